@@ -8,12 +8,21 @@ from flask_cors import CORS
 from src.models.user import db
 from src.models.agente import Agente, Conversacion
 from src.models.sala import Sala, Mensaje, Archivo, Armario, ConocimientoSala
+from src.models.trabajo import Trabajo
+from src.models.lote import Lote, ElementoLote
 from src.routes.user import user_bp
 from src.routes.agentes import agentes_bp
 from src.routes.salas import salas_bp
 from src.routes.modelos import modelos_bp
 from src.routes.archivos import archivos_bp
 from src.routes.web import web_bp
+from src.routes.trabajos import trabajos_bp
+from src.routes.lotes import lotes_bp
+from src.services.circuito import circuitos
+from src.services.catalogo import catalogo
+from src.services.monitor import monitor_servicios
+from src.services.telegram import telegram_runtime
+from src.services.trabajos import cola_trabajos
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
@@ -28,15 +37,40 @@ app.register_blueprint(salas_bp, url_prefix='/api')
 app.register_blueprint(modelos_bp, url_prefix='/api')
 app.register_blueprint(archivos_bp, url_prefix='/api')
 app.register_blueprint(web_bp, url_prefix='/api')
+app.register_blueprint(trabajos_bp, url_prefix='/api')
+app.register_blueprint(lotes_bp, url_prefix='/api')
 
 # Configuración de base de datos
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db.init_app(app)
 
+# Columnas añadidas después de la primera versión (SQLite no las crea con create_all)
+COLUMNAS_NUEVAS = {
+    'agentes': {
+        'cache_habilitado': 'BOOLEAN DEFAULT 0',
+        'cache_ttl': 'INTEGER',
+        'telegram_offset': 'INTEGER',
+        'modelos_respaldo': 'TEXT',
+        'slo_primer_token_ms': 'INTEGER',
+        'plazo_respuesta_ms': 'INTEGER'
+    }
+}
+
+def migrar_columnas():
+    """Añadir a las tablas existentes las columnas que falten"""
+    inspector = db.inspect(db.engine)
+    for tabla, columnas in COLUMNAS_NUEVAS.items():
+        existentes = {columna['name'] for columna in inspector.get_columns(tabla)}
+        for nombre, definicion in columnas.items():
+            if nombre not in existentes:
+                db.session.execute(db.text(f'ALTER TABLE {tabla} ADD COLUMN {nombre} {definicion}'))
+    db.session.commit()
+
 # Crear todas las tablas
 with app.app_context():
     db.create_all()
+    migrar_columnas()
     
     # Crear agentes de ejemplo si no existen
     if Agente.query.count() == 0:
@@ -165,5 +199,32 @@ def health_check():
         'timestamp': os.popen('date').read().strip()
     }
 
+def iniciar_servicios():
+    """Arrancar los servicios en segundo plano del proceso que sirve las peticiones"""
+    # Sondeo de salud de los proveedores locales en segundo plano
+    circuitos.iniciar_sondeo()
+
+    # Refresco del catálogo de modelos locales en segundo plano
+    catalogo.iniciar_refresco()
+
+    # Monitor de procesos y servicios locales
+    monitor_servicios.iniciar()
+
+    # Bots de Telegram de los agentes activos
+    telegram_runtime.iniciar(app)
+    with app.app_context():
+        telegram_runtime.cargar_activos()
+
+    # Workers de la cola persistente de trabajos de generación
+    cola_trabajos.iniciar(app)
+
 if __name__ == '__main__':
+    # Con debug=True el reloader ejecuta este módulo dos veces: un proceso padre
+    # que solo vigila los ficheros y un hijo (WERKZEUG_RUN_MAIN=true) que sirve.
+    # Arrancar los servicios en ambos duplicaría los pollers de Telegram y los workers.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        iniciar_servicios()
     app.run(host='0.0.0.0', port=5000, debug=True)
+else:
+    # Importado por un servidor WSGI (gunicorn src.main:app): este proceso sirve
+    iniciar_servicios()
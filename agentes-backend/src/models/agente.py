@@ -19,9 +19,15 @@ class Agente(db.Model):
     max_tokens = db.Column(db.Integer, default=1000)
     telegram = db.Column(db.Boolean, default=False)
     telegram_token = db.Column(db.String(200))
+    telegram_offset = db.Column(db.Integer)  # siguiente update_id de getUpdates
     base_datos = db.Column(db.String(200))
     voz = db.Column(db.String(20), default='masculina')
     conocimiento_base = db.Column(db.Text)  # JSON string
+    cache_habilitado = db.Column(db.Boolean, default=False)
+    cache_ttl = db.Column(db.Integer)  # segundos; None = TTL por defecto
+    modelos_respaldo = db.Column(db.Text)  # JSON: modelos a probar tras el principal
+    slo_primer_token_ms = db.Column(db.Integer)  # None = RESPALDO_SLO_PRIMER_TOKEN_MS
+    plazo_respuesta_ms = db.Column(db.Integer)  # plazo de cada generación; None = sin plazo propio
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
     fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -44,14 +50,20 @@ class Agente(db.Model):
             'baseDatos': self.base_datos,
             'voz': self.voz,
             'conocimientoBase': json.loads(self.conocimiento_base) if self.conocimiento_base else [],
+            'cacheHabilitado': bool(self.cache_habilitado),
+            'cacheTtl': self.cache_ttl,
+            'modelosRespaldo': json.loads(self.modelos_respaldo) if self.modelos_respaldo else [],
+            'sloPrimerTokenMs': self.slo_primer_token_ms,
+            'plazoRespuestaMs': self.plazo_respuesta_ms,
             'fechaCreacion': self.fecha_creacion.isoformat(),
             'fechaActualizacion': self.fecha_actualizacion.isoformat()
         }
     
     def from_dict(self, data):
         for field in ['nombre', 'rol', 'avatar', 'estado', 'modelo', 'conversaciones', 
-                     'precision', 'aprendiendo', 'prompt', 'temperatura', 'telegram', 
-                     'base_datos', 'voz']:
+                     'precision', 'aprendiendo', 'prompt', 'temperatura', 'maxTokens', 'telegram', 
+                     'telegramToken', 'baseDatos', 'base_datos', 'voz', 'cacheHabilitado', 'cacheTtl', 'sloPrimerTokenMs',
+                     'plazoRespuestaMs']:
             if field in data:
                 if field == 'maxTokens':
                     setattr(self, 'max_tokens', data[field])
@@ -59,11 +71,22 @@ class Agente(db.Model):
                     setattr(self, 'telegram_token', data[field])
                 elif field == 'baseDatos':
                     setattr(self, 'base_datos', data[field])
+                elif field == 'cacheHabilitado':
+                    setattr(self, 'cache_habilitado', bool(data[field]))
+                elif field == 'cacheTtl':
+                    setattr(self, 'cache_ttl', data[field])
+                elif field == 'sloPrimerTokenMs':
+                    setattr(self, 'slo_primer_token_ms', data[field])
+                elif field == 'plazoRespuestaMs':
+                    setattr(self, 'plazo_respuesta_ms', data[field])
                 else:
                     setattr(self, field, data[field])
         
         if 'conocimientoBase' in data:
             self.conocimiento_base = json.dumps(data['conocimientoBase'])
+        
+        if 'modelosRespaldo' in data:
+            self.modelos_respaldo = json.dumps(data['modelosRespaldo'] or [])
 
 class Conversacion(db.Model):
     __tablename__ = 'conversaciones'
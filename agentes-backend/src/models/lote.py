@@ -0,0 +1,75 @@
+from src.models.user import db
+from datetime import datetime
+import json
+
+class Lote(db.Model):
+    __tablename__ = 'lotes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    estado = db.Column(db.String(20), default='pendiente')  # pendiente, en_curso, completado, parcial
+    modelo = db.Column(db.String(100))  # Lote contra un modelo (ollama:llama2, gpt-4...)
+    agente_id = db.Column(db.Integer, db.ForeignKey('agentes.id'))  # o contra un agente
+    usuario = db.Column(db.String(100))
+    parametros = db.Column(db.Text)  # JSON object (prompt de sistema, temperatura, caché...)
+    total = db.Column(db.Integer, default=0)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    elementos = db.relationship('ElementoLote', backref='lote', lazy=True, cascade='all, delete-orphan',
+                                order_by='ElementoLote.indice')
+
+    def recuento(self):
+        """Elementos por estado"""
+        conteo = {'pendiente': 0, 'completado': 0, 'error': 0}
+        for elemento in self.elementos:
+            conteo[elemento.estado] = conteo.get(elemento.estado, 0) + 1
+        return conteo
+
+    def to_dict(self, incluir_elementos=False):
+        conteo = self.recuento()
+        datos = {
+            'id': self.id,
+            'estado': self.estado,
+            'modelo': self.modelo,
+            'agenteId': self.agente_id,
+            'usuario': self.usuario,
+            'total': self.total,
+            'completados': conteo['completado'],
+            'errores': conteo['error'],
+            'pendientes': conteo['pendiente'],
+            'fechaCreacion': self.fecha_creacion.isoformat() if self.fecha_creacion else None,
+            'fechaActualizacion': self.fecha_actualizacion.isoformat() if self.fecha_actualizacion else None
+        }
+        if incluir_elementos:
+            datos['elementos'] = [elemento.to_dict() for elemento in self.elementos]
+        return datos
+
+    def leer_parametros(self):
+        return json.loads(self.parametros) if self.parametros else {}
+
+class ElementoLote(db.Model):
+    __tablename__ = 'elementos_lote'
+
+    id = db.Column(db.Integer, primary_key=True)
+    lote_id = db.Column(db.Integer, db.ForeignKey('lotes.id'), nullable=False, index=True)
+    indice = db.Column(db.Integer, nullable=False)  # Posición del prompt en la petición
+    prompt = db.Column(db.Text, nullable=False)
+    estado = db.Column(db.String(20), default='pendiente')  # pendiente, completado, error
+    respuesta = db.Column(db.Text)
+    modelo = db.Column(db.String(100))
+    error = db.Column(db.Text)
+    intentos = db.Column(db.Integer, default=0)
+    duracion_ms = db.Column(db.Float)
+    fecha_fin = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'indice': self.indice,
+            'estado': self.estado,
+            'respuesta': self.respuesta,
+            'modelo': self.modelo,
+            'error': self.error,
+            'intentos': self.intentos,
+            'duracionMs': self.duracion_ms,
+            'fechaFin': self.fecha_fin.isoformat() if self.fecha_fin else None
+        }
@@ -0,0 +1,55 @@
+from src.models.user import db
+from datetime import datetime
+import json
+
+class Trabajo(db.Model):
+    __tablename__ = 'trabajos'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(20), nullable=False)  # sala, chat
+    estado = db.Column(db.String(20), default='pendiente', index=True)  # pendiente, en_curso, completado, error
+    agente_id = db.Column(db.Integer, db.ForeignKey('agentes.id'), nullable=False)
+    sala_id = db.Column(db.Integer, db.ForeignKey('salas.id'))
+    mensaje_id = db.Column(db.Integer)  # Mensaje del usuario en la sala
+    usuario = db.Column(db.String(100))
+    mensaje = db.Column(db.Text, nullable=False)  # Texto del usuario
+    prompt = db.Column(db.Text, nullable=False)  # Mensaje con historial que se envía al modelo
+    parametros = db.Column(db.Text)  # JSON object (sesión, caché)
+    intentos = db.Column(db.Integer, default=0)
+    disponible_en = db.Column(db.DateTime, default=datetime.utcnow)  # No se procesa antes (reintentos)
+    respuesta = db.Column(db.Text)
+    modelo = db.Column(db.String(100))
+    error = db.Column(db.Text)
+    resultado_id = db.Column(db.Integer)  # Mensaje de sala o conversación guardados
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_inicio = db.Column(db.DateTime)
+    propietario = db.Column(db.String(100))  # Proceso que lo está generando (host:pid:id)
+    latido = db.Column(db.DateTime)  # Último latido del propietario; sin latidos la concesión caduca
+    fecha_fin = db.Column(db.DateTime)
+
+    @property
+    def terminado(self):
+        return self.estado in ('completado', 'error')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'tipo': self.tipo,
+            'estado': self.estado,
+            'agenteId': self.agente_id,
+            'salaId': self.sala_id,
+            'mensajeId': self.mensaje_id,
+            'usuario': self.usuario,
+            'mensaje': self.mensaje,
+            'intentos': self.intentos,
+            'respuesta': self.respuesta,
+            'modelo': self.modelo,
+            'error': self.error,
+            'resultadoId': self.resultado_id,
+            'fechaCreacion': self.fecha_creacion.isoformat() if self.fecha_creacion else None,
+            'fechaInicio': self.fecha_inicio.isoformat() if self.fecha_inicio else None,
+            'fechaFin': self.fecha_fin.isoformat() if self.fecha_fin else None
+        }
+
+    def leer_parametros(self):
+        return json.loads(self.parametros) if self.parametros else {}
@@ -1,9 +1,27 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 import requests
 import json
 import os
+import time
+from contextlib import closing
 from datetime import datetime
 from src.models.agente import db, Agente, Conversacion
+from src.services import proveedores
+from src.services.catalogo import catalogo
+from src.services.residencia import residencia_ollama
+from src.services.sesiones import sesiones_ollama, clave_sesion
+from src.services.historial import historial_chat
+from src.services.telegram import telegram_runtime, validacion_tokens
+from src.services.respaldo import respaldo_modelos, modelo_de, cadena_modelos, slo_primer_token
+from src.services.limites import limites_api, estimar_tokens_peticion
+from src.services.trabajos import cola_trabajos, solicita_asincrono
+from src.services.proveedores import ErrorProveedor, PlazoAgotado, proveedor_de_modelo
+from src.services.plazos import con_plazo, plazo_solicitado, agotado, respuesta_plazo_agotado
+from src.services.concurrencia import stream_con_contexto
+from src.services.cache_respuestas import cache_respuestas, clave_solicitud, cache_aplica, preferencia_cache
+from src.services.coalescencia import vuelos
+from src.services.admision import control_admision, SaturacionProveedor, respuesta_saturacion, inquilino, como_inquilino
+from src.services.streaming import solicita_stream, evento_sse, respuesta_sse, leer_eventos_sse
 
 agentes_bp = Blueprint('agentes', __name__)
 
@@ -27,8 +45,10 @@ def crear_agente():
         data = request.get_json()
         
         # Validar token de Telegram si está habilitado
+        validacion = None
         if data.get('telegram') and data.get('telegramToken'):
-            if not verificar_telegram_bot(data['telegramToken']):
+            validacion = validar_telegram(data['telegramToken'])
+            if validacion == 'invalido':
                 return jsonify({'error': 'Token de Telegram inválido'}), 400
         
         agente = Agente()
@@ -37,7 +57,7 @@ def crear_agente():
         db.session.add(agente)
         db.session.commit()
         
-        return jsonify(agente.to_dict()), 201
+        return respuesta_agente(agente, validacion), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -49,15 +69,28 @@ def actualizar_agente(agente_id):
         agente = Agente.query.get_or_404(agente_id)
         data = request.get_json()
         
-        # Validar token de Telegram si está habilitado
-        if data.get('telegram') and data.get('telegramToken'):
-            if not verificar_telegram_bot(data['telegramToken']):
+        # Validar token de Telegram si está habilitado (solo si cambia)
+        validacion = None
+        if data.get('telegram') and data.get('telegramToken') and data['telegramToken'] != agente.telegram_token:
+            validacion = validar_telegram(data['telegramToken'])
+            if validacion == 'invalido':
                 return jsonify({'error': 'Token de Telegram inválido'}), 400
         
+        telegram_anterior = (agente.telegram, agente.telegram_token)
         agente.from_dict(data)
+        if agente.telegram_token != telegram_anterior[1]:
+            # El offset de getUpdates es propio de cada bot
+            agente.telegram_offset = None
         db.session.commit()
         
-        return jsonify(agente.to_dict())
+        # Reiniciar el bot si el agente está activo y cambió su configuración de Telegram
+        if agente.estado == 'activo' and (agente.telegram, agente.telegram_token) != telegram_anterior:
+            if agente.telegram and agente.telegram_token:
+                iniciar_polling_telegram(agente)
+            else:
+                detener_polling_telegram(agente_id)
+        
+        return respuesta_agente(agente, validacion)
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -69,12 +102,47 @@ def eliminar_agente(agente_id):
         agente = Agente.query.get_or_404(agente_id)
         db.session.delete(agente)
         db.session.commit()
+        sesiones_ollama.olvidar_agente(agente_id)
+        detener_polling_telegram(agente_id)
         
         return jsonify({'mensaje': 'Agente eliminado exitosamente'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@agentes_bp.route('/agentes/<int:agente_id>/sesiones', methods=['DELETE'])
+def olvidar_sesiones_agente(agente_id):
+    """Borrar la memoria de conversación del agente"""
+    try:
+        Agente.query.get_or_404(agente_id)
+        sesiones_ollama.olvidar_agente(agente_id)
+        
+        return jsonify({'mensaje': 'Conversaciones del agente reiniciadas'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@agentes_bp.route('/agentes/telegram/estado', methods=['GET'])
+def estado_telegram():
+    """Estado de los bots de Telegram en ejecución"""
+    try:
+        return jsonify({
+            'telegram': telegram_runtime.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@agentes_bp.route('/agentes/respaldo/estado', methods=['GET'])
+def estado_respaldo():
+    """Estadísticas de las coberturas y respaldos entre modelos"""
+    try:
+        return jsonify({
+            'respaldo': respaldo_modelos.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @agentes_bp.route('/agentes/<int:agente_id>/activar', methods=['POST'])
 def activar_agente(agente_id):
     """Activar un agente"""
@@ -124,8 +192,28 @@ def chat_con_agente(agente_id):
         if not mensaje.strip():
             return jsonify({'error': 'Mensaje vacío'}), 400
         
+        # Modo streaming: enviar tokens por SSE a medida que llegan
+        if solicita_stream(data):
+            return respuesta_sse(stream_chat_agente(agente, mensaje, data))
+        
+        # Modo asíncrono: encolar la generación y responder 202 con el trabajo
+        if solicita_asincrono(data):
+            trabajo = cola_trabajos.encolar('chat', agente, mensaje, mensaje_con_historial(agente, mensaje, data),
+                                            data.get('usuario', 'Usuario'), sala_id=data.get('salaId'),
+                                            sesion=sesion_chat(agente, data), cache=preferencia_cache(data))
+            db.session.commit()
+            cola_trabajos.avisar()
+            return jsonify({'trabajo': trabajo.to_dict()}), 202
+        
         # Generar respuesta usando el modelo del agente
-        respuesta = generar_respuesta_ia(mensaje, agente)
+        try:
+            with como_inquilino(inquilino_chat(data)), con_plazo(plazo_solicitado(agente)):
+                respuesta = generar_respuesta_ia(mensaje_con_historial(agente, mensaje, data), agente,
+                                                 preferencia_cache(data), sesion_chat(agente, data))
+        except SaturacionProveedor as e:
+            return respuesta_saturacion(e)
+        except PlazoAgotado as e:
+            return respuesta_plazo_agotado(e)
         
         # Guardar conversación en base de datos
         conversacion = Conversacion(
@@ -145,40 +233,138 @@ def chat_con_agente(agente_id):
         
         return jsonify({
             'respuesta': respuesta,
+            'modelo': modelo_de(respuesta, agente.modelo),
             'conversacion': conversacion.to_dict()
         })
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+def inquilino_chat(data):
+    """Inquilino del reparto justo para el chat directo: su sala o su usuario"""
+    return inquilino(data.get('salaId'), data.get('usuario', 'Usuario'))
+
+def sesion_chat(agente, data):
+    """Conversación del chat directo: el agente con la sala o el usuario indicados"""
+    return clave_sesion(agente.id, data.get('salaId'), data.get('usuario', 'Usuario'))
+
+def mensaje_con_historial(agente, mensaje, data):
+    """Mensaje con los turnos anteriores del chat (salvo si Ollama ya guarda el contexto)"""
+    if sesiones_ollama.tiene_contexto(sesion_chat(agente, data), agente):
+        return mensaje
+    return historial_chat(agente, data.get('usuario', 'Usuario'), data.get('salaId'), mensaje)
+
+def stream_chat_agente(agente, mensaje, data):
+    """Generador de eventos SSE para el chat en streaming con un agente"""
+    inicio = time.monotonic()
+    primer_token_ms = None
+    partes = []
+    error = None
+    modelo = agente.modelo
+    
+    yield evento_sse('inicio', {'agenteId': agente.id, 'modelo': agente.modelo})
+    
+    try:
+        mensaje_ia = mensaje_con_historial(agente, mensaje, data)
+        # El stream se consume con el inquilino y el plazo de la petición; si el
+        # cliente se desconecta, al cerrarse el generador se cierra la conexión
+        # con el proveedor y el modelo deja de generar
+        with como_inquilino(inquilino_chat(data)), con_plazo(plazo_solicitado(agente)):
+            tokens = stream_con_contexto(
+                generar_respuesta_ia_stream(mensaje_ia, agente, preferencia_cache(data), sesion_chat(agente, data))
+            )
+        for token in tokens:
+            if primer_token_ms is None:
+                primer_token_ms = round((time.monotonic() - inicio) * 1000, 1)
+                modelo = modelo_de(token, modelo)
+            partes.append(token)
+            yield evento_sse('token', {'token': token})
+    except SaturacionProveedor as e:
+        # Sin hueco en el proveedor: avisar al cliente y no guardar nada
+        yield evento_sse('error', {
+            'error': str(e),
+            'codigo': e.codigo,
+            'reintentarEn': e.reintentar_en
+        })
+        return
+    except PlazoAgotado as e:
+        # Plazo vencido: se corta el stream sin guardar una respuesta a medias
+        yield evento_sse('error', {'error': str(e), 'codigo': e.codigo})
+        return
+    except ErrorProveedor as e:
+        error = str(e)
+    except Exception as e:
+        error = f"Error generando respuesta: {str(e)}"
+    
+    respuesta = ''.join(partes) if error is None else error
+    if error is not None:
+        yield evento_sse('error', {'error': error})
+    
+    # Guardar la conversación una vez terminado el stream
+    try:
+        conversacion = Conversacion(
+            agente_id=agente.id,
+            sala_id=data.get('salaId'),
+            usuario=data.get('usuario', 'Usuario'),
+            mensaje_usuario=mensaje,
+            respuesta_agente=respuesta,
+            canal='web'
+        )
+        db.session.add(conversacion)
+        agente.conversaciones += 1
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        yield evento_sse('error', {'error': str(e)})
+        return
+    
+    yield evento_sse('fin', {
+        'respuesta': respuesta,
+        'modelo': modelo,
+        'conversacion': conversacion.to_dict(),
+        'metricas': {
+            'primerTokenMs': primer_token_ms,
+            'totalMs': round((time.monotonic() - inicio) * 1000, 1),
+            'tokens': len(partes)
+        }
+    })
+
 def verificar_telegram_bot(token):
     """Verificar si un token de Telegram es válido"""
-    try:
-        response = requests.get(f'https://api.telegram.org/bot{token}/getMe', timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            return data.get('ok', False)
-        return False
-    except:
-        return False
+    return validacion_tokens.validar(token)
+
+def validar_telegram(token):
+    """'valido', 'invalido' o 'pendiente' (con ?validacion=async y sin resultado en caché)"""
+    if request.args.get('validacion') == 'async':
+        resultado = validacion_tokens.validar_en_segundo_plano(token)
+        if resultado is None:
+            return 'pendiente'
+    else:
+        resultado = verificar_telegram_bot(token)
+    return 'valido' if resultado else 'invalido'
+
+def respuesta_agente(agente, validacion=None):
+    """JSON del agente; indica en una cabecera el resultado de validar el token"""
+    response = jsonify(agente.to_dict())
+    if validacion:
+        response.headers['X-Telegram-Validacion'] = validacion
+    return response
 
 def verificar_modelo_disponible(modelo):
     """Verificar si un modelo está disponible"""
     try:
         if modelo.startswith('ollama:'):
-            # Verificar Ollama
-            response = requests.get('http://localhost:11434/api/tags', timeout=5)
-            if response.status_code == 200:
-                data = response.json()
+            # Verificar Ollama (desde el catálogo en memoria)
+            modelos = catalogo.modelos('ollama')
+            if modelos is not None:
                 modelo_nombre = modelo.replace('ollama:', '')
-                return any(m['name'].startswith(modelo_nombre) for m in data.get('models', []))
+                return any(m.startswith(modelo_nombre) for m in modelos)
         
         elif modelo.startswith('lmstudio:'):
             # Verificar LM Studio
-            response = requests.get('http://localhost:1234/v1/models', timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                return len(data.get('data', [])) > 0
+            modelos = catalogo.modelos('lmstudio')
+            if modelos is not None:
+                return len(modelos) > 0
         
         elif modelo in ['gpt-4', 'gpt-3.5-turbo']:
             # Verificar OpenAI
@@ -192,56 +378,131 @@ def verificar_modelo_disponible(modelo):
     except:
         return False
 
-def generar_respuesta_ia(mensaje, agente):
+def generar_respuesta_ia(mensaje, agente, usar_cache=None, sesion=None):
     """Generar respuesta usando el modelo de IA del agente"""
     try:
-        modelo = agente.modelo
-        
-        if modelo.startswith('ollama:'):
-            return generar_respuesta_ollama(mensaje, agente)
-        elif modelo.startswith('lmstudio:'):
-            return generar_respuesta_lmstudio(mensaje, agente)
-        elif modelo in ['gpt-4', 'gpt-3.5-turbo']:
-            return generar_respuesta_openai(mensaje, agente)
-        elif modelo.startswith('claude'):
-            return generar_respuesta_claude(mensaje, agente)
-        else:
-            return "Lo siento, mi modelo de IA no está disponible en este momento."
+        return generar_respuesta_agente(mensaje, agente, usar_cache, sesion)
     
+    except (SaturacionProveedor, PlazoAgotado):
+        # Se propagan para poder responder 429/503 con Retry-After o 504
+        raise
+    except ErrorProveedor as e:
+        return str(e)
     except Exception as e:
         return f"Error generando respuesta: {str(e)}"
 
-def generar_respuesta_ollama(mensaje, agente):
+def generar_respuesta_agente(mensaje, agente, usar_cache=None, sesion=None):
+    """Como generar_respuesta_ia, pero los fallos del proveedor lanzan ErrorProveedor"""
+    clave = clave_generacion(mensaje, agente)
+    con_sesion = sesiones_ollama.aplica(agente.modelo, sesion)
+    con_cache = not con_sesion and usa_cache_agente(agente, usar_cache)
+    if con_cache:
+        respuesta = cache_respuestas.obtener(clave)
+        if respuesta is not None:
+            return respuesta
+    
+    # Peticiones idénticas simultáneas comparten una sola llamada al proveedor
+    # (salvo con contexto de conversación: la respuesta depende del historial)
+    clave_vuelo = clave if usar_cache is not False and not con_sesion else None
+    respuesta = vuelos.ejecutar(clave_vuelo, generar_respuesta_proveedor, mensaje, agente, sesion,
+                                proveedor=proveedor_de_modelo(agente.modelo))
+    
+    # Solo se guardan respuestas correctas del modelo pedido; los errores lanzan
+    # ErrorProveedor y las de un modelo de respaldo no deben fijarse en la caché
+    if con_cache and modelo_de(respuesta, agente.modelo) == agente.modelo:
+        cache_respuestas.guardar(clave, respuesta, getattr(agente, 'cache_ttl', None))
+    return respuesta
+
+def clave_generacion(mensaje, agente):
+    """Clave que identifica una petición de generación (caché y coalescencia)"""
+    respaldo = None
+    if respaldo_modelos.aplica(agente):
+        # Agentes con otra cadena de respaldo no comparten vuelo ni respuesta
+        respaldo = [cadena_modelos(agente), slo_primer_token(agente)]
+    return clave_solicitud(agente.modelo, agente.prompt, mensaje, agente.temperatura, agente.max_tokens,
+                           respaldo)
+
+def usa_cache_agente(agente, usar_cache=None):
+    """Indica si la petición puede servirse desde la caché de respuestas"""
+    if cache_aplica(agente.temperatura, getattr(agente, 'cache_habilitado', False), usar_cache):
+        return True
+    if usar_cache is False:
+        cache_respuestas.registrar_omitido()
+    return False
+
+def funciones_proveedor(modelo):
+    """Funciones (completa, streaming) del proveedor que sirve el modelo"""
+    if modelo.startswith('ollama:'):
+        return generar_respuesta_ollama, stream_respuesta_ollama
+    elif modelo.startswith('lmstudio:'):
+        return generar_respuesta_lmstudio, stream_respuesta_lmstudio
+    elif modelo in ['gpt-4', 'gpt-3.5-turbo']:
+        return generar_respuesta_openai, stream_respuesta_openai
+    elif modelo.startswith('claude'):
+        return generar_respuesta_claude, stream_respuesta_claude
+    raise ErrorProveedor("Lo siento, mi modelo de IA no está disponible en este momento.")
+
+def generar_respuesta_proveedor(mensaje, agente, sesion=None):
+    """Llamar al proveedor del modelo del agente; lanza ErrorProveedor si falla"""
+    if respaldo_modelos.aplica(agente):
+        # Con cadena de respaldo se usa streaming para medir el primer token
+        return respaldo_modelos.generar(stream_modelo, mensaje, agente, sesion)
+    
+    generar, _ = funciones_proveedor(agente.modelo)
+    
+    # Esperar turno en el proveedor/modelo (o rechazar si la cola está llena)
+    with control_admision.admitir(agente.modelo):
+        return generar(mensaje, agente, sesion)
+
+def payload_ollama(mensaje, agente, sesion, modelo_nombre, keep_alive, stream):
+    """Cuerpo de /api/generate, reenviando el contexto de la conversación si existe"""
+    contexto = sesiones_ollama.obtener(sesion, agente) if sesiones_ollama.aplica(agente.modelo, sesion) else None
+    payload = {
+        'model': modelo_nombre,
+        'prompt': f"{agente.prompt}\n\nUsuario: {mensaje}\nAsistente:",
+        'stream': stream,
+        'keep_alive': keep_alive,
+        'options': {
+            'temperature': agente.temperatura,
+            'num_predict': agente.max_tokens
+        }
+    }
+    if contexto:
+        # El prompt del agente ya está dentro del contexto
+        payload['prompt'] = f"Usuario: {mensaje}\nAsistente:"
+        payload['context'] = contexto
+    return payload
+
+def guardar_contexto_ollama(sesion, agente, data):
+    if data.get('context') and sesiones_ollama.aplica(agente.modelo, sesion):
+        sesiones_ollama.guardar(sesion, agente, data['context'])
+
+def generar_respuesta_ollama(mensaje, agente, sesion=None):
     """Generar respuesta usando Ollama"""
     try:
         modelo_nombre = agente.modelo.replace('ollama:', '')
         
-        response = requests.post('http://localhost:11434/api/generate', 
-            json={
-                'model': modelo_nombre,
-                'prompt': f"{agente.prompt}\n\nUsuario: {mensaje}\nAsistente:",
-                'stream': False,
-                'options': {
-                    'temperature': agente.temperatura,
-                    'num_predict': agente.max_tokens
-                }
-            },
-            timeout=30
-        )
+        with residencia_ollama.usar(modelo_nombre) as uso:
+            response = proveedores.post('ollama', uso.url('/api/generate'),
+                json=payload_ollama(mensaje, agente, sesion, modelo_nombre, uso.keep_alive, False)
+            )
         
         if response.status_code == 200:
             data = response.json()
+            guardar_contexto_ollama(sesion, agente, data)
             return data.get('response', 'Sin respuesta')
-        else:
-            return "Error conectando con Ollama"
     
+    except (SaturacionProveedor, PlazoAgotado):
+        raise
     except Exception as e:
-        return f"Error Ollama: {str(e)}"
+        raise ErrorProveedor(f"Error Ollama: {str(e)}", 'ollama')
+    
+    raise ErrorProveedor("Error conectando con Ollama", 'ollama', response.status_code)
 
-def generar_respuesta_lmstudio(mensaje, agente):
+def generar_respuesta_lmstudio(mensaje, agente, sesion=None):
     """Generar respuesta usando LM Studio"""
     try:
-        response = requests.post('http://localhost:1234/v1/chat/completions',
+        response = proveedores.post('lmstudio', '/v1/chat/completions',
             json={
                 'messages': [
                     {'role': 'system', 'content': agente.prompt},
@@ -249,30 +510,34 @@ def generar_respuesta_lmstudio(mensaje, agente):
                 ],
                 'temperature': agente.temperatura,
                 'max_tokens': agente.max_tokens
-            },
-            timeout=30
+            }
         )
         
         if response.status_code == 200:
             data = response.json()
             return data['choices'][0]['message']['content']
-        else:
-            return "Error conectando con LM Studio"
     
+    except (SaturacionProveedor, PlazoAgotado):
+        raise
     except Exception as e:
-        return f"Error LM Studio: {str(e)}"
+        raise ErrorProveedor(f"Error LM Studio: {str(e)}", 'lmstudio')
+    
+    raise ErrorProveedor("Error conectando con LM Studio", 'lmstudio', response.status_code)
 
-def generar_respuesta_openai(mensaje, agente):
+def generar_respuesta_openai(mensaje, agente, sesion=None):
     """Generar respuesta usando OpenAI"""
+    if not OPENAI_API_KEY:
+        raise ErrorProveedor("API Key de OpenAI no configurada", 'openai')
+    
+    headers = {
+        'Authorization': f'Bearer {OPENAI_API_KEY}',
+        'Content-Type': 'application/json'
+    }
+    tokens = estimar_tokens_peticion(agente.prompt, mensaje, max_tokens=agente.max_tokens)
     try:
-        if not OPENAI_API_KEY:
-            return "API Key de OpenAI no configurada"
-        
-        response = requests.post('https://api.openai.com/v1/chat/completions',
-            headers={
-                'Authorization': f'Bearer {OPENAI_API_KEY}',
-                'Content-Type': 'application/json'
-            },
+        # Espera su turno en los límites RPM/TPM de la clave y reintenta los 429
+        response = limites_api.post('openai', '/chat/completions', tokens,
+            headers=headers,
             json={
                 'model': agente.modelo,
                 'messages': [
@@ -281,60 +546,238 @@ def generar_respuesta_openai(mensaje, agente):
                 ],
                 'temperature': agente.temperatura,
                 'max_tokens': agente.max_tokens
-            },
-            timeout=30
+            }
         )
         
         if response.status_code == 200:
             data = response.json()
+            limites_api.ajustar('openai', headers, tokens, data.get('usage', {}).get('total_tokens'))
             return data['choices'][0]['message']['content']
-        else:
-            return f"Error OpenAI: {response.status_code}"
     
+    except (SaturacionProveedor, PlazoAgotado):
+        raise
     except Exception as e:
-        return f"Error OpenAI: {str(e)}"
+        raise ErrorProveedor(f"Error OpenAI: {str(e)}", 'openai')
+    
+    raise ErrorProveedor(f"Error OpenAI: {response.status_code}", 'openai', response.status_code)
 
-def generar_respuesta_claude(mensaje, agente):
+def generar_respuesta_claude(mensaje, agente, sesion=None):
     """Generar respuesta usando Claude"""
+    if not ANTHROPIC_API_KEY:
+        raise ErrorProveedor("API Key de Anthropic no configurada", 'anthropic')
+    
+    headers = {
+        'x-api-key': ANTHROPIC_API_KEY,
+        'Content-Type': 'application/json',
+        'anthropic-version': '2023-06-01'
+    }
+    tokens = estimar_tokens_peticion(agente.prompt, mensaje, max_tokens=agente.max_tokens)
     try:
-        if not ANTHROPIC_API_KEY:
-            return "API Key de Anthropic no configurada"
-        
-        response = requests.post('https://api.anthropic.com/v1/messages',
-            headers={
-                'x-api-key': ANTHROPIC_API_KEY,
-                'Content-Type': 'application/json',
-                'anthropic-version': '2023-06-01'
-            },
+        response = limites_api.post('anthropic', '/v1/messages', tokens,
+            headers=headers,
             json={
                 'model': agente.modelo,
                 'max_tokens': agente.max_tokens,
                 'messages': [
                     {'role': 'user', 'content': f"{agente.prompt}\n\n{mensaje}"}
                 ]
-            },
-            timeout=30
+            }
         )
         
         if response.status_code == 200:
             data = response.json()
+            uso = data.get('usage') or {}
+            if 'input_tokens' in uso:
+                limites_api.ajustar('anthropic', headers, tokens, uso['input_tokens'] + uso.get('output_tokens', 0))
             return data['content'][0]['text']
-        else:
-            return f"Error Claude: {response.status_code}"
     
+    except (SaturacionProveedor, PlazoAgotado):
+        raise
     except Exception as e:
-        return f"Error Claude: {str(e)}"
+        raise ErrorProveedor(f"Error Claude: {str(e)}", 'anthropic')
+    
+    raise ErrorProveedor(f"Error Claude: {response.status_code}", 'anthropic', response.status_code)
 
-# Variables globales para polling de Telegram
-telegram_polling = {}
+def generar_respuesta_ia_stream(mensaje, agente, usar_cache=None, sesion=None):
+    """Generar respuesta en streaming; produce los tokens a medida que llegan"""
+    clave = clave_generacion(mensaje, agente)
+    con_sesion = sesiones_ollama.aplica(agente.modelo, sesion)
+    con_cache = not con_sesion and usa_cache_agente(agente, usar_cache)
+    if con_cache:
+        respuesta = cache_respuestas.obtener(clave)
+        if respuesta is not None:
+            yield respuesta
+            return
+    
+    partes = []
+    clave_vuelo = clave if usar_cache is not False and not con_sesion else None
+    for token in vuelos.ejecutar_stream(clave_vuelo, stream_respuesta_proveedor, mensaje, agente, sesion,
+                                        proveedor=proveedor_de_modelo(agente.modelo)):
+        partes.append(token)
+        yield token
+    
+    if con_cache and partes and modelo_de(partes[0], agente.modelo) == agente.modelo:
+        cache_respuestas.guardar(clave, ''.join(partes), getattr(agente, 'cache_ttl', None))
+
+def stream_respuesta_proveedor(mensaje, agente, sesion=None):
+    """Abrir el stream de tokens del proveedor del modelo del agente"""
+    if respaldo_modelos.aplica(agente):
+        yield from respaldo_modelos.stream(stream_modelo, mensaje, agente, sesion)
+    else:
+        yield from stream_modelo(mensaje, agente, sesion)
+
+def stream_modelo(mensaje, agente, sesion=None):
+    """Stream de tokens de un único modelo, dentro de su hueco de admisión"""
+    _, stream = funciones_proveedor(agente.modelo)
+    
+    # El hueco de admisión se mantiene mientras dura el stream
+    with control_admision.admitir(agente.modelo), closing(stream(mensaje, agente, sesion)) as tokens:
+        for token in tokens:
+            if agotado():
+                # Plazo vencido: al cerrar el stream se corta la generación en el proveedor
+                raise PlazoAgotado(proveedor_de_modelo(agente.modelo) or agente.modelo)
+            yield token
+
+def stream_respuesta_ollama(mensaje, agente, sesion=None):
+    """Streaming de tokens desde Ollama (NDJSON)"""
+    modelo_nombre = agente.modelo.replace('ollama:', '')
+    with residencia_ollama.usar(modelo_nombre) as uso:
+        try:
+            response = proveedores.post('ollama', uso.url('/api/generate'),
+                json=payload_ollama(mensaje, agente, sesion, modelo_nombre, uso.keep_alive, True),
+                stream=True
+            )
+        except (SaturacionProveedor, PlazoAgotado):
+            raise
+        except Exception as e:
+            raise ErrorProveedor(f"Error Ollama: {str(e)}", 'ollama')
+        
+        with response:
+            if response.status_code != 200:
+                raise ErrorProveedor("Error conectando con Ollama", 'ollama', response.status_code)
+            
+            for linea in response.iter_lines():
+                if not linea:
+                    continue
+                data = json.loads(linea)
+                if data.get('error'):
+                    raise ErrorProveedor(f"Error Ollama: {data['error']}", 'ollama')
+                if data.get('response'):
+                    yield data['response']
+                if data.get('done'):
+                    guardar_contexto_ollama(sesion, agente, data)
+                    break
+
+def _stream_chat_completions(proveedor, ruta, payload, headers, etiqueta):
+    """Streaming de tokens desde una API compatible con OpenAI (SSE)"""
+    tokens = estimar_tokens_peticion(*(m['content'] for m in payload.get('messages', [])),
+                                     max_tokens=payload.get('max_tokens'))
+    try:
+        response = limites_api.post(proveedor, ruta, tokens, json=payload, headers=headers, stream=True)
+    except (SaturacionProveedor, PlazoAgotado):
+        raise
+    except Exception as e:
+        raise ErrorProveedor(f"Error {etiqueta}: {str(e)}", proveedor)
+    
+    with response:
+        if response.status_code != 200:
+            if proveedor == 'lmstudio':
+                raise ErrorProveedor("Error conectando con LM Studio", proveedor, response.status_code)
+            raise ErrorProveedor(f"Error {etiqueta}: {response.status_code}", proveedor, response.status_code)
+        
+        for _, datos in leer_eventos_sse(response):
+            if datos == '[DONE]':
+                break
+            data = json.loads(datos)
+            opciones = data.get('choices') or [{}]
+            token = opciones[0].get('delta', {}).get('content')
+            if token:
+                yield token
+
+def stream_respuesta_lmstudio(mensaje, agente, sesion=None):
+    """Streaming de tokens desde LM Studio"""
+    return _stream_chat_completions('lmstudio', '/v1/chat/completions', {
+        'messages': [
+            {'role': 'system', 'content': agente.prompt},
+            {'role': 'user', 'content': mensaje}
+        ],
+        'temperature': agente.temperatura,
+        'max_tokens': agente.max_tokens,
+        'stream': True
+    }, None, 'LM Studio')
+
+def stream_respuesta_openai(mensaje, agente, sesion=None):
+    """Streaming de tokens desde OpenAI"""
+    if not OPENAI_API_KEY:
+        raise ErrorProveedor("API Key de OpenAI no configurada", 'openai')
+    
+    return _stream_chat_completions('openai', '/chat/completions', {
+        'model': agente.modelo,
+        'messages': [
+            {'role': 'system', 'content': agente.prompt},
+            {'role': 'user', 'content': mensaje}
+        ],
+        'temperature': agente.temperatura,
+        'max_tokens': agente.max_tokens,
+        'stream': True
+    }, {
+        'Authorization': f'Bearer {OPENAI_API_KEY}',
+        'Content-Type': 'application/json'
+    }, 'OpenAI')
+
+def stream_respuesta_claude(mensaje, agente, sesion=None):
+    """Streaming de tokens desde Claude"""
+    if not ANTHROPIC_API_KEY:
+        raise ErrorProveedor("API Key de Anthropic no configurada", 'anthropic')
+    
+    return _stream_claude(mensaje, agente)
+
+def _stream_claude(mensaje, agente):
+    tokens = estimar_tokens_peticion(agente.prompt, mensaje, max_tokens=agente.max_tokens)
+    try:
+        response = limites_api.post('anthropic', '/v1/messages', tokens,
+            headers={
+                'x-api-key': ANTHROPIC_API_KEY,
+                'Content-Type': 'application/json',
+                'anthropic-version': '2023-06-01'
+            },
+            json={
+                'model': agente.modelo,
+                'max_tokens': agente.max_tokens,
+                'messages': [
+                    {'role': 'user', 'content': f"{agente.prompt}\n\n{mensaje}"}
+                ],
+                'stream': True
+            },
+            stream=True
+        )
+    except (SaturacionProveedor, PlazoAgotado):
+        raise
+    except Exception as e:
+        raise ErrorProveedor(f"Error Claude: {str(e)}", 'anthropic')
+    
+    with response:
+        if response.status_code != 200:
+            raise ErrorProveedor(f"Error Claude: {response.status_code}", 'anthropic', response.status_code)
+        
+        for evento, datos in leer_eventos_sse(response):
+            data = json.loads(datos)
+            tipo = data.get('type', evento)
+            if tipo == 'content_block_delta':
+                token = data.get('delta', {}).get('text')
+                if token:
+                    yield token
+            elif tipo == 'error':
+                raise ErrorProveedor(f"Error Claude: {data.get('error', {}).get('message', '')}", 'anthropic')
+            elif tipo == 'message_stop':
+                break
 
 def iniciar_polling_telegram(agente):
     """Iniciar polling de Telegram para un agente"""
-    # Implementar polling real aquí
-    pass
+    telegram_runtime.iniciar(current_app._get_current_object())
+    telegram_runtime.agregar(agente.id, agente.telegram_token, agente.telegram_offset)
 
 def detener_polling_telegram(agente_id):
     """Detener polling de Telegram para un agente"""
-    # Implementar detención de polling aquí
-    pass
+    telegram_runtime.quitar(agente_id)
 
@@ -0,0 +1,128 @@
+from flask import Blueprint, request, jsonify
+from datetime import datetime
+from functools import partial
+from src.models.user import db
+from src.models.agente import Agente
+from src.models.lote import Lote
+from src.routes.agentes import generar_respuesta_agente
+from src.routes.modelos import generador_para_modelo, generar_con_cache
+from src.services.concurrencia import copiar_agente
+from src.services.cache_respuestas import preferencia_cache
+from src.services.plazos import limitar, plazo_agente
+from src.services.streaming import formatear_evento, respuesta_stream
+from src.services.lotes import gestor_lotes, concurrencia_lote, LOTE_MAX_PROMPTS
+
+lotes_bp = Blueprint('lotes', __name__)
+
+@lotes_bp.route('/lotes', methods=['POST'])
+def crear_lote():
+    """Generar una lista de prompts con un modelo o un agente; los resultados
+    se envían como NDJSON según terminan, con el índice de cada prompt"""
+    try:
+        data = request.get_json()
+        prompts = data.get('prompts')
+        modelo = data.get('modelo')
+        agente_id = data.get('agenteId')
+
+        if not isinstance(prompts, list) or not prompts:
+            return jsonify({'error': 'Se requiere una lista de prompts'}), 400
+        if not all(isinstance(prompt, str) and prompt.strip() for prompt in prompts):
+            return jsonify({'error': 'Todos los prompts deben ser texto no vacío'}), 400
+        if len(prompts) > LOTE_MAX_PROMPTS:
+            return jsonify({'error': f'Máximo {LOTE_MAX_PROMPTS} prompts por lote'}), 400
+        if bool(modelo) == bool(agente_id):
+            return jsonify({'error': 'Indica un modelo o un agenteId'}), 400
+
+        if agente_id:
+            agente = Agente.query.get_or_404(agente_id)
+            modelo = agente.modelo
+        elif not generador_para_modelo(modelo):
+            return jsonify({'error': f'Modelo no soportado: {modelo}'}), 400
+
+        lote = gestor_lotes.crear(
+            prompts, modelo, agente_id, data.get('usuario', 'Usuario'),
+            prompt_sistema=data.get('prompt_sistema', 'Eres un asistente útil.'),
+            temperatura=data.get('temperatura', 0.7),
+            max_tokens=data.get('max_tokens', 1000),
+            concurrencia=data.get('concurrencia'),
+            cache=preferencia_cache(data)
+        )
+        return stream_lote(lote)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@lotes_bp.route('/lotes/<int:lote_id>/reanudar', methods=['POST'])
+def reanudar_lote(lote_id):
+    """Generar lo que falta de un lote cortado; antes se reenvían los resultados guardados"""
+    try:
+        lote = Lote.query.get_or_404(lote_id)
+        data = request.get_json(silent=True) or {}
+        reintentar_errores = bool(data.get('reintentarErrores')) or \
+            request.args.get('reintentarErrores', '').lower() in ('1', 'true')
+
+        # Reclamar en la base de datos: de dos reanudaciones simultáneas solo sigue una
+        if not gestor_lotes.reclamar(lote.id):
+            return jsonify({'error': 'El lote ya se está generando'}), 409
+        db.session.refresh(lote)
+        return stream_lote(lote, reanudar=True, reintentar_errores=reintentar_errores)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@lotes_bp.route('/lotes/<int:lote_id>', methods=['GET'])
+def obtener_lote(lote_id):
+    """Estado de un lote con los resultados de cada elemento"""
+    try:
+        lote = Lote.query.get_or_404(lote_id)
+        return jsonify(lote.to_dict(incluir_elementos=True))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@lotes_bp.route('/lotes/estado', methods=['GET'])
+def estado_lotes():
+    """Estadísticas de la generación por lotes"""
+    try:
+        return jsonify({
+            'lotes': gestor_lotes.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def generador_lote(lote):
+    """Función que genera la respuesta de un prompt del lote"""
+    parametros = lote.leer_parametros()
+    if lote.agente_id:
+        agente = db.session.get(Agente, lote.agente_id)
+        if agente is None:
+            raise ValueError('Agente no encontrado')
+        generar = partial(generar_respuesta_agente, agente=copiar_agente(agente), usar_cache=parametros.get('cache'))
+        return limitar(generar, plazo_agente(agente))
+    return partial(
+        _generar_modelo, modelo=lote.modelo, prompt_sistema=parametros.get('prompt_sistema'),
+        temperatura=parametros.get('temperatura'), max_tokens=parametros.get('max_tokens'),
+        usar_cache=parametros.get('cache')
+    )
+
+def _generar_modelo(prompt, modelo, prompt_sistema, temperatura, max_tokens, usar_cache):
+    respuesta, _ = generar_con_cache(modelo, prompt, prompt_sistema, temperatura, max_tokens, usar_cache)
+    return respuesta
+
+def stream_lote(lote, reanudar=False, reintentar_errores=False):
+    """Respuesta NDJSON con los eventos de un lote reclamado"""
+    try:
+        concurrencia = concurrencia_lote(lote.modelo, lote.leer_parametros().get('concurrencia'))
+        generar = generador_lote(lote)
+    except Exception:
+        # No se llegó a generar: soltar el lote para poder reanudarlo
+        db.session.rollback()
+        gestor_lotes.cerrar(lote)
+        raise
+    eventos = gestor_lotes.ejecutar(
+        lote, generar, concurrencia, partial(formatear_evento, 'ndjson'),
+        reanudar=reanudar, reintentar_errores=reintentar_errores
+    )
+    respuesta = respuesta_stream(eventos, 'ndjson')
+    respuesta.headers['X-Lote-Id'] = str(lote.id)
+    return respuesta
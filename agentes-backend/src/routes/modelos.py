@@ -2,37 +2,134 @@ from flask import Blueprint, request, jsonify
 import requests
 import os
 import json
+import threading
+import time
 from datetime import datetime
+from urllib.parse import urlsplit
+from src.services import proveedores
+from src.services.coalescencia import vuelos
+from src.services.circuito import circuitos
+from src.services.catalogo import catalogo
+from src.services.monitor import monitor_servicios
+from src.services.descargas import gestor_descargas
+from src.services.residencia import residencia_ollama
+from src.services.sesiones import sesiones_ollama
+from src.services.concurrencia import completar_con_plazo, enviar
+from src.services.streaming import solicita_stream, formato_stream, formatear_evento, respuesta_stream, respuesta_sse, evento_sse
+from src.services.admision import control_admision, SaturacionProveedor, respuesta_saturacion
+from src.services.proveedores import PlazoAgotado
+from src.services.plazos import respuesta_plazo_agotado
+from src.services.limites import limites_api, estimar_tokens_peticion
+from src.services.nodos import pool_nodos
+from src.services.cache_respuestas import cache_respuestas, clave_solicitud, cache_aplica, preferencia_cache
 
 modelos_bp = Blueprint('modelos', __name__)
 
+# Detección de modelos: todos los servicios se sondean en paralelo con
+# timeouts cortos y un plazo global; el último resultado queda guardado
+# como instantánea para responder al momento con ?cache=1.
+DETECCION_TIMEOUT = (
+    float(os.getenv('DETECCION_TIMEOUT_CONEXION', '1')),
+    float(os.getenv('DETECCION_TIMEOUT_LECTURA', '5'))
+)
+DETECCION_PLAZO = float(os.getenv('DETECCION_PLAZO', '8'))
+DETECCION_INTENTOS_OLLAMA = int(os.getenv('DETECCION_INTENTOS_OLLAMA', '1'))
+DETECCION_INSTANTANEA_TTL = float(os.getenv('DETECCION_INSTANTANEA_TTL', '60'))
+
+_instantanea_deteccion = {'servicios': {}, 'actualizado': None}
+_lock_deteccion = threading.Lock()
+
+def detectores_servicios():
+    return {
+        'ollama': detectar_ollama,
+        'lmstudio': detectar_lmstudio,
+        'localai': detectar_localai,
+        'openai': detectar_openai,
+        'anthropic': detectar_anthropic,
+        'google': detectar_google
+    }
+
+def _resultado_deteccion(resultado):
+    """Convertir el resultado de una tarea en la entrada de un servicio"""
+    if resultado['estado'] == 'ok':
+        return resultado['resultado']
+    if resultado['estado'] == 'timeout':
+        return {'conectado': False, 'modelos': [], 'timeout': True,
+                'estado': f'Sin respuesta en {DETECCION_PLAZO:.0f} s'}
+    return {'conectado': False, 'modelos': [], 'error': resultado['error']}
+
+def detectar_servicios(plazo=None):
+    """Sondear todos los servicios en paralelo; produce (servicio, resultado) según terminan"""
+    tareas = [(servicio, detector, ()) for servicio, detector in detectores_servicios().items()]
+    for servicio, resultado in completar_con_plazo(tareas, DETECCION_PLAZO if plazo is None else plazo):
+        entrada = _resultado_deteccion(resultado)
+        entrada['duracionMs'] = resultado['duracionMs']
+        with _lock_deteccion:
+            _instantanea_deteccion['servicios'][servicio] = entrada
+            _instantanea_deteccion['actualizado'] = time.time()
+        yield servicio, entrada
+
+def detectar_todos():
+    """Detección completa (las peticiones simultáneas comparten un único sondeo)"""
+    return vuelos.ejecutar('detectar-modelos', lambda: dict(detectar_servicios()))
+
+def instantanea_deteccion():
+    """Última detección guardada y su antigüedad en segundos (None si no hay)"""
+    with _lock_deteccion:
+        actualizado = _instantanea_deteccion['actualizado']
+        servicios = dict(_instantanea_deteccion['servicios'])
+    return servicios, (time.time() - actualizado) if actualizado else None
+
 @modelos_bp.route('/modelos/detectar', methods=['GET'])
 def detectar_modelos():
     """Detectar todos los modelos disponibles localmente y remotamente"""
     try:
-        modelos = {
-            'ollama': detectar_ollama(),
-            'lmstudio': detectar_lmstudio(),
-            'localai': detectar_localai(),
-            'openai': detectar_openai(),
-            'anthropic': detectar_anthropic(),
-            'google': detectar_google()
-        }
-        
-        return jsonify(modelos)
+        if request.args.get('cache') or request.args.get('instantanea'):
+            servicios, edad = instantanea_deteccion()
+            if edad is None or len(servicios) < len(detectores_servicios()):
+                servicios, edad = detectar_todos(), 0
+            elif edad > DETECCION_INSTANTANEA_TTL:
+                # Responder con la instantánea y refrescarla en segundo plano
+                enviar(detectar_todos)
+            respuesta = jsonify(servicios)
+            respuesta.headers['X-Deteccion-Edad'] = str(round(edad, 1))
+            return respuesta
+        
+        if solicita_stream():
+            formato = formato_stream()
+            return respuesta_stream(stream_deteccion(formato), formato)
+        
+        return jsonify(detectar_todos())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def stream_deteccion(formato):
+    """Enviar el resultado de cada servicio en cuanto termina su sondeo"""
+    inicio = time.monotonic()
+    sin_respuesta = []
+    for servicio, resultado in detectar_servicios():
+        if resultado.get('timeout'):
+            sin_respuesta.append(servicio)
+        yield formatear_evento(formato, 'servicio', {'servicio': servicio, 'resultado': resultado})
+    yield formatear_evento(formato, 'fin', {
+        'sinRespuesta': sin_respuesta,
+        'duracionMs': round((time.monotonic() - inicio) * 1000, 1)
+    })
+
+def puerto_proveedor(proveedor):
+    """Puerto de la URL base configurada del proveedor"""
+    return urlsplit(proveedores.url_base(proveedor)).port
+
 def detectar_ollama():
     """Detectar modelos de Ollama con diagnóstico mejorado"""
     try:
         print("🔍 Iniciando detección de Ollama...")
         
         # Intentar conectar a Ollama con múltiples intentos
-        for intento in range(3):
+        for intento in range(DETECCION_INTENTOS_OLLAMA):
             try:
-                print(f"📡 Intento {intento + 1}/3 conectando a Ollama...")
-                response = requests.get('http://localhost:11434/api/tags', timeout=15)
+                print(f"📡 Intento {intento + 1}/{DETECCION_INTENTOS_OLLAMA} conectando a Ollama...")
+                response = proveedores.get('ollama', '/api/tags', timeout=DETECCION_TIMEOUT)
                 
                 if response.status_code == 200:
                     print("✅ Conexión exitosa con Ollama")
@@ -91,7 +188,8 @@ def detectar_ollama():
                     return {
                         'conectado': True,
                         'modelos': modelos,
-                        'puerto': 11434,
+                        'puerto': puerto_proveedor('ollama'),
+                        'nodos': proveedores.urls_proveedor('ollama'),
                         'total_modelos': len(modelos),
                         'estado': 'Conectado y funcionando',
                         'version_api': data.get('version', 'unknown'),
@@ -103,21 +201,18 @@ def detectar_ollama():
                     
             except requests.exceptions.ConnectionError as e:
                 print(f"❌ Error de conexión (intento {intento + 1}): {e}")
-                if intento < 2:  # Si no es el último intento
-                    import time
-                    time.sleep(2)  # Esperar 2 segundos antes del siguiente intento
+                if intento < DETECCION_INTENTOS_OLLAMA - 1:  # Si no es el último intento
+                    time.sleep(1)  # Esperar antes del siguiente intento
                     
             except requests.exceptions.Timeout as e:
                 print(f"⏱️ Timeout (intento {intento + 1}): {e}")
-                if intento < 2:
-                    import time
-                    time.sleep(2)
+                if intento < DETECCION_INTENTOS_OLLAMA - 1:
+                    time.sleep(1)
                     
             except Exception as e:
                 print(f"❌ Error inesperado (intento {intento + 1}): {e}")
-                if intento < 2:
-                    import time
-                    time.sleep(2)
+                if intento < DETECCION_INTENTOS_OLLAMA - 1:
+                    time.sleep(1)
         
         # Si llegamos aquí, todos los intentos fallaron
         print("❌ Todos los intentos de conexión fallaron")
@@ -128,11 +223,11 @@ def detectar_ollama():
         return {
             'conectado': False,
             'modelos': [],
-            'puerto': 11434,
+            'puerto': puerto_proveedor('ollama'),
             'total_modelos': 0,
             'estado': 'No disponible - Verificar que Ollama esté ejecutándose',
             'proceso_activo': proceso_activo,
-            'diagnostico': 'Ollama no responde en puerto 11434'
+            'diagnostico': f"Ollama no responde en {', '.join(proveedores.urls_proveedor('ollama'))}"
         }
         
     except Exception as e:
@@ -140,7 +235,7 @@ def detectar_ollama():
         return {
             'conectado': False,
             'modelos': [],
-            'puerto': 11434,
+            'puerto': puerto_proveedor('ollama'),
             'total_modelos': 0,
             'estado': f'Error crítico: {str(e)}',
             'error_detallado': str(e)
@@ -193,16 +288,15 @@ def verificar_proceso_ollama_detallado():
                     'sugerencia': 'Instalar Ollama desde https://ollama.ai'
                 }
         else:
-            # Linux/Mac
-            result = subprocess.run(['pgrep', '-f', 'ollama'], 
-                                  capture_output=True, text=True)
+            # Linux/Mac: procesos según la última revisión del monitor
+            pids = monitor_servicios.pids('ollama')
             
-            if result.returncode == 0:
+            if pids:
                 print("✅ Proceso ollama encontrado")
                 return {
                     'ejecutandose': True,
-                    'metodo': 'pgrep',
-                    'pid': result.stdout.strip()
+                    'metodo': 'monitor',
+                    'pid': '\n'.join(str(pid) for pid in pids)
                 }
             else:
                 print("❌ Proceso ollama NO encontrado")
@@ -221,7 +315,7 @@ def verificar_proceso_ollama_detallado():
 def detectar_lmstudio():
     """Detectar modelos de LM Studio"""
     try:
-        response = requests.get('http://localhost:1234/v1/models', timeout=5)
+        response = proveedores.get('lmstudio', '/v1/models', timeout=DETECCION_TIMEOUT)
         if response.status_code == 200:
             data = response.json()
             modelos = []
@@ -236,7 +330,7 @@ def detectar_lmstudio():
             return {
                 'conectado': True,
                 'modelos': modelos,
-                'puerto': 1234
+                'puerto': puerto_proveedor('lmstudio')
             }
     except Exception as e:
         print(f"Error detectando LM Studio: {e}")
@@ -244,13 +338,13 @@ def detectar_lmstudio():
     return {
         'conectado': False,
         'modelos': [],
-        'puerto': 1234
+        'puerto': puerto_proveedor('lmstudio')
     }
 
 def detectar_localai():
     """Detectar modelos de LocalAI"""
     try:
-        response = requests.get('http://localhost:8080/v1/models', timeout=5)
+        response = proveedores.get('localai', '/v1/models', timeout=DETECCION_TIMEOUT)
         if response.status_code == 200:
             data = response.json()
             modelos = []
@@ -265,7 +359,7 @@ def detectar_localai():
             return {
                 'conectado': True,
                 'modelos': modelos,
-                'puerto': 8080
+                'puerto': puerto_proveedor('localai')
             }
     except Exception as e:
         print(f"Error detectando LocalAI: {e}")
@@ -273,7 +367,7 @@ def detectar_localai():
     return {
         'conectado': False,
         'modelos': [],
-        'puerto': 8080
+        'puerto': puerto_proveedor('localai')
     }
 
 def detectar_openai():
@@ -287,9 +381,9 @@ def detectar_openai():
         }
     
     try:
-        response = requests.get('https://api.openai.com/v1/models',
+        response = proveedores.get('openai', '/models',
             headers={'Authorization': f'Bearer {api_key}'},
-            timeout=10
+            timeout=DETECCION_TIMEOUT
         )
         
         if response.status_code == 200:
@@ -386,7 +480,7 @@ def detectar_google():
 
 @modelos_bp.route('/modelos/ollama/descargar', methods=['POST'])
 def descargar_modelo_ollama():
-    """Descargar un modelo en Ollama"""
+    """Descargar un modelo en Ollama (como trabajo en segundo plano)"""
     try:
         data = request.get_json()
         nombre_modelo = data.get('modelo')
@@ -395,21 +489,94 @@ def descargar_modelo_ollama():
             return jsonify({'error': 'Nombre de modelo requerido'}), 400
         
         # Verificar que Ollama esté disponible
-        try:
-            requests.get('http://localhost:11434/api/tags', timeout=5)
-        except:
+        if not catalogo.disponible('ollama'):
             return jsonify({'error': 'Ollama no está disponible'}), 503
         
-        # Iniciar descarga
-        response = requests.post('http://localhost:11434/api/pull',
-            json={'name': nombre_modelo},
-            timeout=300  # 5 minutos timeout
-        )
+        trabajo, nuevo = gestor_descargas.iniciar(nombre_modelo)
         
-        if response.status_code == 200:
-            return jsonify({'mensaje': f'Modelo {nombre_modelo} descargado exitosamente'})
-        else:
-            return jsonify({'error': f'Error descargando modelo: {response.text}'}), 500
+        # Compatibilidad: esperar a que termine si el cliente lo pide
+        if data.get('esperar'):
+            trabajo.esperar(data.get('timeout', 300))
+            estado = trabajo.to_dict()
+            if estado['estado'] == 'completado':
+                return jsonify({'mensaje': f'Modelo {nombre_modelo} descargado exitosamente', 'trabajo': estado})
+            if estado['estado'] in ('error', 'cancelado'):
+                return jsonify({'error': f"Error descargando modelo: {estado['error'] or estado['estado']}", 'trabajo': estado}), 500
+        
+        respuesta = jsonify({
+            'mensaje': f'Descarga de {nombre_modelo} ' + ('iniciada' if nuevo else 'ya en curso'),
+            'trabajo': trabajo.to_dict()
+        })
+        respuesta.headers['Location'] = f'/api/modelos/ollama/descargas/{trabajo.id}'
+        return respuesta, 202
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/ollama/residentes', methods=['GET'])
+def obtener_residentes_ollama():
+    """Obtener los modelos cargados en memoria y el presupuesto de memoria"""
+    try:
+        return jsonify({
+            'residencia': residencia_ollama.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/ollama/sesiones', methods=['GET'])
+def obtener_sesiones_ollama():
+    """Obtener estadísticas del contexto de conversación reutilizado"""
+    try:
+        return jsonify({
+            'sesiones': sesiones_ollama.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/ollama/descargas', methods=['GET'])
+def obtener_descargas():
+    """Listar los trabajos de descarga recientes"""
+    try:
+        return jsonify({'descargas': gestor_descargas.listar()})
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/ollama/descargas/<trabajo_id>', methods=['GET'])
+def obtener_descarga(trabajo_id):
+    """Consultar el progreso de una descarga (o seguirlo por SSE)"""
+    try:
+        trabajo = gestor_descargas.obtener(trabajo_id)
+        if trabajo is None:
+            return jsonify({'error': 'Descarga no encontrada'}), 404
+        
+        if solicita_stream():
+            return respuesta_sse(stream_descarga(trabajo))
+        
+        return jsonify(trabajo.to_dict())
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def stream_descarga(trabajo):
+    """Eventos SSE de progreso de una descarga hasta que termina"""
+    for estado in trabajo.seguir():
+        evento = 'fin' if estado['estado'] in ('completado', 'error', 'cancelado') else 'progreso'
+        yield evento_sse(evento, estado)
+
+@modelos_bp.route('/modelos/ollama/descargas/<trabajo_id>', methods=['DELETE'])
+def cancelar_descarga(trabajo_id):
+    """Cancelar una descarga en curso"""
+    try:
+        trabajo = gestor_descargas.cancelar(trabajo_id)
+        if trabajo is None:
+            return jsonify({'error': 'Descarga no encontrada'}), 404
+        
+        return jsonify({'mensaje': f'Cancelación de {trabajo.modelo} solicitada', 'trabajo': trabajo.to_dict()})
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -424,10 +591,11 @@ def eliminar_modelo_ollama():
         if not nombre_modelo:
             return jsonify({'error': 'Nombre de modelo requerido'}), 400
         
-        response = requests.delete('http://localhost:11434/api/delete',
+        response = proveedores.delete('ollama', '/api/delete',
             json={'name': nombre_modelo},
             timeout=30
         )
+        catalogo.invalidar('ollama')
         
         if response.status_code == 200:
             return jsonify({'mensaje': f'Modelo {nombre_modelo} eliminado exitosamente'})
@@ -451,62 +619,98 @@ def generar_respuesta_modelo():
         if not modelo_id or not mensaje:
             return jsonify({'error': 'Modelo y mensaje son requeridos'}), 400
         
-        respuesta = None
-        
-        # Determinar el servicio del modelo
-        if modelo_id.startswith('ollama:'):
-            nombre_modelo = modelo_id.replace('ollama:', '')
-            respuesta = generar_respuesta_ollama(nombre_modelo, mensaje, prompt_sistema, temperatura, max_tokens)
-        
-        elif modelo_id.startswith('lmstudio:'):
-            nombre_modelo = modelo_id.replace('lmstudio:', '')
-            respuesta = generar_respuesta_lmstudio(nombre_modelo, mensaje, prompt_sistema, temperatura, max_tokens)
-        
-        elif modelo_id.startswith('gpt-'):
-            respuesta = generar_respuesta_openai(modelo_id, mensaje, prompt_sistema, temperatura, max_tokens)
-        
-        elif modelo_id.startswith('claude-'):
-            respuesta = generar_respuesta_anthropic(modelo_id, mensaje, prompt_sistema, temperatura, max_tokens)
-        
-        elif modelo_id.startswith('gemini-'):
-            respuesta = generar_respuesta_google(modelo_id, mensaje, prompt_sistema, temperatura, max_tokens)
-        
-        else:
+        if not generador_para_modelo(modelo_id):
             return jsonify({'error': f'Modelo no soportado: {modelo_id}'}), 400
         
+        respuesta, desde_cache = generar_con_cache(
+            modelo_id, mensaje, prompt_sistema, temperatura, max_tokens, preferencia_cache(data)
+        )
+        
         if respuesta:
             return jsonify({
                 'modelo': modelo_id,
                 'mensaje': mensaje,
                 'respuesta': respuesta,
                 'timestamp': datetime.utcnow().isoformat(),
-                'exito': True
+                'exito': True,
+                'cache': desde_cache
             })
         else:
             return jsonify({'error': 'No se pudo generar respuesta'}), 500
     
+    except SaturacionProveedor as e:
+        return respuesta_saturacion(e)
+    except PlazoAgotado as e:
+        return respuesta_plazo_agotado(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def generar_con_cache(modelo_id, mensaje, prompt_sistema, temperatura, max_tokens, usar_cache=None):
+    """Generar con caché y coalescencia; devuelve (respuesta o None, desde_cache)"""
+    # Consultar la caché si la petición es determinista o se pidió explícitamente
+    clave = None
+    if cache_aplica(temperatura, False, usar_cache):
+        clave = clave_solicitud(modelo_id, prompt_sistema, mensaje, temperatura, max_tokens)
+        respuesta = cache_respuestas.obtener(clave)
+        if respuesta is not None:
+            return respuesta, True
+    elif usar_cache is False:
+        cache_respuestas.registrar_omitido()
+    
+    # Peticiones idénticas simultáneas comparten una sola generación
+    clave_vuelo = None
+    if usar_cache is not False:
+        clave_vuelo = clave or clave_solicitud(modelo_id, prompt_sistema, mensaje, temperatura, max_tokens)
+    respuesta = vuelos.ejecutar(
+        clave_vuelo, generar_con_modelo, modelo_id, mensaje, prompt_sistema, temperatura, max_tokens,
+        proveedor=proveedores.proveedor_de_modelo(modelo_id)
+    )
+    if respuesta and clave is not None:
+        cache_respuestas.guardar(clave, respuesta)
+    return respuesta, False
+
+def generador_para_modelo(modelo_id):
+    """Función de generación y nombre de modelo según el prefijo del ID"""
+    if modelo_id.startswith('ollama:'):
+        return generar_respuesta_ollama, modelo_id.replace('ollama:', '')
+    elif modelo_id.startswith('lmstudio:'):
+        return generar_respuesta_lmstudio, modelo_id.replace('lmstudio:', '')
+    elif modelo_id.startswith('gpt-'):
+        return generar_respuesta_openai, modelo_id
+    elif modelo_id.startswith('claude-'):
+        return generar_respuesta_anthropic, modelo_id
+    elif modelo_id.startswith('gemini-'):
+        return generar_respuesta_google, modelo_id
+    return None
+
+def generar_con_modelo(modelo_id, mensaje, prompt_sistema, temperatura, max_tokens):
+    """Generar una respuesta con el modelo indicado; devuelve None si falla"""
+    funcion, nombre_modelo = generador_para_modelo(modelo_id)
+    with control_admision.admitir(modelo_id):
+        return funcion(nombre_modelo, mensaje, prompt_sistema, temperatura, max_tokens)
+
 def generar_respuesta_ollama(modelo, mensaje, prompt_sistema, temperatura, max_tokens):
     """Generar respuesta usando Ollama"""
     try:
-        payload = {
-            'model': modelo,
-            'prompt': f"{prompt_sistema}\n\nUsuario: {mensaje}\nAsistente:",
-            'stream': False,
-            'options': {
-                'temperature': temperatura,
-                'num_predict': max_tokens
+        with residencia_ollama.usar(modelo) as uso:
+            payload = {
+                'model': modelo,
+                'prompt': f"{prompt_sistema}\n\nUsuario: {mensaje}\nAsistente:",
+                'stream': False,
+                'keep_alive': uso.keep_alive,
+                'options': {
+                    'temperature': temperatura,
+                    'num_predict': max_tokens
+                }
             }
-        }
-        
-        response = requests.post('http://localhost:11434/api/generate', 
-                               json=payload, timeout=60)
+            
+            response = proveedores.post('ollama', uso.url('/api/generate'), json=payload)
         
         if response.status_code == 200:
             data = response.json()
             return data.get('response', '').strip()
+    except (SaturacionProveedor, PlazoAgotado):
+        raise
     except Exception as e:
         print(f"Error generando respuesta con Ollama: {e}")
     
@@ -525,12 +729,13 @@ def generar_respuesta_lmstudio(modelo, mensaje, prompt_sistema, temperatura, max
             'max_tokens': max_tokens
         }
         
-        response = requests.post('http://localhost:1234/v1/chat/completions',
-                               json=payload, timeout=60)
+        response = proveedores.post('lmstudio', '/v1/chat/completions', json=payload)
         
         if response.status_code == 200:
             data = response.json()
             return data['choices'][0]['message']['content'].strip()
+    except (SaturacionProveedor, PlazoAgotado):
+        raise
     except Exception as e:
         print(f"Error generando respuesta con LM Studio: {e}")
     
@@ -558,12 +763,15 @@ def generar_respuesta_openai(modelo, mensaje, prompt_sistema, temperatura, max_t
             'Content-Type': 'application/json'
         }
         
-        response = requests.post('https://api.openai.com/v1/chat/completions',
-                               json=payload, headers=headers, timeout=60)
+        response = limites_api.post('openai', '/chat/completions',
+                                    estimar_tokens_peticion(prompt_sistema, mensaje, max_tokens=max_tokens),
+                                    json=payload, headers=headers)
         
         if response.status_code == 200:
             data = response.json()
             return data['choices'][0]['message']['content'].strip()
+    except (SaturacionProveedor, PlazoAgotado):
+        raise
     except Exception as e:
         print(f"Error generando respuesta con OpenAI: {e}")
     
@@ -592,12 +800,15 @@ def generar_respuesta_anthropic(modelo, mensaje, prompt_sistema, temperatura, ma
             'anthropic-version': '2023-06-01'
         }
         
-        response = requests.post('https://api.anthropic.com/v1/messages',
-                               json=payload, headers=headers, timeout=60)
+        response = limites_api.post('anthropic', '/v1/messages',
+                                    estimar_tokens_peticion(prompt_sistema, mensaje, max_tokens=max_tokens),
+                                    json=payload, headers=headers)
         
         if response.status_code == 200:
             data = response.json()
             return data['content'][0]['text'].strip()
+    except (SaturacionProveedor, PlazoAgotado):
+        raise
     except Exception as e:
         print(f"Error generando respuesta con Anthropic: {e}")
     
@@ -617,6 +828,8 @@ def generar_respuesta_google(modelo, mensaje, prompt_sistema, temperatura, max_t
         # Aquí iría la implementación real de Google AI
         # Por ahora retornamos un placeholder
         return f"[Respuesta de {modelo}] Esta funcionalidad requiere implementación específica de Google AI SDK."
+    except (SaturacionProveedor, PlazoAgotado):
+        raise
     except Exception as e:
         print(f"Error generando respuesta con Google AI: {e}")
     
@@ -680,7 +893,10 @@ def desactivar_modelo():
         resultado = None
         
         if servicio == 'ollama' or modelo_id.startswith('ollama:'):
-            resultado = desactivar_modelo_ollama()
+            if data.get('detenerServicio'):
+                resultado = desactivar_modelo_ollama()
+            else:
+                resultado = descargar_memoria_ollama(modelo_id.replace('ollama:', ''))
         
         elif servicio == 'lmstudio' or modelo_id.startswith('lmstudio:'):
             resultado = desactivar_lmstudio()
@@ -716,25 +932,17 @@ def activar_modelo_ollama(nombre_modelo):
         import platform
         
         # Verificar si Ollama está ejecutándose
-        try:
-            response = requests.get('http://localhost:11434/api/tags', timeout=5)
-            if response.status_code != 200:
-                # Intentar iniciar Ollama
-                resultado_inicio = iniciar_ollama()
-                if not resultado_inicio['exito']:
-                    return resultado_inicio
-        except:
+        modelos_disponibles = catalogo.modelos('ollama')
+        if modelos_disponibles is None:
             # Ollama no está ejecutándose, intentar iniciarlo
             resultado_inicio = iniciar_ollama()
             if not resultado_inicio['exito']:
                 return resultado_inicio
+            catalogo.invalidar('ollama')
+            modelos_disponibles = catalogo.modelos('ollama')
         
         # Verificar si el modelo existe
-        response = requests.get('http://localhost:11434/api/tags', timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            modelos_disponibles = [m['name'] for m in data.get('models', [])]
-            
+        if modelos_disponibles is not None:
             if nombre_modelo not in modelos_disponibles:
                 # El modelo no existe, intentar descargarlo
                 print(f"📥 Descargando modelo {nombre_modelo}...")
@@ -742,16 +950,8 @@ def activar_modelo_ollama(nombre_modelo):
                 if not resultado_descarga['exito']:
                     return resultado_descarga
         
-        # Cargar el modelo en memoria (hacer una consulta simple)
-        payload = {
-            'model': nombre_modelo,
-            'prompt': 'Hola',
-            'stream': False,
-            'options': {'num_predict': 1}
-        }
-        
-        response = requests.post('http://localhost:11434/api/generate', 
-                               json=payload, timeout=30)
+        # Cargar el modelo en memoria (sin generar; puede desalojar otros por presupuesto)
+        response = residencia_ollama.cargar(nombre_modelo)
         
         if response.status_code == 200:
             return {
@@ -773,6 +973,28 @@ def activar_modelo_ollama(nombre_modelo):
             'error': str(e)
         }
 
+def descargar_memoria_ollama(nombre_modelo):
+    """Sacar un modelo de la memoria de Ollama sin detener el servidor"""
+    try:
+        response = residencia_ollama.descargar(nombre_modelo)
+        if response.status_code == 200:
+            return {
+                'exito': True,
+                'mensaje': f'Modelo {nombre_modelo} descargado de memoria',
+                'metodo': 'keep_alive'
+            }
+        return {
+            'exito': False,
+            'error': f'Error descargando modelo de memoria: {response.text}',
+            'codigo': response.status_code
+        }
+    
+    except Exception as e:
+        return {
+            'exito': False,
+            'error': str(e)
+        }
+
 def desactivar_modelo_ollama():
     """Desactivar Ollama (liberar memoria)"""
     try:
@@ -859,7 +1081,7 @@ def iniciar_ollama():
         # Esperar a que inicie
         for i in range(10):  # Esperar hasta 10 segundos
             try:
-                response = requests.get('http://localhost:11434/api/tags', timeout=2)
+                response = proveedores.get('ollama', '/api/tags', timeout=2)
                 if response.status_code == 200:
                     return {
                         'exito': True,
@@ -881,41 +1103,30 @@ def iniciar_ollama():
         }
 
 def descargar_modelo_ollama_interno(nombre_modelo):
-    """Descargar un modelo en Ollama internamente"""
+    """Descargar un modelo en Ollama internamente (esperando al trabajo compartido)"""
     try:
         print(f"📥 Iniciando descarga de {nombre_modelo}...")
         
-        response = requests.post('http://localhost:11434/api/pull',
-            json={'name': nombre_modelo},
-            timeout=600,  # 10 minutos timeout para descarga
-            stream=True
-        )
-        
-        if response.status_code == 200:
-            # Procesar respuesta streaming
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        data = json.loads(line)
-                        if 'status' in data:
-                            print(f"📥 {data['status']}")
-                        if data.get('status') == 'success':
-                            return {
-                                'exito': True,
-                                'mensaje': f'Modelo {nombre_modelo} descargado exitosamente'
-                            }
-                    except:
-                        continue
-            
+        trabajo, _ = gestor_descargas.iniciar(nombre_modelo)
+        if not trabajo.esperar(600):  # 10 minutos para la descarga
             return {
-                'exito': True,
-                'mensaje': f'Descarga de {nombre_modelo} completada'
+                'exito': False,
+                'error': f'La descarga de {nombre_modelo} sigue en curso',
+                'trabajo': trabajo.id
             }
-        else:
+        
+        estado = trabajo.to_dict()
+        if estado['estado'] == 'completado':
             return {
-                'exito': False,
-                'error': f'Error descargando: {response.text}'
+                'exito': True,
+                'mensaje': f'Modelo {nombre_modelo} descargado exitosamente',
+                'trabajo': trabajo.id
             }
+        return {
+            'exito': False,
+            'error': f"Error descargando: {estado['error'] or estado['estado']}",
+            'trabajo': trabajo.id
+        }
     
     except Exception as e:
         return {
@@ -1045,111 +1256,31 @@ def desactivar_localai():
 
 @modelos_bp.route('/modelos/estado-servicios', methods=['GET'])
 def obtener_estado_servicios():
-    """Obtener estado real de todos los servicios"""
+    """Obtener estado real de todos los servicios (desde el monitor en segundo plano)"""
     try:
-        import subprocess
         import platform
         
-        sistema = platform.system().lower()
-        estados = {}
-        
-        # Verificar Ollama
-        try:
-            response = requests.get('http://localhost:11434/api/tags', timeout=3)
-            estados['ollama'] = {
-                'activo': response.status_code == 200,
-                'puerto': 11434,
-                'proceso': verificar_proceso_ollama(sistema)
-            }
-        except:
-            estados['ollama'] = {
-                'activo': False,
-                'puerto': 11434,
-                'proceso': verificar_proceso_ollama(sistema)
-            }
-        
-        # Verificar LM Studio
-        try:
-            response = requests.get('http://localhost:1234/v1/models', timeout=3)
-            estados['lmstudio'] = {
-                'activo': response.status_code == 200,
-                'puerto': 1234,
-                'proceso': verificar_proceso_lmstudio(sistema)
-            }
-        except:
-            estados['lmstudio'] = {
-                'activo': False,
-                'puerto': 1234,
-                'proceso': verificar_proceso_lmstudio(sistema)
-            }
+        instantanea = monitor_servicios.instantanea()
+        estados = instantanea['servicios']
         
-        # Verificar LocalAI
-        try:
-            response = requests.get('http://localhost:8080/v1/models', timeout=3)
-            estados['localai'] = {
-                'activo': response.status_code == 200,
-                'puerto': 8080,
-                'proceso': verificar_proceso_localai()
-            }
-        except:
-            estados['localai'] = {
-                'activo': False,
-                'puerto': 8080,
-                'proceso': verificar_proceso_localai()
-            }
+        # Estado del circuit breaker de cada endpoint
+        for servicio, estado in estados.items():
+            estado['circuito'] = circuitos.estado(proveedores.url_base(servicio))
+            for nodo in estado['nodos']:
+                nodo['circuito'] = circuitos.estado(nodo['url'])
         
         return jsonify({
             'servicios': estados,
-            'timestamp': datetime.utcnow().isoformat(),
-            'sistema': sistema
+            'circuitos': circuitos.todos(),
+            'timestamp': datetime.utcfromtimestamp(instantanea['actualizado']).isoformat(),
+            'edadSegundos': instantanea['edadSegundos'],
+            'intervaloSegundos': instantanea['intervalo'],
+            'sistema': platform.system().lower()
         })
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def verificar_proceso_ollama(sistema):
-    """Verificar si el proceso Ollama está ejecutándose"""
-    try:
-        import subprocess
-        
-        if sistema == 'windows':
-            result = subprocess.run(['tasklist', '/FI', 'IMAGENAME eq ollama.exe'], 
-                                  capture_output=True, text=True)
-            return 'ollama.exe' in result.stdout
-        else:
-            result = subprocess.run(['pgrep', '-f', 'ollama'], 
-                                  capture_output=True, text=True)
-            return result.returncode == 0
-    except:
-        return False
-
-def verificar_proceso_lmstudio(sistema):
-    """Verificar si LM Studio está ejecutándose"""
-    try:
-        import subprocess
-        
-        if sistema == 'windows':
-            result = subprocess.run(['tasklist', '/FI', 'IMAGENAME eq LM Studio.exe'], 
-                                  capture_output=True, text=True)
-            return 'LM Studio.exe' in result.stdout
-        else:
-            result = subprocess.run(['pgrep', '-f', 'lm.studio'], 
-                                  capture_output=True, text=True)
-            return result.returncode == 0
-    except:
-        return False
-
-def verificar_proceso_localai():
-    """Verificar si LocalAI está ejecutándose"""
-    try:
-        import subprocess
-        
-        result = subprocess.run(['docker', 'ps', '--filter', 'name=localai'], 
-                              capture_output=True, text=True)
-        return 'localai' in result.stdout
-    except:
-        return False
-
 @modelos_bp.route('/modelos/buscar-web', methods=['POST'])
 def buscar_en_web():
     """Buscar información en internet"""
@@ -1201,6 +1332,8 @@ def buscar_en_web():
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/probar', methods=['POST'])
 def probar_modelo():
     """Probar un modelo con un mensaje simple"""
     try:
@@ -1223,7 +1356,7 @@ def probar_modelo():
         
         # Importar función de generación
         from src.routes.agentes import generar_respuesta_ia
-        respuesta = generar_respuesta_ia(mensaje, agente_temp)
+        respuesta = generar_respuesta_ia(mensaje, agente_temp, preferencia_cache(data))
         
         return jsonify({
             'modelo': modelo_id,
@@ -1232,6 +1365,10 @@ def probar_modelo():
             'timestamp': datetime.utcnow().isoformat()
         })
     
+    except SaturacionProveedor as e:
+        return respuesta_saturacion(e)
+    except PlazoAgotado as e:
+        return respuesta_plazo_agotado(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1271,7 +1408,7 @@ def obtener_configuracion_modelos():
         configuracion = {
             'openai': {
                 'configurado': bool(os.getenv('OPENAI_API_KEY')),
-                'base_url': os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')
+                'base_url': proveedores.url_base('openai')
             },
             'anthropic': {
                 'configurado': bool(os.getenv('ANTHROPIC_API_KEY'))
@@ -1281,16 +1418,19 @@ def obtener_configuracion_modelos():
             },
             'servicios_locales': {
                 'ollama': {
-                    'puerto': 11434,
-                    'url': 'http://localhost:11434'
+                    'puerto': puerto_proveedor('ollama'),
+                    'url': proveedores.url_base('ollama'),
+                    'urls': proveedores.urls_proveedor('ollama')
                 },
                 'lmstudio': {
-                    'puerto': 1234,
-                    'url': 'http://localhost:1234'
+                    'puerto': puerto_proveedor('lmstudio'),
+                    'url': proveedores.url_base('lmstudio'),
+                    'urls': proveedores.urls_proveedor('lmstudio')
                 },
                 'localai': {
-                    'puerto': 8080,
-                    'url': 'http://localhost:8080'
+                    'puerto': puerto_proveedor('localai'),
+                    'url': proveedores.url_base('localai'),
+                    'urls': proveedores.urls_proveedor('localai')
                 }
             }
         }
@@ -1300,6 +1440,105 @@ def obtener_configuracion_modelos():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@modelos_bp.route('/modelos/pools', methods=['GET'])
+def obtener_estadisticas_pools():
+    """Obtener estadísticas de reutilización de conexiones por proveedor"""
+    try:
+        return jsonify({
+            'pools': proveedores.estadisticas_pools(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/cache', methods=['GET'])
+def obtener_estadisticas_cache():
+    """Obtener contadores de la caché de respuestas"""
+    try:
+        return jsonify({
+            'cache': cache_respuestas.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/coalescencia', methods=['GET'])
+def obtener_estadisticas_coalescencia():
+    """Obtener estadísticas de generaciones idénticas compartidas"""
+    try:
+        return jsonify({
+            'coalescencia': vuelos.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/admision', methods=['GET'])
+def obtener_estadisticas_admision():
+    """Obtener profundidad de colas y tiempos de espera por proveedor"""
+    try:
+        return jsonify({
+            'admision': control_admision.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/nodos', methods=['GET'])
+def obtener_estadisticas_nodos():
+    """Obtener carga, salud y afinidad de modelos de los nodos locales"""
+    try:
+        return jsonify({
+            'nodos': pool_nodos.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/limites', methods=['GET'])
+def obtener_estadisticas_limites():
+    """Obtener el estado de los límites RPM/TPM y el tiempo de espera por API key"""
+    try:
+        return jsonify({
+            'limites': limites_api.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/catalogo', methods=['GET'])
+def obtener_catalogo():
+    """Obtener el catálogo en memoria de modelos locales"""
+    try:
+        if request.args.get('refrescar'):
+            catalogo.invalidar()
+            for proveedor in ('ollama', 'lmstudio', 'localai'):
+                catalogo.refrescar(proveedor)
+        
+        return jsonify({
+            'catalogo': catalogo.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@modelos_bp.route('/modelos/cache', methods=['DELETE'])
+def limpiar_cache():
+    """Vaciar la caché de respuestas"""
+    try:
+        cache_respuestas.limpiar()
+        return jsonify({'mensaje': 'Caché de respuestas vaciada'})
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @modelos_bp.route('/modelos/configuracion', methods=['POST'])
 def actualizar_configuracion_modelos():
     """Actualizar configuración de APIs de modelos"""
@@ -1314,7 +1553,7 @@ def actualizar_configuracion_modelos():
         if 'openai_api_key' in data:
             # Validar API key de OpenAI
             try:
-                response = requests.get('https://api.openai.com/v1/models',
+                response = proveedores.get('openai', '/models',
                     headers={'Authorization': f'Bearer {data["openai_api_key"]}'},
                     timeout=10
                 )
@@ -1,11 +1,23 @@
 from flask import Blueprint, request, jsonify, send_file
 import json
 import os
+import time
 from datetime import datetime
 from werkzeug.utils import secure_filename
 from src.models.sala import db, Sala, Mensaje, Archivo, Armario, ConocimientoSala
 from src.models.agente import Agente
-from src.routes.agentes import generar_respuesta_ia
+from src.routes.agentes import generar_respuesta_ia, generar_respuesta_ia_stream
+from src.services.concurrencia import ejecutar_con_plazo, multiplexar_streams, copiar_agente, PLAZO_SALA_SEGUNDOS
+from src.services.proveedores import ErrorProveedor
+from src.services.cache_respuestas import preferencia_cache
+from src.services.sesiones import clave_sesion, sesiones_ollama
+from src.services.historial import HistorialSala, programar_resumen
+from src.services.respaldo import modelo_de
+from src.services.enrutado import enrutador_sala
+from src.services.admision import inquilino, como_inquilino, stream_como_inquilino
+from src.services.plazos import con_plazo, plazo_solicitado, plazo_agente, limitar
+from src.services.trabajos import cola_trabajos, solicita_asincrono
+from src.services.streaming import solicita_stream, formato_stream, formatear_evento, respuesta_stream
 
 salas_bp = Blueprint('salas', __name__)
 
@@ -91,6 +103,17 @@ def crear_sala():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@salas_bp.route('/salas/enrutado/estado', methods=['GET'])
+def estado_enrutado():
+    """Estadísticas del enrutado de mensajes a los agentes de las salas"""
+    try:
+        return jsonify({
+            'enrutado': enrutador_sala.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @salas_bp.route('/salas/<int:sala_id>/mensajes', methods=['POST'])
 def enviar_mensaje_sala(sala_id):
     """Enviar mensaje a una sala y obtener respuestas de agentes"""
@@ -103,6 +126,9 @@ def enviar_mensaje_sala(sala_id):
         if not mensaje_texto.strip():
             return jsonify({'error': 'Mensaje vacío'}), 400
         
+        # Historial previo de la sala (antes de añadir el mensaje nuevo)
+        historial = HistorialSala(sala.id)
+        
         # Guardar mensaje del usuario
         mensaje_usuario = Mensaje(
             sala_id=sala.id,
@@ -114,38 +140,85 @@ def enviar_mensaje_sala(sala_id):
         
         # Obtener agentes activos en la sala
         agentes_activos = json.loads(sala.agentes_activos) if sala.agentes_activos else []
-        respuestas = []
-        
+        agentes = []
         for agente_id in agentes_activos:
             agente = Agente.query.get(agente_id)
             if agente and agente.estado == 'activo':
-                # Generar respuesta del agente
-                respuesta = generar_respuesta_ia(mensaje_texto, agente)
-                
-                # Guardar mensaje del agente
-                mensaje_agente = Mensaje(
-                    sala_id=sala.id,
-                    agente_id=agente.id,
-                    tipo='agente',
-                    texto=respuesta,
-                    metadatos=json.dumps({
-                        'agente': agente.to_dict(),
-                        'modelo': agente.modelo
-                    })
-                )
-                db.session.add(mensaje_agente)
-                
-                # Actualizar contador de conversaciones
-                agente.conversaciones += 1
-                
-                respuestas.append({
-                    'agente': agente.to_dict(),
-                    'respuesta': respuesta,
-                    'mensaje': mensaje_agente.to_dict()
-                })
+                agentes.append(agente)
+        
+        configuracion = json.loads(sala.configuracion) if sala.configuracion else {}
+        plazo = float(configuracion.get('plazoRespuestaSegundos', PLAZO_SALA_SEGUNDOS))
+        if plazo_solicitado() is not None:
+            # El plazo de la petición (cabecera X-Plazo-Ms) acorta el de la sala
+            plazo = min(plazo, plazo_solicitado())
+        usar_cache = preferencia_cache(data)
+        
+        # Enrutado: solo responden los agentes relevantes para el mensaje
+        if data.get('enrutado', True) is not False:
+            agentes, decision = enrutador_sala.elegir(mensaje_texto, agentes, configuracion.get('enrutadoTopK'))
+            mensaje_usuario.metadatos = json.dumps({'usuario': usuario, 'enrutado': decision})
+        
+        # Mensaje de cada agente con el historial que cabe en su presupuesto
+        mensajes_agentes = {agente.id: mensaje_con_historial(historial, sala, agente, mensaje_texto) for agente in agentes}
+        if agentes and historial.necesita_resumen():
+            programar_resumen(sala.id, agentes[0].modelo)
+        
+        # Modo asíncrono: encolar un trabajo por agente y responder 202 sin esperar
+        if solicita_asincrono(data):
+            db.session.flush()
+            trabajos = [
+                cola_trabajos.encolar('sala', agente, mensaje_texto, mensajes_agentes[agente.id], usuario,
+                                      sala_id=sala.id, mensaje_id=mensaje_usuario.id,
+                                      sesion=clave_sesion(agente.id, sala.id), cache=usar_cache)
+                for agente in agentes
+            ]
+            db.session.commit()
+            cola_trabajos.avisar()
+            return jsonify({
+                'mensajeUsuario': mensaje_usuario.to_dict(),
+                'trabajos': [trabajo.to_dict() for trabajo in trabajos]
+            }), 202
+        
+        # Modo streaming: entrelazar los tokens de todos los agentes
+        if solicita_stream(data):
+            db.session.commit()
+            formato = formato_stream()
+            return respuesta_stream(
+                stream_mensaje_sala(sala, mensaje_usuario, agentes, mensajes_agentes, plazo, formato, usar_cache),
+                formato
+            )
+        
+        # Generar las respuestas de todos los agentes en paralelo con un plazo por sala
+        # (el plazo también limita las llamadas a los proveedores: los agentes que
+        # no llegan a tiempo dejan de generar en lugar de seguir en segundo plano)
+        with como_inquilino(inquilino(sala.id)), con_plazo(plazo):
+            resultados = ejecutar_con_plazo(
+                [(agente.id, limitar(generar_respuesta_ia, plazo_agente(agente)),
+                  (mensajes_agentes[agente.id], copiar_agente(agente), usar_cache, clave_sesion(agente.id, sala.id)))
+                 for agente in agentes],
+                plazo
+            )
+        
+        # Guardar las respuestas en el orden de la sala, no en el de llegada
+        respuestas = []
+        for agente in agentes:
+            resultado = resultados[agente.id]
+            mensaje_agente = guardar_respuesta_agente(
+                sala, agente, resultado['estado'], resultado['resultado'],
+                f"Error generando respuesta: {resultado['error']}", resultado['duracionMs']
+            )
+            
+            respuestas.append({
+                'agente': agente.to_dict(),
+                'respuesta': mensaje_agente.texto,
+                'mensaje': mensaje_agente
+            })
         
         db.session.commit()
         
+        for item in respuestas:
+            item['mensaje'] = item['mensaje'].to_dict()
+        
         return jsonify({
             'mensajeUsuario': mensaje_usuario.to_dict(),
             'respuestas': respuestas
@@ -155,6 +228,100 @@ def enviar_mensaje_sala(sala_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+def guardar_respuesta_agente(sala, agente, estado, texto, error=None, duracion_ms=None, modelo=None):
+    """Añadir a la sesión el mensaje de un agente según el resultado de su generación"""
+    modelo = modelo or modelo_de(texto, agente.modelo)
+    metadatos = {
+        'agente': agente.to_dict(),
+        'modelo': modelo,
+        'duracionMs': duracion_ms
+    }
+    if modelo != agente.modelo:
+        metadatos['modeloPrincipal'] = agente.modelo
+    
+    if estado == 'timeout':
+        texto = f"{agente.avatar} {agente.nombre} no respondió a tiempo"
+        metadatos['timeout'] = True
+    elif estado == 'error':
+        texto = error
+        metadatos['error'] = True
+    
+    mensaje_agente = Mensaje(
+        sala_id=sala.id,
+        agente_id=agente.id,
+        tipo='agente',
+        texto=texto,
+        metadatos=json.dumps(metadatos)
+    )
+    db.session.add(mensaje_agente)
+    
+    # Actualizar contador de conversaciones
+    if estado == 'ok':
+        agente.conversaciones += 1
+    
+    return mensaje_agente
+
+def mensaje_con_historial(historial, sala, agente, mensaje_texto):
+    """Mensaje para el agente; si Ollama ya guarda el contexto de la sala no se repite el historial"""
+    if sesiones_ollama.tiene_contexto(clave_sesion(agente.id, sala.id), agente):
+        return mensaje_texto
+    return historial.mensaje_para(agente, mensaje_texto)
+
+def stream_mensaje_sala(sala, mensaje_usuario, agentes, mensajes_agentes, plazo, formato, usar_cache=None):
+    """Generador que entrelaza los tokens de todos los agentes de la sala"""
+    inicio = time.monotonic()
+    por_id = {agente.id: agente for agente in agentes}
+    
+    yield formatear_evento(formato, 'inicio', {
+        'mensajeUsuario': mensaje_usuario.to_dict(),
+        'agentes': [agente.id for agente in agentes]
+    })
+    
+    fuentes = [
+        (agente.id, limitar(generar_respuesta_ia_stream, plazo_agente(agente)),
+         (mensajes_agentes[agente.id], copiar_agente(agente), usar_cache, clave_sesion(agente.id, sala.id)))
+        for agente in agentes
+    ]
+    
+    # Si el cliente se desconecta se deja de consumir el multiplexor, que
+    # cancela los streams de todos los agentes
+    with con_plazo(plazo):
+        eventos = stream_como_inquilino(multiplexar_streams(fuentes, plazo), inquilino(sala.id))
+    
+    modelos = {}
+    for evento, agente_id, valor in eventos:
+        if evento == 'token':
+            if agente_id not in modelos:
+                modelos[agente_id] = modelo_de(valor, None)
+            yield formatear_evento(formato, 'token', {'agenteId': agente_id, 'token': valor})
+            continue
+        
+        # El agente terminó (bien, con error o por plazo): guardar su mensaje
+        agente = por_id[agente_id]
+        duracion_ms = round((time.monotonic() - inicio) * 1000, 1)
+        estado = {'fin': 'ok', 'error': 'error', 'timeout': 'timeout'}[evento]
+        error = None
+        if evento == 'error':
+            error = str(valor) if isinstance(valor, ErrorProveedor) else f"Error generando respuesta: {valor}"
+        try:
+            mensaje_agente = guardar_respuesta_agente(
+                sala, agente, estado, valor if evento == 'fin' else None, error, duracion_ms,
+                modelos.get(agente_id)
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            yield formatear_evento(formato, 'error', {'agenteId': agente_id, 'error': str(e)})
+            continue
+        
+        yield formatear_evento(formato, 'mensaje', {
+            'agenteId': agente_id,
+            'estado': estado,
+            'mensaje': mensaje_agente.to_dict()
+        })
+    
+    yield formatear_evento(formato, 'fin', {'totalMs': round((time.monotonic() - inicio) * 1000, 1)})
+
 @salas_bp.route('/salas/<int:sala_id>/agentes/<int:agente_id>/llamar', methods=['POST'])
 def llamar_agente_sala(sala_id, agente_id):
     """Llamar un agente a una sala"""
@@ -0,0 +1,69 @@
+from flask import Blueprint, request, jsonify
+from datetime import datetime
+from src.models.user import db
+from src.models.trabajo import Trabajo
+from src.services.trabajos import cola_trabajos
+from src.services.streaming import solicita_stream, formato_stream, formatear_evento, respuesta_stream
+
+trabajos_bp = Blueprint('trabajos', __name__)
+
+def ids_solicitados():
+    """IDs de trabajo de la query (?ids=1,2,3)"""
+    return [int(i) for i in request.args.get('ids', '').split(',') if i.strip().isdigit()]
+
+@trabajos_bp.route('/trabajos', methods=['GET'])
+def obtener_trabajos():
+    """Consultar trabajos por ID o por sala/estado; con stream=1 se envían al terminar"""
+    try:
+        ids = ids_solicitados()
+        if ids and solicita_stream():
+            formato = formato_stream()
+            return respuesta_stream(stream_trabajos(ids, formato), formato)
+
+        consulta = Trabajo.query
+        if ids:
+            consulta = consulta.filter(Trabajo.id.in_(ids))
+        if request.args.get('salaId'):
+            consulta = consulta.filter_by(sala_id=int(request.args['salaId']))
+        if request.args.get('estado'):
+            consulta = consulta.filter_by(estado=request.args['estado'])
+        trabajos = consulta.order_by(Trabajo.id.desc()).limit(100).all()
+        return jsonify([trabajo.to_dict() for trabajo in trabajos])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@trabajos_bp.route('/trabajos/<int:trabajo_id>', methods=['GET'])
+def obtener_trabajo(trabajo_id):
+    """Estado y resultado de un trabajo de generación"""
+    try:
+        trabajo = Trabajo.query.get_or_404(trabajo_id)
+        return jsonify(trabajo.to_dict())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@trabajos_bp.route('/trabajos/estado', methods=['GET'])
+def estado_trabajos():
+    """Estadísticas de la cola de trabajos de generación"""
+    try:
+        return jsonify({
+            'trabajos': cola_trabajos.estadisticas(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def stream_trabajos(ids, formato):
+    """Generador que envía cada trabajo cuando termina y 'fin' cuando terminan todos"""
+    enviados = set()
+    while True:
+        # Terminar la transacción de lectura para ver lo que guardan los workers
+        db.session.rollback()
+        trabajos = Trabajo.query.filter(Trabajo.id.in_(ids)).all()
+        for trabajo in trabajos:
+            if trabajo.terminado and trabajo.id not in enviados:
+                enviados.add(trabajo.id)
+                yield formatear_evento(formato, 'trabajo', trabajo.to_dict())
+        if all(trabajo.terminado for trabajo in trabajos):
+            yield formatear_evento(formato, 'fin', {'trabajos': sorted(enviados)})
+            return
+        cola_trabajos.esperar_cambios()
@@ -0,0 +1,372 @@
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from flask import jsonify
+from src.services.proveedores import SaturacionProveedor, PlazoAgotado, proveedor_de_modelo
+from src.services.concurrencia import stream_con_contexto
+from src.services.plazos import restante
+
+# Control de admisión para la generación: limita las peticiones en curso por
+# proveedor y por modelo, con una cola de espera acotada. Cuando la cola está
+# llena se rechaza enseguida (429) en vez de dejar que todo acabe en timeout.
+#
+# La cola no se sirve por orden de llegada sino con reparto justo ponderado
+# entre inquilinos (cada sala, o cada usuario fuera de las salas): una sala que
+# envía muchos mensajes no deja sin turno al resto. El trabajo interactivo
+# pasa siempre antes que el de lote (resúmenes, análisis).
+
+MAX_EN_VUELO_POR_DEFECTO = {
+    'ollama': 1,
+    'lmstudio': 1,
+    'localai': 1,
+    'openai': 8,
+    'anthropic': 8,
+    'google': 8
+}
+
+COLA_MAX = int(os.getenv('ADMISION_COLA_MAX', '16'))
+ESPERA_MAX_SEGUNDOS = float(os.getenv('ADMISION_ESPERA_MAX', '30'))
+MAX_POR_MODELO = int(os.getenv('ADMISION_MAX_POR_MODELO', '0'))  # 0 = sin límite propio
+MAX_POR_INQUILINO = int(os.getenv('ADMISION_MAX_POR_INQUILINO', '4'))  # 0 = sin límite propio
+MAX_INQUILINOS_METRICAS = 256
+
+INTERACTIVA = 'interactiva'
+LOTE = 'lote'
+PRIORIDADES = {INTERACTIVA: 0, LOTE: 1}
+INQUILINO_POR_DEFECTO = 'general'
+
+# Inquilino y prioridad de las generaciones del contexto actual
+_solicitud = contextvars.ContextVar('solicitud_admision', default=(INQUILINO_POR_DEFECTO, INTERACTIVA))
+# Hueco ocupado por el bloque `admitir` en curso del contexto actual (ver `ceder`)
+_hueco = contextvars.ContextVar('hueco_admision', default=None)
+
+def _limites_modelos():
+    try:
+        return json.loads(os.getenv('ADMISION_MAX_MODELOS', '{}'))
+    except ValueError:
+        return {}
+
+def _pesos_inquilinos():
+    try:
+        return json.loads(os.getenv('ADMISION_PESOS_INQUILINOS', '{}'))
+    except ValueError:
+        return {}
+
+def inquilino(sala_id=None, usuario=None):
+    """Inquilino del reparto justo: la sala o, fuera de las salas, el usuario"""
+    if sala_id is not None:
+        return f'sala:{sala_id}'
+    return f'usuario:{usuario or "Usuario"}'
+
+@contextmanager
+def como_inquilino(nombre, prioridad=INTERACTIVA):
+    """Las generaciones del bloque (y de los hilos que lance) cuentan para `nombre`"""
+    token = _solicitud.set((nombre or INQUILINO_POR_DEFECTO, prioridad))
+    try:
+        yield
+    finally:
+        _solicitud.reset(token)
+
+def stream_como_inquilino(iterable, nombre, prioridad=INTERACTIVA):
+    """Como `como_inquilino` para un stream: el inquilino (y el resto del contexto
+    actual) se aplica mientras se pide cada token, no entre un token y otro"""
+    with como_inquilino(nombre, prioridad):
+        return stream_con_contexto(iterable)
+
+class _Ticket:
+    def __init__(self, proveedor, modelo, inquilino, prioridad, etiqueta):
+        self.proveedor = proveedor
+        self.modelo = modelo
+        self.inquilino = inquilino
+        self.prioridad = prioridad
+        self.etiqueta = etiqueta
+        self.llegada = time.monotonic()
+
+    def orden(self):
+        return (PRIORIDADES.get(self.prioridad, 0), self.etiqueta, self.llegada)
+
+class _Hueco:
+    def __init__(self, proveedor, modelo, inquilino, prioridad):
+        self.proveedor = proveedor
+        self.modelo = modelo
+        self.inquilino = inquilino
+        self.prioridad = prioridad
+        self.ocupado = True
+        self.inicio = time.monotonic()
+
+class ControlAdmision:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._limites_modelos = _limites_modelos()
+        self._pesos = _pesos_inquilinos()
+        self._en_vuelo = {}
+        self._en_vuelo_modelo = {}
+        self._en_vuelo_inquilino = {}
+        self._colas = {}
+        self._metricas = {}
+        self._metricas_inquilinos = OrderedDict()
+        # Reparto justo autocronometrado: tiempo virtual por proveedor y
+        # etiqueta de fin del último ticket de cada inquilino
+        self._tiempo_virtual = {}
+        self._ultima_etiqueta = {}
+
+    def limite_proveedor(self, proveedor):
+        defecto = MAX_EN_VUELO_POR_DEFECTO.get(proveedor, 4)
+        return int(os.getenv(f'ADMISION_MAX_{proveedor.upper()}', defecto))
+
+    def limite_modelo(self, modelo):
+        return int(self._limites_modelos.get(modelo, MAX_POR_MODELO))
+
+    def _metricas_de(self, proveedor):
+        if proveedor not in self._metricas:
+            self._metricas[proveedor] = {
+                'admitidas': 0,
+                'rechazadas': 0,
+                'expiradas': 0,
+                'esperaTotal': 0.0,
+                'esperaMax': 0.0,
+                'servicioMedio': 0.0
+            }
+        return self._metricas[proveedor]
+
+    def _metricas_inquilino(self, inquilino):
+        metricas = self._metricas_inquilinos.get(inquilino)
+        if metricas is None:
+            metricas = {
+                'admitidas': 0,
+                'rechazadas': 0,
+                'expiradas': 0,
+                'esperaTotal': 0.0,
+                'esperaMax': 0.0,
+                'prioridad': INTERACTIVA
+            }
+            self._metricas_inquilinos[inquilino] = metricas
+            if len(self._metricas_inquilinos) > MAX_INQUILINOS_METRICAS:
+                self._metricas_inquilinos.popitem(last=False)
+        self._metricas_inquilinos.move_to_end(inquilino)
+        return metricas
+
+    def _hay_hueco(self, proveedor, modelo, inquilino):
+        if self._en_vuelo.get(proveedor, 0) >= self.limite_proveedor(proveedor):
+            return False
+        if MAX_POR_INQUILINO and self._en_vuelo_inquilino.get((proveedor, inquilino), 0) >= MAX_POR_INQUILINO:
+            return False
+        limite = self.limite_modelo(modelo)
+        return not limite or self._en_vuelo_modelo.get(modelo, 0) < limite
+
+    def _coste(self, inquilino):
+        """Avance de la etiqueta virtual por petición: el inverso del peso del inquilino"""
+        return 1 / (float(self._pesos.get(inquilino, 1)) or 1.0)
+
+    def _etiquetar(self, proveedor, inquilino):
+        """Etiqueta de fin virtual de una nueva petición del inquilino (solo al
+        encolarla o admitirla: una petición rechazada no gasta turno)"""
+        virtual = self._tiempo_virtual.get(proveedor, 0.0)
+        etiqueta = max(virtual, self._ultima_etiqueta.get((proveedor, inquilino), 0.0)) + self._coste(inquilino)
+        self._ultima_etiqueta[(proveedor, inquilino)] = etiqueta
+        if len(self._ultima_etiqueta) > MAX_INQUILINOS_METRICAS:
+            # Las etiquetas ya alcanzadas por el tiempo virtual no influyen
+            for clave in [c for c, e in self._ultima_etiqueta.items() if e <= self._tiempo_virtual.get(c[0], 0.0)]:
+                del self._ultima_etiqueta[clave]
+        return etiqueta
+
+    def _retirar(self, cola, ticket):
+        """Sacar de la cola un ticket que expiró sin entrar y devolver su turno:
+        las peticiones posteriores del inquilino adelantan su etiqueta"""
+        cola.remove(ticket)
+        coste = self._coste(ticket.inquilino)
+        for otro in cola:
+            if otro.inquilino == ticket.inquilino and otro.etiqueta > ticket.etiqueta:
+                otro.etiqueta -= coste
+        clave = (ticket.proveedor, ticket.inquilino)
+        if clave in self._ultima_etiqueta:
+            self._ultima_etiqueta[clave] -= coste
+
+    def _siguiente(self, proveedor):
+        """Ticket que debe pasar a continuación: el de mayor prioridad y menor
+        etiqueta virtual entre los que tienen hueco"""
+        candidatos = [t for t in self._colas.get(proveedor, ())
+                      if self._hay_hueco(t.proveedor, t.modelo, t.inquilino)]
+        return min(candidatos, key=_Ticket.orden) if candidatos else None
+
+    def _reintentar_en(self, proveedor):
+        metricas = self._metricas_de(proveedor)
+        en_cola = len(self._colas.get(proveedor, ()))
+        servicio = metricas['servicioMedio'] or 1.0
+        return max(1, math.ceil(servicio * (en_cola + 1) / self.limite_proveedor(proveedor)))
+
+    def _entrar(self, proveedor, modelo, timeout, inquilino, prioridad, por_plazo=False):
+        inicio = time.monotonic()
+        with self._cond:
+            metricas = self._metricas_de(proveedor)
+            metricas_inquilino = self._metricas_inquilino(inquilino)
+            metricas_inquilino['prioridad'] = prioridad
+            cola = self._colas.setdefault(proveedor, deque())
+
+            if not cola and self._hay_hueco(proveedor, modelo, inquilino):
+                etiqueta = self._etiquetar(proveedor, inquilino)
+            else:
+                if len(cola) >= COLA_MAX:
+                    metricas['rechazadas'] += 1
+                    metricas_inquilino['rechazadas'] += 1
+                    raise SaturacionProveedor(
+                        f"{proveedor} está saturado, vuelve a intentarlo en unos segundos",
+                        proveedor, 429, self._reintentar_en(proveedor)
+                    )
+
+                ticket = _Ticket(proveedor, modelo, inquilino, prioridad, self._etiquetar(proveedor, inquilino))
+                cola.append(ticket)
+                limite = inicio + timeout
+                while self._siguiente(proveedor) is not ticket:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self._retirar(cola, ticket)
+                        metricas['expiradas'] += 1
+                        metricas_inquilino['expiradas'] += 1
+                        self._cond.notify_all()
+                        if por_plazo:
+                            # Se acabó el plazo del cliente: reintentar no tiene sentido
+                            raise PlazoAgotado(proveedor)
+                        raise SaturacionProveedor(
+                            f"{proveedor} no tuvo hueco en {timeout:.0f} s",
+                            proveedor, 503, self._reintentar_en(proveedor)
+                        )
+                    self._cond.wait(restante)
+                cola.remove(ticket)
+                etiqueta = ticket.etiqueta
+
+            self._en_vuelo[proveedor] = self._en_vuelo.get(proveedor, 0) + 1
+            self._en_vuelo_modelo[modelo] = self._en_vuelo_modelo.get(modelo, 0) + 1
+            self._en_vuelo_inquilino[(proveedor, inquilino)] = self._en_vuelo_inquilino.get((proveedor, inquilino), 0) + 1
+            self._tiempo_virtual[proveedor] = max(self._tiempo_virtual.get(proveedor, 0.0), etiqueta)
+
+            espera = time.monotonic() - inicio
+            for m in (metricas, metricas_inquilino):
+                m['admitidas'] += 1
+                m['esperaTotal'] += espera
+                m['esperaMax'] = max(m['esperaMax'], espera)
+
+    def _salir(self, proveedor, modelo, inquilino, duracion):
+        with self._cond:
+            self._en_vuelo[proveedor] -= 1
+            self._en_vuelo_modelo[modelo] -= 1
+            self._en_vuelo_inquilino[(proveedor, inquilino)] -= 1
+            if not self._en_vuelo_inquilino[(proveedor, inquilino)]:
+                del self._en_vuelo_inquilino[(proveedor, inquilino)]
+            metricas = self._metricas_de(proveedor)
+            # Media móvil del tiempo de servicio para estimar Retry-After
+            if duracion is None:
+                pass
+            elif metricas['servicioMedio']:
+                metricas['servicioMedio'] = 0.8 * metricas['servicioMedio'] + 0.2 * duracion
+            else:
+                metricas['servicioMedio'] = duracion
+            self._cond.notify_all()
+
+    @contextmanager
+    def admitir(self, modelo, timeout=None):
+        """Ocupar un hueco de generación para el modelo mientras dura el bloque"""
+        proveedor = proveedor_de_modelo(modelo) or 'desconocido'
+        inquilino, prioridad = _solicitud.get()
+        espera_max, por_plazo = self._espera(timeout)
+        self._entrar(proveedor, modelo, espera_max, inquilino, prioridad, por_plazo)
+        hueco = _Hueco(proveedor, modelo, inquilino, prioridad)
+        anterior = _hueco.get()
+        _hueco.set(hueco)
+        try:
+            yield
+        finally:
+            _hueco.set(anterior)
+            if hueco.ocupado:
+                self._salir(proveedor, modelo, inquilino, time.monotonic() - hueco.inicio)
+
+    def _espera(self, timeout=None):
+        """(espera máxima de turno, si la limita el plazo de la petición)"""
+        espera_max = ESPERA_MAX_SEGUNDOS if timeout is None else timeout
+        tiempo = restante()
+        if tiempo is not None and tiempo < espera_max:
+            # No esperar turno más allá del plazo de la petición
+            return max(tiempo, 0), True
+        return espera_max, False
+
+    @contextmanager
+    def ceder(self):
+        """Soltar el hueco del `admitir` en curso mientras dura el bloque (p. ej.
+        esperando turno de un límite de API) y volver a pedirlo al salir, para
+        no dejar sin turno a otros inquilinos mientras este hilo duerme"""
+        hueco = _hueco.get()
+        if hueco is None or not hueco.ocupado:
+            yield
+            return
+        self._salir(hueco.proveedor, hueco.modelo, hueco.inquilino, None)
+        hueco.ocupado = False
+        try:
+            yield
+        finally:
+            espera_max, por_plazo = self._espera()
+            self._entrar(hueco.proveedor, hueco.modelo, espera_max, hueco.inquilino, hueco.prioridad, por_plazo)
+            hueco.ocupado = True
+            hueco.inicio = time.monotonic()
+
+    def estadisticas(self):
+        with self._cond:
+            resultado = {}
+            for proveedor in set(self._metricas) | set(self._en_vuelo):
+                metricas = self._metricas_de(proveedor)
+                admitidas = metricas['admitidas']
+                resultado[proveedor] = {
+                    'enVuelo': self._en_vuelo.get(proveedor, 0),
+                    'maxEnVuelo': self.limite_proveedor(proveedor),
+                    'enCola': len(self._colas.get(proveedor, ())),
+                    'colaMax': COLA_MAX,
+                    'admitidas': admitidas,
+                    'rechazadas': metricas['rechazadas'],
+                    'expiradas': metricas['expiradas'],
+                    'esperaMediaMs': round(metricas['esperaTotal'] / admitidas * 1000, 1) if admitidas else 0.0,
+                    'esperaMaxMs': round(metricas['esperaMax'] * 1000, 1),
+                    'servicioMedioMs': round(metricas['servicioMedio'] * 1000, 1)
+                }
+            resultado['modelos'] = {m: n for m, n in self._en_vuelo_modelo.items() if n}
+            resultado['inquilinos'] = self._estadisticas_inquilinos()
+            return resultado
+
+    def _estadisticas_inquilinos(self):
+        en_vuelo = {}
+        for (_, nombre), n in self._en_vuelo_inquilino.items():
+            en_vuelo[nombre] = en_vuelo.get(nombre, 0) + n
+        en_cola = {}
+        for cola in self._colas.values():
+            for ticket in cola:
+                en_cola[ticket.inquilino] = en_cola.get(ticket.inquilino, 0) + 1
+        return {
+            nombre: {
+                'prioridad': metricas['prioridad'],
+                'peso': float(self._pesos.get(nombre, 1)),
+                'enVuelo': en_vuelo.get(nombre, 0),
+                'maxEnVuelo': MAX_POR_INQUILINO or None,
+                'enCola': en_cola.get(nombre, 0),
+                'admitidas': metricas['admitidas'],
+                'rechazadas': metricas['rechazadas'],
+                'expiradas': metricas['expiradas'],
+                'esperaMediaMs': round(metricas['esperaTotal'] / metricas['admitidas'] * 1000, 1) if metricas['admitidas'] else 0.0,
+                'esperaMaxMs': round(metricas['esperaMax'] * 1000, 1)
+            }
+            for nombre, metricas in self._metricas_inquilinos.items()
+        }
+
+control_admision = ControlAdmision()
+
+def respuesta_saturacion(error):
+    """Respuesta HTTP 429/503 con Retry-After para un proveedor saturado"""
+    respuesta = jsonify({
+        'error': str(error),
+        'proveedor': error.proveedor,
+        'reintentarEn': error.reintentar_en
+    })
+    respuesta.headers['Retry-After'] = str(error.reintentar_en)
+    return respuesta, error.codigo
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import request
+
+# Caché LRU con TTL para respuestas completas de modelos.
+# Solo se usa cuando la petición es determinista (temperatura 0) o el
+# agente la tiene habilitada explícitamente.
+
+CACHE_MAX_ENTRADAS = int(os.getenv('CACHE_RESPUESTAS_MAX', '512'))
+CACHE_TTL_SEGUNDOS = int(os.getenv('CACHE_RESPUESTAS_TTL', '300'))
+
+class CacheRespuestas:
+    def __init__(self, max_entradas=CACHE_MAX_ENTRADAS, ttl=CACHE_TTL_SEGUNDOS):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.expirados = 0
+        self.desalojados = 0
+        self.omitidos = 0
+
+    def obtener(self, clave):
+        """Devolver la respuesta guardada o None si no existe o expiró"""
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                self.fallos += 1
+                return None
+
+            valor, expira = entrada
+            if expira < time.monotonic():
+                del self._entradas[clave]
+                self.expirados += 1
+                self.fallos += 1
+                return None
+
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return valor
+
+    def guardar(self, clave, valor, ttl=None):
+        """Guardar una respuesta, desalojando las menos usadas si hace falta"""
+        ttl = ttl or self.ttl
+        with self._lock:
+            self._entradas[clave] = (valor, time.monotonic() + ttl)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+                self.desalojados += 1
+
+    def registrar_omitido(self):
+        with self._lock:
+            self.omitidos += 1
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+
+    def estadisticas(self):
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                'entradas': len(self._entradas),
+                'maxEntradas': self.max_entradas,
+                'ttlPorDefecto': self.ttl,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasaAciertos': round(self.aciertos / consultas, 3) if consultas else 0.0,
+                'expirados': self.expirados,
+                'desalojados': self.desalojados,
+                'omitidos': self.omitidos
+            }
+
+cache_respuestas = CacheRespuestas()
+
+def clave_solicitud(modelo, prompt_sistema, mensaje, temperatura, max_tokens, respaldo=None):
+    """Hash de todos los parámetros que determinan la respuesta (`respaldo`: cadena
+    de modelos y SLO de primer token, si la petición puede responderla otro modelo)"""
+    parametros = [modelo, prompt_sistema, mensaje, temperatura, max_tokens]
+    if respaldo:
+        parametros.append(respaldo)
+    contenido = json.dumps(parametros, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+
+def preferencia_cache(data=None):
+    """Leer la preferencia de caché de la petición: True, False o None (por defecto)"""
+    if 'no-cache' in request.headers.get('Cache-Control', ''):
+        return False
+    if data:
+        if data.get('sinCache'):
+            return False
+        if 'cache' in data:
+            return bool(data['cache'])
+    return None
+
+def cache_aplica(temperatura, habilitado=False, usar_cache=None):
+    """Decidir si una petición puede servirse desde caché"""
+    if usar_cache is not None:
+        return usar_cache
+    return bool(habilitado) or temperatura == 0
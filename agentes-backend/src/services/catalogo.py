@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from src.services import proveedores
+from src.services.nodos import pool_nodos
+
+# Catálogo en memoria de los modelos instalados en cada proveedor local.
+# Las comprobaciones de disponibilidad leen de aquí en lugar de pedir
+# /api/tags o /v1/models cada vez; un hilo en segundo plano lo mantiene
+# fresco y las descargas/eliminaciones lo invalidan.
+
+CATALOGO_TTL = float(os.getenv('CATALOGO_TTL', '30'))
+CATALOGO_TTL_ERROR = float(os.getenv('CATALOGO_TTL_ERROR', '5'))
+
+RUTAS_CATALOGO = {
+    'ollama': '/api/tags',
+    'lmstudio': '/v1/models',
+    'localai': '/v1/models'
+}
+
+def _nombres_modelos(proveedor, data):
+    if proveedor == 'ollama':
+        return [m.get('name') for m in data.get('models', []) if m.get('name')]
+    return [m.get('id') for m in data.get('data', []) if m.get('id')]
+
+def _unir(entrada, proveedor, modelos, data):
+    """Añadir a la entrada los modelos de un nodo (sin repetir los de otros nodos)"""
+    if entrada['datos'] is None:
+        entrada.update(disponible=True, modelos=list(modelos), datos=data)
+        return
+    clave, campo = ('models', 'name') if proveedor == 'ollama' else ('data', 'id')
+    for modelo in data.get(clave, []):
+        if modelo.get(campo) not in entrada['modelos']:
+            entrada['modelos'].append(modelo.get(campo))
+            entrada['datos'].setdefault(clave, []).append(modelo)
+
+class CatalogoModelos:
+    def __init__(self, ttl=CATALOGO_TTL):
+        self.ttl = ttl
+        self._entradas = {}
+        self._lock = threading.Lock()
+        self._locks_proveedor = {p: threading.Lock() for p in RUTAS_CATALOGO}
+        self._hilo_refresco = None
+        self.aciertos = 0
+        self.consultas_red = 0
+
+    def _vigente(self, entrada):
+        ttl = self.ttl if entrada['disponible'] else CATALOGO_TTL_ERROR
+        return time.monotonic() - entrada['actualizado'] < ttl
+
+    def refrescar(self, proveedor):
+        """Consultar al proveedor (todos sus nodos) y actualizar su entrada del catálogo"""
+        with self._locks_proveedor[proveedor]:
+            entrada = {'disponible': False, 'modelos': [], 'datos': None, 'error': None}
+            urls = proveedores.urls_proveedor(proveedor)
+            for url in urls:
+                try:
+                    self.consultas_red += 1
+                    ruta = RUTAS_CATALOGO[proveedor]
+                    response = proveedores.get(proveedor, f"{url}{ruta}" if len(urls) > 1 else ruta, timeout=5)
+                    if response.status_code == 200:
+                        data = response.json()
+                        modelos = _nombres_modelos(proveedor, data)
+                        pool_nodos.registrar_modelos(proveedor, url, modelos)
+                        _unir(entrada, proveedor, modelos, data)
+                    else:
+                        entrada['error'] = f"HTTP {response.status_code}"
+                except Exception as e:
+                    entrada['error'] = str(e)
+            if entrada['disponible']:
+                entrada['error'] = None
+
+            entrada['actualizado'] = time.monotonic()
+            with self._lock:
+                self._entradas[proveedor] = entrada
+            return entrada
+
+    def entrada(self, proveedor):
+        """Entrada vigente del proveedor; solo va a la red si no hay una válida"""
+        with self._lock:
+            entrada = self._entradas.get(proveedor)
+            if entrada is not None and self._vigente(entrada):
+                self.aciertos += 1
+                return entrada
+        return self.refrescar(proveedor)
+
+    def modelos(self, proveedor):
+        """Lista de modelos instalados, o None si el proveedor no responde"""
+        entrada = self.entrada(proveedor)
+        return list(entrada['modelos']) if entrada['disponible'] else None
+
+    def disponible(self, proveedor):
+        return self.entrada(proveedor)['disponible']
+
+    def invalidar(self, proveedor=None):
+        """Descartar la entrada de un proveedor (o de todos) tras un cambio"""
+        with self._lock:
+            if proveedor is None:
+                self._entradas.clear()
+            else:
+                self._entradas.pop(proveedor, None)
+
+    def iniciar_refresco(self):
+        """Arrancar el hilo que refresca en segundo plano los proveedores consultados"""
+        with self._lock:
+            if self._hilo_refresco is not None:
+                return
+            self._hilo_refresco = threading.Thread(target=self._bucle_refresco, name='catalogo-modelos', daemon=True)
+            self._hilo_refresco.start()
+
+    def _bucle_refresco(self):
+        while True:
+            # Refrescar un poco antes de que caduque para que las consultas no esperen
+            time.sleep(max(self.ttl * 0.8, 1))
+            with self._lock:
+                proveedores_usados = list(self._entradas)
+            for proveedor in proveedores_usados:
+                try:
+                    self.refrescar(proveedor)
+                except Exception as e:
+                    print(f"⚠️ Error refrescando catálogo de {proveedor}: {e}")
+
+    def estadisticas(self):
+        with self._lock:
+            ahora = time.monotonic()
+            return {
+                'ttl': self.ttl,
+                'aciertos': self.aciertos,
+                'consultasRed': self.consultas_red,
+                'proveedores': {
+                    proveedor: {
+                        'disponible': entrada['disponible'],
+                        'modelos': entrada['modelos'],
+                        'edadSegundos': round(ahora - entrada['actualizado'], 1),
+                        'error': entrada['error']
+                    }
+                    for proveedor, entrada in self._entradas.items()
+                }
+            }
+
+catalogo = CatalogoModelos()
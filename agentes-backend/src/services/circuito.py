@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Circuit breaker por endpoint de proveedor (cerrado / abierto / semiabierto).
+# Se alimenta de los resultados reales de las llamadas y de un sondeo de salud
+# en segundo plano, para que un backend caído falle al instante en lugar de
+# hacer esperar a cada petición hasta el timeout de conexión.
+
+UMBRAL_FALLOS = int(os.getenv('CIRCUITO_UMBRAL_FALLOS', '3'))
+TIEMPO_ABIERTO = float(os.getenv('CIRCUITO_TIEMPO_ABIERTO', '15'))
+INTERVALO_SONDEO = float(os.getenv('CIRCUITO_INTERVALO_SONDEO', '10'))
+
+CERRADO = 'cerrado'
+ABIERTO = 'abierto'
+SEMIABIERTO = 'semiabierto'
+
+# Valor de `permitir()` para la petición de prueba del estado semiabierto
+PRUEBA = 'prueba'
+
+# Ruta de salud de cada proveedor local sondeado en segundo plano
+RUTAS_SALUD = {
+    'ollama': '/api/tags',
+    'lmstudio': '/v1/models',
+    'localai': '/v1/models'
+}
+
+def endpoint_de_url(url):
+    """Clave del circuito: esquema://host:puerto de la URL"""
+    partes = urlsplit(url)
+    return f"{partes.scheme}://{partes.netloc}"
+
+class Circuito:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.estado = CERRADO
+        self.fallos_consecutivos = 0
+        self.fallos_totales = 0
+        self.exitos_totales = 0
+        self.rechazadas = 0
+        self.abierto_desde = None
+        self.ultimo_error = None
+        self.ultimo_cambio = time.time()
+        self.prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    def _cambiar(self, estado):
+        if self.estado != estado:
+            self.estado = estado
+            self.ultimo_cambio = time.time()
+
+    def permitir(self):
+        """Indica si se puede llamar al endpoint ahora mismo (PRUEBA si es la
+        petición de prueba del estado semiabierto)"""
+        with self._lock:
+            if self.estado == CERRADO:
+                return True
+            if self.estado == ABIERTO and time.monotonic() - self.abierto_desde >= TIEMPO_ABIERTO:
+                self._cambiar(SEMIABIERTO)
+            if self.estado == SEMIABIERTO and not self.prueba_en_curso:
+                # Dejar pasar una sola petición de prueba
+                self.prueba_en_curso = True
+                return PRUEBA
+            self.rechazadas += 1
+            return False
+
+    def reintentar_en(self):
+        with self._lock:
+            if self.estado != ABIERTO:
+                return 1
+            return max(1, int(TIEMPO_ABIERTO - (time.monotonic() - self.abierto_desde)) + 1)
+
+    def registrar_exito(self):
+        with self._lock:
+            self.exitos_totales += 1
+            self.fallos_consecutivos = 0
+            self.prueba_en_curso = False
+            self._cambiar(CERRADO)
+
+    def liberar_prueba(self):
+        """La prueba terminó sin veredicto (plazo agotado, cancelada...): no cuenta
+        como éxito ni como fallo, pero la siguiente petición puede probar"""
+        with self._lock:
+            if self.estado == SEMIABIERTO:
+                self.prueba_en_curso = False
+
+    def registrar_fallo(self, error=None):
+        with self._lock:
+            self.fallos_totales += 1
+            self.fallos_consecutivos += 1
+            self.ultimo_error = str(error) if error else None
+            self.prueba_en_curso = False
+            if self.estado == SEMIABIERTO or self.fallos_consecutivos >= UMBRAL_FALLOS:
+                self.abierto_desde = time.monotonic()
+                self._cambiar(ABIERTO)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'endpoint': self.endpoint,
+                'estado': self.estado,
+                'fallosConsecutivos': self.fallos_consecutivos,
+                'fallosTotales': self.fallos_totales,
+                'exitosTotales': self.exitos_totales,
+                'rechazadas': self.rechazadas,
+                'ultimoError': self.ultimo_error,
+                'ultimoCambio': self.ultimo_cambio
+            }
+
+class RegistroCircuitos:
+    def __init__(self):
+        self._circuitos = {}
+        self._lock = threading.Lock()
+        self._hilo_sondeo = None
+
+    def circuito(self, url):
+        endpoint = endpoint_de_url(url)
+        with self._lock:
+            if endpoint not in self._circuitos:
+                self._circuitos[endpoint] = Circuito(endpoint)
+            return self._circuitos[endpoint]
+
+    def estado(self, url):
+        return self.circuito(url).to_dict()
+
+    def todos(self):
+        with self._lock:
+            circuitos = list(self._circuitos.values())
+        return [c.to_dict() for c in circuitos]
+
+    def sondear(self):
+        """Sondear una vez la salud de los proveedores locales"""
+        from src.services import proveedores
+
+        for proveedor, ruta in RUTAS_SALUD.items():
+            for url in proveedores.urls_proveedor(proveedor):
+                circuito = self.circuito(url)
+                try:
+                    response = proveedores.solicitar(
+                        proveedor, 'GET', f"{url}{ruta}", timeout=2, ignorar_circuito=True
+                    )
+                    if response.status_code < 500:
+                        circuito.registrar_exito()
+                    else:
+                        circuito.registrar_fallo(f"HTTP {response.status_code}")
+                except Exception as e:
+                    circuito.registrar_fallo(e)
+
+    def iniciar_sondeo(self):
+        """Arrancar el hilo de sondeo de salud en segundo plano (una sola vez)"""
+        with self._lock:
+            if self._hilo_sondeo is not None:
+                return
+            self._hilo_sondeo = threading.Thread(target=self._bucle_sondeo, name='sondeo-salud', daemon=True)
+            self._hilo_sondeo.start()
+
+    def _bucle_sondeo(self):
+        while True:
+            try:
+                self.sondear()
+            except Exception as e:
+                print(f"⚠️ Error en sondeo de salud: {e}")
+            time.sleep(INTERVALO_SONDEO)
+
+circuitos = RegistroCircuitos()
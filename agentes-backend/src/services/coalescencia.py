@@ -0,0 +1,180 @@
+import threading
+from contextlib import closing
+from src.services.concurrencia import con_contexto
+from src.services.proveedores import ErrorProveedor, PlazoAgotado
+from src.services.plazos import restante
+from src.services.respaldo import TextoGenerado, modelo_de
+
+# Coalescencia "single-flight": peticiones idénticas que llegan mientras otra
+# está en curso esperan su resultado en lugar de llamar de nuevo al proveedor.
+
+class Vuelo:
+    """Generación en curso compartida por todas las peticiones idénticas"""
+
+    def __init__(self):
+        self.tokens = []
+        self.terminado = False
+        self.resultado = None
+        self.error = None
+        self.suscriptores = 1
+        self.cancelado = False
+        self._cond = threading.Condition()
+
+    def agregar_token(self, token):
+        with self._cond:
+            self.tokens.append(token)
+            self._cond.notify_all()
+
+    def terminar(self, resultado=None, error=None):
+        with self._cond:
+            if resultado and not self.tokens:
+                self.tokens.append(resultado)
+            self.resultado = resultado
+            self.error = error
+            self.terminado = True
+            self._cond.notify_all()
+
+    def salir(self):
+        """Un suscriptor deja el vuelo; sin ninguno, la generación se cancela"""
+        with self._cond:
+            self.suscriptores -= 1
+            if self.suscriptores <= 0 and not self.terminado:
+                self.cancelado = True
+
+    def _aguardar(self, listo, proveedor):
+        """Esperar (con el lock tomado) a que `listo()` se cumpla sin pasar del plazo actual"""
+        while not listo():
+            tiempo = restante()
+            if tiempo is not None and tiempo <= 0:
+                raise PlazoAgotado(proveedor or 'la generación compartida')
+            self._cond.wait(tiempo)
+
+    def esperar(self, proveedor=None):
+        """Bloquear hasta que termine y devolver el resultado (o relanzar el error)"""
+        try:
+            with self._cond:
+                self._aguardar(lambda: self.terminado, proveedor)
+        finally:
+            self.salir()
+        if self.error is not None:
+            raise self.error
+        return self.resultado
+
+    def iterar(self, proveedor=None):
+        """Recorrer los tokens ya producidos y los que vayan llegando"""
+        indice = 0
+        try:
+            while True:
+                with self._cond:
+                    self._aguardar(lambda: indice < len(self.tokens) or self.terminado, proveedor)
+                    nuevos = self.tokens[indice:]
+                    indice += len(nuevos)
+                    fin = self.terminado and indice >= len(self.tokens)
+                for token in nuevos:
+                    yield token
+                if fin:
+                    break
+        finally:
+            # Cliente desconectado o fin del stream
+            self.salir()
+        if self.error is not None:
+            raise self.error
+
+class VueloUnico:
+    def __init__(self):
+        self._vuelos = {}
+        self._lock = threading.Lock()
+        self.lideres = 0
+        self.coalescidas = 0
+
+    def _unirse(self, clave):
+        """Devolver (vuelo, es_lider) para la clave indicada"""
+        with self._lock:
+            vuelo = self._vuelos.get(clave)
+            if vuelo is not None and not vuelo.cancelado:
+                vuelo.suscriptores += 1
+                self.coalescidas += 1
+                return vuelo, False
+            vuelo = Vuelo()
+            self._vuelos[clave] = vuelo
+            self.lideres += 1
+            return vuelo, True
+
+    def _aterrizar(self, clave, vuelo):
+        with self._lock:
+            if self._vuelos.get(clave) is vuelo:
+                del self._vuelos[clave]
+
+    def ejecutar(self, clave, funcion, *args, proveedor=None):
+        """Ejecutar `funcion(*args)` una sola vez por clave entre peticiones simultáneas.
+
+        Quien espera la generación de otro lo hace como mucho hasta su propio
+        plazo; al agotarlo lanza PlazoAgotado en nombre de `proveedor`.
+        """
+        if clave is None:
+            return funcion(*args)
+
+        vuelo, es_lider = self._unirse(clave)
+        if not es_lider:
+            return vuelo.esperar(proveedor)
+
+        try:
+            resultado = funcion(*args)
+        except Exception as e:
+            self._aterrizar(clave, vuelo)
+            vuelo.terminar(error=e)
+            raise
+        self._aterrizar(clave, vuelo)
+        vuelo.terminar(resultado=resultado)
+        return resultado
+
+    def ejecutar_stream(self, clave, funcion_stream, *args, proveedor=None):
+        """Compartir un stream de tokens entre peticiones simultáneas.
+
+        El stream del proveedor se consume en un hilo propio, de modo que si
+        el primer cliente se desconecta el resto sigue recibiendo tokens.
+        """
+        if clave is None:
+            yield from funcion_stream(*args)
+            return
+
+        vuelo, es_lider = self._unirse(clave)
+        if es_lider:
+            hilo = threading.Thread(
+                target=con_contexto(self._producir), args=(clave, vuelo, funcion_stream, args),
+                name='vuelo-stream', daemon=True
+            )
+            hilo.start()
+
+        yield from vuelo.iterar(proveedor)
+
+    def _producir(self, clave, vuelo, funcion_stream, args):
+        partes = []
+        try:
+            with closing(funcion_stream(*args)) as tokens:
+                for token in tokens:
+                    if vuelo.cancelado:
+                        # Ya no queda nadie escuchando: cortar la generación
+                        raise ErrorProveedor("Generación cancelada: los clientes se desconectaron")
+                    partes.append(token)
+                    vuelo.agregar_token(token)
+        except Exception as e:
+            self._aterrizar(clave, vuelo)
+            vuelo.terminar(error=e)
+            return
+        self._aterrizar(clave, vuelo)
+        # Conservar el modelo que generó el texto (el primer token lo lleva si hubo respaldo)
+        modelo = modelo_de(partes[0], None) if partes else None
+        texto = ''.join(partes)
+        vuelo.terminar(resultado=TextoGenerado(texto, modelo) if modelo else texto)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'enVuelo': len(self._vuelos),
+                'esperando': sum(v.suscriptores - 1 for v in self._vuelos.values()),
+                'lideres': self.lideres,
+                'coalescidas': self.coalescidas
+            }
+
+vuelos = VueloUnico()
@@ -0,0 +1,222 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeout
+
+# Pool de hilos compartido para generar respuestas de varios agentes a la vez
+
+HILOS_GENERACION = int(os.getenv('GENERACION_HILOS', '16'))
+PLAZO_SALA_SEGUNDOS = float(os.getenv('SALA_PLAZO_RESPUESTA', '45'))
+
+_executor = ThreadPoolExecutor(max_workers=HILOS_GENERACION, thread_name_prefix='generacion')
+
+def copiar_agente(agente):
+    """Copiar las columnas de un agente a un objeto simple usable desde otros hilos.
+
+    Las instancias de SQLAlchemy pertenecen a la sesión del hilo de la
+    petición, así que los hilos de generación trabajan sobre esta copia.
+    """
+    valores = {columna.name: getattr(agente, columna.name) for columna in agente.__table__.columns}
+    return types.SimpleNamespace(**valores)
+
+def con_contexto(funcion):
+    """Envolver una función para que otro hilo la ejecute con el contexto actual
+    (por ejemplo, el inquilino y la prioridad del control de admisión)"""
+    contexto = contextvars.copy_context()
+    return lambda *args, **kwargs: contexto.run(funcion, *args, **kwargs)
+
+def iterar_en_contexto(iterable, contexto):
+    """Recorrer un iterable ejecutando cada paso dentro de `contexto`"""
+    iterador = iter(iterable)
+    try:
+        while True:
+            try:
+                valor = contexto.run(next, iterador)
+            except StopIteration:
+                return
+            yield valor
+    finally:
+        # Si quien consume corta el stream, cerrar también el original
+        if hasattr(iterador, 'close'):
+            contexto.run(iterador.close)
+
+def stream_con_contexto(iterable):
+    """Stream que se consume con el contexto actual aunque se recorra más tarde"""
+    return iterar_en_contexto(iterable, contextvars.copy_context())
+
+def enviar(funcion, *args, **kwargs):
+    """Ejecutar una función en el pool compartido y devolver su Future"""
+    return _executor.submit(con_contexto(funcion), *args, **kwargs)
+
+def ejecutar_con_plazo(tareas, plazo):
+    """Ejecutar tareas en paralelo esperando como máximo `plazo` segundos.
+
+    `tareas` es una lista de (clave, funcion, args). Devuelve un dict
+    clave -> {'estado': 'ok' | 'timeout' | 'error', 'resultado', 'error', 'duracionMs'}.
+    Las tareas que no terminan a tiempo siguen en segundo plano, pero su
+    resultado se descarta.
+    """
+    return dict(completar_con_plazo(tareas, plazo))
+
+def completar_con_plazo(tareas, plazo):
+    """Como `ejecutar_con_plazo`, pero produce (clave, resultado) según van terminando.
+
+    Al agotarse el plazo se producen las tareas pendientes con estado 'timeout',
+    igual que las que terminan con PlazoAgotado (su propio plazo, más corto).
+    """
+    from src.services.proveedores import PlazoAgotado
+
+    inicio = time.monotonic()
+    futuros = {}
+    duraciones = {}
+
+    def _medir(clave, funcion, args):
+        t0 = time.monotonic()
+        try:
+            return funcion(*args)
+        finally:
+            duraciones[clave] = round((time.monotonic() - t0) * 1000, 1)
+
+    for clave, funcion, args in tareas:
+        futuros[_executor.submit(con_contexto(_medir), clave, funcion, args)] = clave
+
+    try:
+        for futuro in as_completed(list(futuros), timeout=max(plazo, 0)):
+            clave = futuros.pop(futuro)
+            if isinstance(futuro.exception(), PlazoAgotado):
+                yield clave, {
+                    'estado': 'timeout',
+                    'resultado': None,
+                    'error': None,
+                    'duracionMs': duraciones.get(clave)
+                }
+            elif futuro.exception() is not None:
+                yield clave, {
+                    'estado': 'error',
+                    'resultado': None,
+                    'error': str(futuro.exception()),
+                    'duracionMs': duraciones.get(clave)
+                }
+            else:
+                yield clave, {
+                    'estado': 'ok',
+                    'resultado': futuro.result(),
+                    'error': None,
+                    'duracionMs': duraciones.get(clave)
+                }
+    except FuturesTimeout:
+        pass
+
+    for futuro, clave in futuros.items():
+        futuro.cancel()
+        yield clave, {
+            'estado': 'timeout',
+            'resultado': None,
+            'error': None,
+            'duracionMs': round((time.monotonic() - inicio) * 1000, 1)
+        }
+
+def completar_en_ventana(tareas, ventana):
+    """Ejecutar tareas en paralelo con como mucho `ventana` en curso a la vez.
+
+    `tareas` es un iterable de (clave, funcion, args); se lanza una nueva
+    cada vez que termina otra. Produce (clave, resultado) en orden de
+    finalización con el mismo formato que `completar_con_plazo`, sin plazo.
+    Si quien consume deja de hacerlo, las tareas aún no empezadas se cancelan.
+    """
+    pendientes = iter(tareas)
+    en_curso = {}
+
+    def _medir(funcion, args):
+        t0 = time.monotonic()
+        try:
+            return 'ok', funcion(*args), None, round((time.monotonic() - t0) * 1000, 1)
+        except Exception as e:
+            return 'error', None, str(e), round((time.monotonic() - t0) * 1000, 1)
+
+    def _lanzar():
+        while len(en_curso) < max(ventana, 1):
+            try:
+                clave, funcion, args = next(pendientes)
+            except StopIteration:
+                return
+            en_curso[_executor.submit(con_contexto(_medir), funcion, args)] = clave
+
+    try:
+        _lanzar()
+        while en_curso:
+            terminados, _ = wait(list(en_curso), return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                clave = en_curso.pop(futuro)
+                estado, resultado, error, duracion = futuro.result()
+                yield clave, {'estado': estado, 'resultado': resultado, 'error': error, 'duracionMs': duracion}
+            _lanzar()
+    finally:
+        for futuro in en_curso:
+            futuro.cancel()
+
+def multiplexar_streams(fuentes, plazo):
+    """Consumir varios generadores de tokens en paralelo y entrelazar su salida.
+
+    `fuentes` es una lista de (clave, funcion, args) donde la función devuelve
+    un iterable de tokens. Produce tuplas (evento, clave, valor) con evento
+    'token', 'fin' (valor = texto completo), 'error' (valor = excepción) o
+    'timeout' para las fuentes que no terminan dentro del plazo (o que agotan
+    el suyo propio con PlazoAgotado).
+
+    Al agotarse el plazo, o si quien consume deja de hacerlo (cliente
+    desconectado), las fuentes pendientes se cancelan en su siguiente token.
+    """
+    from src.services.proveedores import PlazoAgotado
+
+    cola = queue.Queue()
+    limite = time.monotonic() + max(plazo, 0)
+    pendientes = set()
+    cancelado = threading.Event()
+
+    def _consumir(clave, funcion, args):
+        partes = []
+        tokens = None
+        try:
+            tokens = iter(funcion(*args))
+            for token in tokens:
+                if cancelado.is_set():
+                    return
+                partes.append(token)
+                cola.put(('token', clave, token))
+            cola.put(('fin', clave, ''.join(partes)))
+        except PlazoAgotado:
+            cola.put(('timeout', clave, None))
+        except Exception as e:
+            cola.put(('error', clave, e))
+        finally:
+            # Cerrar el stream del proveedor también cuando se cancela
+            if hasattr(tokens, 'close'):
+                tokens.close()
+
+    for clave, funcion, args in fuentes:
+        pendientes.add(clave)
+        _executor.submit(con_contexto(_consumir), clave, funcion, args)
+
+    try:
+        while pendientes:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                evento, clave, valor = cola.get(timeout=restante)
+            except queue.Empty:
+                break
+            if clave not in pendientes:
+                continue
+            if evento in ('fin', 'error', 'timeout'):
+                pendientes.discard(clave)
+            yield evento, clave, valor
+
+        for clave in list(pendientes):
+            yield 'timeout', clave, None
+    finally:
+        cancelado.set()
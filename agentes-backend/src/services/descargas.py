@@ -0,0 +1,202 @@
+import json
+import os
+import threading
+import time
+import uuid
+from src.services import proveedores
+from src.services.catalogo import catalogo
+from src.services.nodos import clave_modelo
+
+# Descargas de modelos de Ollama como trabajos en segundo plano. Cada
+# descarga tiene un ID, su progreso se puede consultar o seguir por SSE,
+# las peticiones repetidas del mismo modelo comparten el trabajo en curso
+# y se puede cancelar cerrando el stream de /api/pull.
+
+DESCARGA_TIMEOUT_LECTURA = float(os.getenv('DESCARGA_TIMEOUT_LECTURA', '120'))
+DESCARGAS_RETENCION = float(os.getenv('DESCARGAS_RETENCION', '3600'))
+DESCARGAS_MAX_HISTORIAL = int(os.getenv('DESCARGAS_MAX_HISTORIAL', '50'))
+
+PENDIENTE = 'pendiente'
+DESCARGANDO = 'descargando'
+COMPLETADO = 'completado'
+ERROR = 'error'
+CANCELADO = 'cancelado'
+
+ESTADOS_FINALES = (COMPLETADO, ERROR, CANCELADO)
+
+class TrabajoDescarga:
+    def __init__(self, modelo):
+        self.id = uuid.uuid4().hex[:12]
+        self.modelo = modelo
+        self.nodo = None  # URL del nodo de Ollama que descarga el modelo
+        self.estado = PENDIENTE
+        self.fase = None
+        self.completado = 0
+        self.total = 0
+        self.error = None
+        self.creado = time.time()
+        self.terminado = None
+        self.version = 0
+        self.cancelar_solicitado = False
+        self._cond = threading.Condition()
+
+    @property
+    def finalizado(self):
+        return self.estado in ESTADOS_FINALES
+
+    def actualizar(self, **cambios):
+        with self._cond:
+            for campo, valor in cambios.items():
+                setattr(self, campo, valor)
+            if self.finalizado and self.terminado is None:
+                self.terminado = time.time()
+            self.version += 1
+            self._cond.notify_all()
+
+    def esperar(self, timeout=None):
+        """Bloquear hasta que el trabajo termine; devuelve False si vence el plazo"""
+        limite = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self.finalizado:
+                restante = None if limite is None else limite - time.monotonic()
+                if restante is not None and restante <= 0:
+                    return False
+                self._cond.wait(restante)
+            return True
+
+    def seguir(self, intervalo=15):
+        """Producir el estado cada vez que cambia (o cada `intervalo` segundos) hasta terminar"""
+        vista = -1
+        while True:
+            with self._cond:
+                if self.version == vista and not self.finalizado:
+                    self._cond.wait(intervalo)
+                vista = self.version
+                datos = self._dict()
+            yield datos
+            if datos['estado'] in ESTADOS_FINALES:
+                break
+
+    def _dict(self):
+        return {
+            'id': self.id,
+            'modelo': self.modelo,
+            'nodo': self.nodo,
+            'estado': self.estado,
+            'fase': self.fase,
+            'completado': self.completado,
+            'total': self.total,
+            'porcentaje': round(self.completado * 100 / self.total, 1) if self.total else None,
+            'error': self.error,
+            'creado': self.creado,
+            'terminado': self.terminado
+        }
+
+    def to_dict(self):
+        with self._cond:
+            return self._dict()
+
+class GestorDescargas:
+    def __init__(self):
+        self._trabajos = {}
+        self._activos = {}
+        self._lock = threading.Lock()
+
+    def iniciar(self, modelo):
+        """Lanzar la descarga del modelo o unirse a la que ya está en curso.
+
+        Devuelve (trabajo, nuevo).
+        """
+        # llama2 y llama2:latest son la misma descarga
+        clave = clave_modelo(modelo)
+        with self._lock:
+            trabajo = self._activos.get(clave)
+            if trabajo is not None and not trabajo.finalizado:
+                return trabajo, False
+
+            self._purgar()
+            trabajo = TrabajoDescarga(modelo)
+            self._trabajos[trabajo.id] = trabajo
+            self._activos[clave] = trabajo
+
+        hilo = threading.Thread(target=self._ejecutar, args=(trabajo,), name=f'descarga-{trabajo.id}', daemon=True)
+        hilo.start()
+        return trabajo, True
+
+    def obtener(self, trabajo_id):
+        with self._lock:
+            return self._trabajos.get(trabajo_id)
+
+    def listar(self):
+        with self._lock:
+            trabajos = list(self._trabajos.values())
+        return [t.to_dict() for t in sorted(trabajos, key=lambda t: t.creado, reverse=True)]
+
+    def cancelar(self, trabajo_id):
+        """Pedir la cancelación; devuelve el trabajo o None si no existe"""
+        trabajo = self.obtener(trabajo_id)
+        if trabajo is not None and not trabajo.finalizado:
+            trabajo.actualizar(cancelar_solicitado=True)
+        return trabajo
+
+    def _purgar(self):
+        """Olvidar los trabajos terminados antiguos (con el lock tomado)"""
+        ahora = time.time()
+        terminados = sorted(
+            (t for t in self._trabajos.values() if t.finalizado),
+            key=lambda t: t.terminado
+        )
+        sobrantes = len(terminados) - DESCARGAS_MAX_HISTORIAL
+        for i, trabajo in enumerate(terminados):
+            if i < sobrantes or ahora - trabajo.terminado > DESCARGAS_RETENCION:
+                del self._trabajos[trabajo.id]
+
+    def _ejecutar(self, trabajo):
+        trabajo.actualizar(estado=DESCARGANDO, fase='conectando')
+        try:
+            # Al nodo que atenderá el modelo (con varios nodos la ruta relativa iría a cualquiera)
+            trabajo.actualizar(nodo=proveedores.nodo_para_modelo('ollama', trabajo.modelo))
+            response = proveedores.post('ollama', f'{trabajo.nodo}/api/pull',
+                json={'name': trabajo.modelo, 'stream': True},
+                timeout=DESCARGA_TIMEOUT_LECTURA,
+                stream=True
+            )
+            with response:
+                if response.status_code != 200:
+                    trabajo.actualizar(estado=ERROR, error=f'Error descargando: {response.text}')
+                    return
+
+                for linea in response.iter_lines():
+                    if trabajo.cancelar_solicitado:
+                        # Al cerrar el stream Ollama aborta la descarga
+                        trabajo.actualizar(estado=CANCELADO, fase='cancelado')
+                        return
+                    if not linea:
+                        continue
+                    try:
+                        data = json.loads(linea)
+                    except ValueError:
+                        continue
+
+                    if data.get('error'):
+                        trabajo.actualizar(estado=ERROR, error=data['error'])
+                        return
+                    if data.get('status') == 'success':
+                        break
+                    trabajo.actualizar(
+                        fase=data.get('status'),
+                        completado=data.get('completed', 0),
+                        total=data.get('total', 0)
+                    )
+
+            catalogo.invalidar('ollama')
+            trabajo.actualizar(estado=COMPLETADO, fase='success')
+        except Exception as e:
+            trabajo.actualizar(estado=ERROR, error=str(e))
+        finally:
+            with self._lock:
+                clave = clave_modelo(trabajo.modelo)
+                if self._activos.get(clave) is trabajo:
+                    del self._activos[clave]
+
+gestor_descargas = GestorDescargas()
@@ -0,0 +1,164 @@
+import hashlib
+import math
+import os
+import re
+import threading
+import unicodedata
+from src.services import proveedores
+
+# Enrutado de mensajes de sala: antes de repartir el mensaje se eligen los
+# agentes relevantes con señales baratas (menciones @, coincidencia de
+# palabras con el rol/nombre/prompt y, opcionalmente, embeddings locales)
+# para que no respondan todos los agentes activos a cada mensaje.
+
+ENRUTADO_TOP_K = int(os.getenv('ENRUTADO_TOP_K', '3'))  # 0 = responden todos
+ENRUTADO_EMBEDDINGS_MODELO = os.getenv('ENRUTADO_EMBEDDINGS_MODELO', '')  # p. ej. nomic-embed-text
+ENRUTADO_EMBEDDINGS_PESO = float(os.getenv('ENRUTADO_EMBEDDINGS_PESO', '2'))
+ENRUTADO_EMBEDDINGS_TIMEOUT = float(os.getenv('ENRUTADO_EMBEDDINGS_TIMEOUT', '2'))
+
+PESO_ROL = 3.0
+PESO_NOMBRE = 2.0
+PESO_PROMPT = 0.5
+MENCIONES_TODOS = {'todos', 'all', 'everyone'}
+
+PALABRAS_VACIAS = {
+    'que', 'los', 'las', 'del', 'por', 'para', 'con', 'una', 'uno', 'como', 'mas', 'pero',
+    'sus', 'este', 'esta', 'esto', 'ese', 'esa', 'hay', 'son', 'ser', 'muy', 'sin', 'sobre',
+    'the', 'and', 'for', 'you', 'are', 'eres', 'experto', 'experta', 'especializado', 'especialista'
+}
+
+def _normalizar(texto):
+    texto = unicodedata.normalize('NFKD', (texto or '').lower())
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+def _raices(texto):
+    """Raíces (5 primeras letras) de las palabras significativas del texto"""
+    palabras = re.findall(r'[a-z0-9]+', _normalizar(texto))
+    return {p[:5] for p in palabras if len(p) >= 3 and p not in PALABRAS_VACIAS}
+
+def _alias(agente):
+    """Formas con las que se puede mencionar a un agente (@ana, @analistafinanciero, @finanzas)"""
+    nombre = _normalizar(agente.nombre)
+    alias = {re.sub(r'[^a-z0-9]', '', nombre), re.sub(r'[^a-z0-9]', '', _normalizar(agente.rol))}
+    partes = nombre.split()
+    if partes:
+        alias.add(re.sub(r'[^a-z0-9]', '', partes[0]))
+    alias.discard('')
+    return alias
+
+def _menciones(mensaje):
+    return {re.sub(r'[^a-z0-9]', '', m) for m in re.findall(r'@([\w.-]+)', _normalizar(mensaje))}
+
+def _coseno(a, b):
+    producto = sum(x * y for x, y in zip(a, b))
+    norma = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return producto / norma if norma else 0.0
+
+class EnrutadorSala:
+    def __init__(self):
+        self._embeddings = {}
+        self._lock = threading.Lock()
+        self.mensajes = 0
+        self.agentes_candidatos = 0
+        self.agentes_elegidos = 0
+
+    def _embedding(self, texto):
+        clave = hashlib.sha256(f'{ENRUTADO_EMBEDDINGS_MODELO}\0{texto}'.encode('utf-8')).hexdigest()
+        with self._lock:
+            if clave in self._embeddings:
+                return self._embeddings[clave]
+        response = proveedores.post('ollama', '/api/embeddings',
+            json={'model': ENRUTADO_EMBEDDINGS_MODELO, 'prompt': texto},
+            timeout=ENRUTADO_EMBEDDINGS_TIMEOUT
+        )
+        if response.status_code != 200:
+            return None
+        vector = response.json().get('embedding')
+        with self._lock:
+            if len(self._embeddings) > 1024:
+                self._embeddings.clear()
+            self._embeddings[clave] = vector
+        return vector
+
+    def _similitudes(self, mensaje, agentes):
+        """Similitud de embeddings mensaje-perfil por agente, o {} si no hay modelo"""
+        if not ENRUTADO_EMBEDDINGS_MODELO:
+            return {}
+        try:
+            vector = self._embedding(mensaje)
+            if not vector:
+                return {}
+            similitudes = {}
+            for agente in agentes:
+                perfil = self._embedding(f"{agente.nombre}. {agente.rol}. {agente.prompt}")
+                if perfil:
+                    similitudes[agente.id] = _coseno(vector, perfil)
+            return similitudes
+        except Exception as e:
+            print(f"⚠️ Embeddings para enrutado no disponibles: {e}")
+            return {}
+
+    def elegir(self, mensaje, agentes, top_k=None):
+        """Devolver (agentes elegidos, decisión) para un mensaje de sala"""
+        top_k = ENRUTADO_TOP_K if top_k is None else top_k
+        decision = {'topK': top_k, 'candidatos': [a.id for a in agentes]}
+
+        # Menciones explícitas: solo responden los mencionados
+        menciones = _menciones(mensaje)
+        if menciones & MENCIONES_TODOS:
+            elegidos, decision['modo'] = list(agentes), 'menciones'
+        elif menciones:
+            elegidos = [a for a in agentes if _alias(a) & menciones]
+            decision['modo'] = 'menciones' if elegidos else None
+        else:
+            elegidos = []
+            decision['modo'] = None
+
+        if decision['modo'] is None:
+            if not top_k or len(agentes) <= top_k:
+                elegidos, decision['modo'] = list(agentes), 'todos'
+            else:
+                elegidos = self._por_relevancia(mensaje, agentes, top_k, decision)
+
+        decision['elegidos'] = [a.id for a in elegidos]
+        with self._lock:
+            self.mensajes += 1
+            self.agentes_candidatos += len(agentes)
+            self.agentes_elegidos += len(elegidos)
+        return elegidos, decision
+
+    def _por_relevancia(self, mensaje, agentes, top_k, decision):
+        raices = _raices(mensaje)
+        similitudes = self._similitudes(mensaje, agentes)
+        puntuaciones = {}
+        for agente in agentes:
+            puntuacion = (PESO_ROL * len(raices & _raices(agente.rol))
+                          + PESO_NOMBRE * len(raices & _raices(agente.nombre))
+                          + PESO_PROMPT * len(raices & _raices(agente.prompt)))
+            puntuacion += ENRUTADO_EMBEDDINGS_PESO * similitudes.get(agente.id, 0.0)
+            puntuaciones[agente.id] = round(puntuacion, 3)
+
+        # Orden estable: a igual puntuación se respeta el orden de la sala
+        ordenados = sorted(agentes, key=lambda a: -puntuaciones[a.id])
+        relevantes = [a for a in ordenados if puntuaciones[a.id] > 0][:top_k]
+        decision['puntuaciones'] = puntuaciones
+        decision['embeddings'] = bool(similitudes)
+        if relevantes:
+            decision['modo'] = 'relevancia'
+            return relevantes
+        # Ninguna señal: responden los primeros top_k de la sala
+        decision['modo'] = 'sin_coincidencias'
+        return ordenados[:top_k]
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'topK': ENRUTADO_TOP_K,
+                'embeddingsModelo': ENRUTADO_EMBEDDINGS_MODELO or None,
+                'mensajes': self.mensajes,
+                'agentesCandidatos': self.agentes_candidatos,
+                'agentesElegidos': self.agentes_elegidos,
+                'llamadasEvitadas': self.agentes_candidatos - self.agentes_elegidos
+            }
+
+enrutador_sala = EnrutadorSala()
@@ -0,0 +1,230 @@
+import json
+import os
+import threading
+import types
+from datetime import datetime
+from flask import current_app
+from src.models.sala import db, Mensaje, ConocimientoSala
+from src.models.agente import Agente, Conversacion
+from src.services.concurrencia import enviar
+from src.services.admision import inquilino, como_inquilino, LOTE
+
+# Historial de conversación con presupuesto de tokens. Antes de generar se
+# añaden al mensaje los turnos recientes que caben en el presupuesto del
+# agente; los turnos antiguos de una sala se resumen de forma incremental en
+# un ConocimientoSala de tipo 'resumen', así el prompt no crece con la sala.
+
+HISTORIAL_MAX_TOKENS = int(os.getenv('HISTORIAL_MAX_TOKENS', '1500'))  # 0 = sin historial
+HISTORIAL_VENTANA = int(os.getenv('HISTORIAL_VENTANA', '12'))
+RESUMEN_LOTE = int(os.getenv('HISTORIAL_RESUMEN_LOTE', '20'))
+RESUMEN_MAX_TOKENS = int(os.getenv('HISTORIAL_RESUMEN_MAX_TOKENS', '300'))
+RESUMEN_MODELO = os.getenv('HISTORIAL_RESUMEN_MODELO')  # None = modelo del agente
+
+# Ventana de contexto aproximada por modelo (tokens)
+VENTANAS_CONTEXTO = {
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'claude': 200000,
+    'gemini': 32768,
+    'ollama:': 2048,
+    'lmstudio:': 4096,
+    'localai:': 4096
+}
+
+PROMPT_RESUMEN = (
+    "Eres un asistente que mantiene el resumen de una conversación de grupo. "
+    "Actualiza el resumen con los mensajes nuevos conservando decisiones, datos "
+    "y tareas pendientes. Responde solo con el resumen, en pocas frases."
+)
+
+def estimar_tokens(texto):
+    """Estimación rápida (unos 4 caracteres por token)"""
+    return len(texto or '') // 4 + 1
+
+def ventana_contexto(modelo):
+    for prefijo, ventana in VENTANAS_CONTEXTO.items():
+        if modelo.startswith(prefijo):
+            return ventana
+    return 4096
+
+def presupuesto_historial(agente, mensaje):
+    """Tokens disponibles para historial sin invadir la respuesta ni el prompt"""
+    libre = (ventana_contexto(agente.modelo) - (agente.max_tokens or 0)
+             - estimar_tokens(agente.prompt) - estimar_tokens(mensaje) - 64)
+    return max(0, min(HISTORIAL_MAX_TOKENS, libre))
+
+def componer_mensaje(mensaje, lineas, resumen=None):
+    """Mensaje final con resumen y turnos recientes delante del mensaje actual"""
+    if not lineas and not resumen:
+        return mensaje
+    partes = []
+    if resumen:
+        partes.append(f"Resumen de la conversación anterior:\n{resumen}")
+    if lineas:
+        partes.append("Conversación reciente:\n" + "\n".join(lineas))
+    partes.append(f"Mensaje actual:\n{mensaje}")
+    return "\n\n".join(partes)
+
+def _ajustar(lineas, presupuesto):
+    """Quedarse con las líneas más recientes que caben (lineas de más antigua a más nueva)"""
+    elegidas = []
+    usados = 0
+    for linea in reversed(lineas):
+        coste = estimar_tokens(linea)
+        if usados + coste > presupuesto:
+            break
+        elegidas.append(linea)
+        usados += coste
+    return list(reversed(elegidas))
+
+def _linea_mensaje(mensaje, nombres):
+    """Texto de un Mensaje de sala para el historial, o None si no aporta"""
+    metadatos = json.loads(mensaje.metadatos) if mensaje.metadatos else {}
+    if mensaje.tipo == 'usuario':
+        return f"{metadatos.get('usuario', 'Usuario')}: {mensaje.texto}"
+    if mensaje.tipo == 'agente' and not metadatos.get('timeout') and not metadatos.get('error'):
+        return f"{nombres.get(mensaje.agente_id, 'Agente')}: {mensaje.texto}"
+    return None
+
+class HistorialSala:
+    """Historial de una sala cargado una vez por petición y recortado por agente"""
+
+    def __init__(self, sala_id):
+        self.sala_id = sala_id
+        self.resumen = resumen_sala(sala_id)
+        desde = _metadatos(self.resumen).get('hastaMensajeId', 0) if self.resumen else 0
+
+        mensajes = (Mensaje.query
+                    .filter(Mensaje.sala_id == sala_id, Mensaje.id > desde)
+                    .order_by(Mensaje.id.desc())
+                    .limit(HISTORIAL_VENTANA + RESUMEN_LOTE * 2)
+                    .all())
+        mensajes.reverse()
+        ids_agentes = {m.agente_id for m in mensajes if m.agente_id}
+        nombres = {a.id: a.nombre for a in Agente.query.filter(Agente.id.in_(ids_agentes)).all()} if ids_agentes else {}
+
+        self.pendientes = len(mensajes)
+        self.primer_id = mensajes[0].id if mensajes else None
+        self.lineas = [linea for linea in (_linea_mensaje(m, nombres) for m in mensajes) if linea]
+
+    def mensaje_para(self, agente, mensaje):
+        """Mensaje con el historial que cabe en el presupuesto de este agente"""
+        if not HISTORIAL_MAX_TOKENS:
+            return mensaje
+        resumen = self.resumen.contenido if self.resumen else None
+        presupuesto = presupuesto_historial(agente, mensaje)
+        if resumen:
+            presupuesto -= estimar_tokens(resumen)
+        return componer_mensaje(mensaje, _ajustar(self.lineas, max(presupuesto, 0)), resumen)
+
+    def necesita_resumen(self):
+        return bool(HISTORIAL_MAX_TOKENS) and self.pendientes >= HISTORIAL_VENTANA + RESUMEN_LOTE
+
+def historial_chat(agente, usuario, sala_id=None, mensaje='', canal='web'):
+    """Mensaje con los turnos anteriores del chat directo del agente con el usuario
+    en el canal indicado (el mismo nombre en web y Telegram no es la misma persona)"""
+    if not HISTORIAL_MAX_TOKENS:
+        return mensaje
+    conversaciones = (Conversacion.query
+                      .filter_by(agente_id=agente.id, usuario=usuario, sala_id=sala_id, canal=canal)
+                      .order_by(Conversacion.id.desc())
+                      .limit(HISTORIAL_VENTANA)
+                      .all())
+    lineas = []
+    for conversacion in reversed(conversaciones):
+        lineas.append(f"{usuario}: {conversacion.mensaje_usuario}")
+        lineas.append(f"{agente.nombre}: {conversacion.respuesta_agente}")
+    return componer_mensaje(mensaje, _ajustar(lineas, presupuesto_historial(agente, mensaje)))
+
+def _metadatos(conocimiento):
+    return json.loads(conocimiento.metadatos) if conocimiento and conocimiento.metadatos else {}
+
+def resumen_sala(sala_id):
+    return (ConocimientoSala.query
+            .filter_by(sala_id=sala_id, tipo='resumen')
+            .order_by(ConocimientoSala.id.desc())
+            .first())
+
+# --- Resúmenes incrementales en segundo plano ---
+
+_salas_resumiendo = set()
+_lock_resumen = threading.Lock()
+
+def programar_resumen(sala_id, modelo):
+    """Lanzar la actualización del resumen de la sala si no hay otra en curso"""
+    with _lock_resumen:
+        if sala_id in _salas_resumiendo:
+            return
+        _salas_resumiendo.add(sala_id)
+    app = current_app._get_current_object()
+    enviar(_actualizar_resumen, app, sala_id, RESUMEN_MODELO or modelo)
+
+def _actualizar_resumen(app, sala_id, modelo):
+    try:
+        # Los resúmenes son trabajo de lote: ceden el turno a los chats interactivos
+        with app.app_context(), como_inquilino(inquilino(sala_id), LOTE):
+            while True:
+                historial = HistorialSala(sala_id)
+                if not historial.necesita_resumen():
+                    break
+                _resumir_lote(sala_id, historial, modelo)
+    except Exception as e:
+        print(f"⚠️ Error actualizando resumen de la sala {sala_id}: {e}")
+    finally:
+        with _lock_resumen:
+            _salas_resumiendo.discard(sala_id)
+
+def _resumir_lote(sala_id, historial, modelo):
+    """Incorporar al resumen los RESUMEN_LOTE mensajes más antiguos sin resumir.
+
+    Solo se consideran los mensajes cargados en el historial, así una sala
+    con mucho historial previo no obliga a resumirlo entero.
+    """
+    resumen = historial.resumen
+    metadatos = _metadatos(resumen)
+    mensajes = (Mensaje.query
+                .filter(Mensaje.sala_id == sala_id, Mensaje.id >= historial.primer_id)
+                .order_by(Mensaje.id.asc())
+                .limit(RESUMEN_LOTE)
+                .all())
+    ids_agentes = {m.agente_id for m in mensajes if m.agente_id}
+    nombres = {a.id: a.nombre for a in Agente.query.filter(Agente.id.in_(ids_agentes)).all()} if ids_agentes else {}
+    lineas = [linea for linea in (_linea_mensaje(m, nombres) for m in mensajes) if linea]
+
+    anterior = resumen.contenido if resumen else ''
+    contenido = resumir(anterior, lineas, modelo) if lineas else anterior
+
+    metadatos.update({
+        'hastaMensajeId': mensajes[-1].id,
+        'mensajesResumidos': metadatos.get('mensajesResumidos', 0) + len(mensajes),
+        'modelo': modelo,
+        'actualizado': datetime.utcnow().isoformat()
+    })
+    if resumen is None:
+        resumen = ConocimientoSala(sala_id=sala_id, tipo='resumen', contenido=contenido)
+        db.session.add(resumen)
+    resumen.contenido = contenido
+    resumen.metadatos = json.dumps(metadatos)
+    db.session.commit()
+
+def resumir(resumen_anterior, lineas, modelo):
+    """Nuevo resumen a partir del anterior y de los mensajes nuevos"""
+    from src.routes.agentes import generar_respuesta_proveedor
+
+    mensaje = (f"Resumen actual:\n{resumen_anterior or '(vacío)'}\n\n"
+               f"Mensajes nuevos:\n" + "\n".join(lineas))
+    resumidor = types.SimpleNamespace(
+        id=None, modelo=modelo, prompt=PROMPT_RESUMEN,
+        temperatura=0.2, max_tokens=RESUMEN_MAX_TOKENS
+    )
+    try:
+        texto = generar_respuesta_proveedor(mensaje, resumidor)
+        if texto and texto.strip():
+            return texto.strip()
+    except Exception as e:
+        print(f"⚠️ Resumen con {modelo} no disponible, se usa un resumen extractivo: {e}")
+
+    # Resumen extractivo: el principio de cada mensaje, conservando lo más reciente
+    extracto = "\n".join(linea[:160] for linea in lineas)
+    texto = f"{resumen_anterior}\n{extracto}".strip()
+    return texto[-RESUMEN_MAX_TOKENS * 4:]
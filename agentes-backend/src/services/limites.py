@@ -0,0 +1,239 @@
+import hashlib
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from src.services import proveedores
+from src.services.proveedores import SaturacionProveedor, PlazoAgotado
+from src.services.plazos import restante
+from src.services.admision import control_admision
+
+# Límites de las APIs en la nube (OpenAI, Anthropic) aplicados en el cliente:
+# un cubo de peticiones/minuto y otro de tokens/minuto por API key. Las
+# peticiones esperan su turno en lugar de recibir un 429, y si aun así llega
+# uno se reintenta con backoff con jitter respetando Retry-After.
+
+LIMITES_RPM = {
+    'openai': int(os.getenv('OPENAI_RPM', '500')),
+    'anthropic': int(os.getenv('ANTHROPIC_RPM', '50'))
+}
+LIMITES_TPM = {
+    'openai': int(os.getenv('OPENAI_TPM', '30000')),
+    'anthropic': int(os.getenv('ANTHROPIC_TPM', '40000'))
+}
+LIMITE_REINTENTOS = int(os.getenv('LIMITE_REINTENTOS', '3'))
+LIMITE_BACKOFF_BASE = float(os.getenv('LIMITE_BACKOFF_BASE', '1'))
+LIMITE_BACKOFF_MAX = float(os.getenv('LIMITE_BACKOFF_MAX', '30'))
+LIMITE_ESPERA_MAX = float(os.getenv('LIMITE_ESPERA_MAX', '60'))
+
+# 529 es la respuesta de Anthropic cuando está sobrecargado
+CODIGOS_REINTENTABLES = (429, 529)
+
+def estimar_tokens_peticion(*textos, max_tokens=0):
+    """Tokens que consumirá la petición: entrada estimada más la salida máxima"""
+    return sum(len(texto or '') // 4 + 1 for texto in textos) + (max_tokens or 0)
+
+def _api_key(headers):
+    cabeceras = {k.lower(): v for k, v in (headers or {}).items()}
+    return cabeceras.get('x-api-key') or cabeceras.get('authorization', '').replace('Bearer ', '')
+
+def _retry_after(response):
+    """Segundos indicados por retry-after-ms o Retry-After (número o fecha HTTP), o None"""
+    try:
+        if response.headers.get('retry-after-ms'):
+            return float(response.headers['retry-after-ms']) / 1000
+        valor = response.headers.get('Retry-After')
+        if not valor:
+            return None
+        try:
+            return max(float(valor), 0)
+        except ValueError:
+            return max(parsedate_to_datetime(valor).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+class CuboTokens:
+    """Cubo que se rellena a `por_minuto` unidades por minuto"""
+
+    def __init__(self, por_minuto):
+        self.capacidad = por_minuto
+        self.ritmo = por_minuto / 60
+        self.nivel = float(por_minuto)
+        self.actualizado = time.monotonic()
+
+    def _rellenar(self, ahora):
+        self.nivel = min(self.capacidad, self.nivel + (ahora - self.actualizado) * self.ritmo)
+        self.actualizado = ahora
+
+    def reservar(self, cantidad, ahora):
+        """Consumir `cantidad` (puede quedar en deuda); devuelve los segundos a esperar"""
+        self._rellenar(ahora)
+        # Una petición mayor que el cubo entero no debe bloquearse para siempre
+        self.nivel -= min(cantidad, self.capacidad)
+        return 0 if self.nivel >= 0 else -self.nivel / self.ritmo
+
+    def devolver(self, cantidad, ahora):
+        self._rellenar(ahora)
+        self.nivel = min(self.capacidad, self.nivel + cantidad)
+
+class LimitadorClave:
+    """Cubos RPM/TPM de una API key con sus métricas de espera"""
+
+    def __init__(self, proveedor, huella, rpm, tpm):
+        self.proveedor = proveedor
+        self.huella = huella
+        self.peticiones = CuboTokens(rpm) if rpm else None
+        self.tokens = CuboTokens(tpm) if tpm else None
+        self.pausa_hasta = 0
+        self._lock = threading.Lock()
+        self.total_peticiones = 0
+        self.esperadas = 0
+        self.segundos_espera = 0.0
+        self.limitadas = 0
+        self.segundos_backoff = 0.0
+        self.rechazadas = 0
+
+    def reservar(self, tokens, espera_max=LIMITE_ESPERA_MAX):
+        """Reservar una petición y sus tokens; devuelve los segundos a esperar"""
+        with self._lock:
+            ahora = time.monotonic()
+            espera = max(self.pausa_hasta - ahora, 0)
+            if self.peticiones:
+                espera = max(espera, self.peticiones.reservar(1, ahora))
+            if self.tokens:
+                espera = max(espera, self.tokens.reservar(tokens, ahora))
+            if espera > espera_max:
+                # Demasiada cola: deshacer la reserva y rechazar
+                if self.peticiones:
+                    self.peticiones.devolver(1, ahora)
+                if self.tokens:
+                    self.tokens.devolver(tokens, ahora)
+                self.rechazadas += 1
+                return espera, False
+            self.total_peticiones += 1
+            if espera:
+                # La parte de la espera que impone la pausa de un 429 cuenta como backoff
+                backoff = min(max(self.pausa_hasta - ahora, 0), espera)
+                self.esperadas += 1
+                self.segundos_backoff += backoff
+                self.segundos_espera += espera - backoff
+            return espera, True
+
+    def ajustar(self, estimados, reales):
+        """Corregir el cubo de tokens con el uso real informado por la API"""
+        if self.tokens and reales is not None:
+            with self._lock:
+                self.tokens.devolver(estimados - reales, time.monotonic())
+
+    def pausar(self, segundos, tokens=0):
+        """Tras un 429 ninguna petición de esta clave sale antes de `segundos`.
+
+        Los `tokens` reservados para la petición rechazada se devuelven al cubo:
+        el reintento los vuelve a reservar.
+        """
+        with self._lock:
+            ahora = time.monotonic()
+            self.limitadas += 1
+            if self.tokens and tokens:
+                self.tokens.devolver(tokens, ahora)
+            self.pausa_hasta = max(self.pausa_hasta, ahora + segundos)
+
+    def estadisticas(self):
+        with self._lock:
+            ahora = time.monotonic()
+            for cubo in (self.peticiones, self.tokens):
+                if cubo:
+                    cubo._rellenar(ahora)
+            return {
+                'proveedor': self.proveedor,
+                'clave': self.huella,
+                'rpm': self.peticiones.capacidad if self.peticiones else None,
+                'tpm': self.tokens.capacidad if self.tokens else None,
+                'peticionesDisponibles': round(self.peticiones.nivel, 1) if self.peticiones else None,
+                'tokensDisponibles': round(self.tokens.nivel) if self.tokens else None,
+                'peticiones': self.total_peticiones,
+                'esperadas': self.esperadas,
+                'segundosEspera': round(self.segundos_espera, 3),
+                'limitadas429': self.limitadas,
+                'segundosBackoff': round(self.segundos_backoff, 3),
+                'rechazadas': self.rechazadas
+            }
+
+class LimitesApi:
+    def __init__(self):
+        self._limitadores = {}
+        self._lock = threading.Lock()
+
+    def limitador(self, proveedor, api_key):
+        """Limitador de la API key (las claves se identifican por su hash)"""
+        if proveedor not in LIMITES_RPM:
+            return None
+        huella = hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:12]
+        with self._lock:
+            limitador = self._limitadores.get((proveedor, huella))
+            if limitador is None:
+                limitador = LimitadorClave(proveedor, huella, LIMITES_RPM[proveedor], LIMITES_TPM[proveedor])
+                self._limitadores[(proveedor, huella)] = limitador
+            return limitador
+
+    def post(self, proveedor, ruta, tokens, **kwargs):
+        """POST al proveedor respetando sus límites y reintentando los 429.
+
+        Devuelve la respuesta (con cualquier otro código) o lanza
+        SaturacionProveedor si se agotan los reintentos o la espera.
+        """
+        limitador = self.limitador(proveedor, _api_key(kwargs.get('headers')))
+        if limitador is None:
+            return proveedores.post(proveedor, ruta, **kwargs)
+
+        for intento in range(LIMITE_REINTENTOS + 1):
+            # Con plazo de petición no se espera turno más allá de él
+            tiempo = restante()
+            por_plazo = tiempo is not None and tiempo < LIMITE_ESPERA_MAX
+            espera_max = max(tiempo, 0) if por_plazo else LIMITE_ESPERA_MAX
+            espera, admitida = limitador.reservar(tokens, espera_max)
+            if not admitida:
+                if por_plazo:
+                    # El turno llegaría después del plazo del cliente
+                    raise PlazoAgotado(proveedor)
+                raise SaturacionProveedor(
+                    f"Límite de {proveedor} alcanzado, la espera superaría {espera_max:.0f} s",
+                    proveedor, 429, max(1, round(espera))
+                )
+            if espera:
+                # Sin ocupar el hueco de admisión mientras se espera turno del límite
+                with control_admision.ceder():
+                    time.sleep(espera)
+
+            response = proveedores.post(proveedor, ruta, **kwargs)
+            if response.status_code not in CODIGOS_REINTENTABLES:
+                return response
+
+            # Backoff exponencial con jitter completo; Retry-After manda si viene
+            retry_after = _retry_after(response)
+            response.close()
+            backoff = random.uniform(0, min(LIMITE_BACKOFF_MAX, LIMITE_BACKOFF_BASE * 2 ** intento))
+            limitador.pausar(retry_after if retry_after is not None else backoff, tokens)
+
+        raise SaturacionProveedor(
+            f"{proveedor} sigue limitando las peticiones tras {LIMITE_REINTENTOS} reintentos",
+            proveedor, 429, max(1, round(retry_after if retry_after is not None else LIMITE_BACKOFF_BASE))
+        )
+
+    def ajustar(self, proveedor, headers, estimados, reales):
+        limitador = self.limitador(proveedor, _api_key(headers))
+        if limitador is not None:
+            limitador.ajustar(estimados, reales)
+
+    def estadisticas(self):
+        with self._lock:
+            limitadores = list(self._limitadores.values())
+        return {
+            'reintentosMax': LIMITE_REINTENTOS,
+            'esperaMaxSegundos': LIMITE_ESPERA_MAX,
+            'claves': [limitador.estadisticas() for limitador in limitadores],
+            'segundosLimitadoTotal': round(sum(l.segundos_espera + l.segundos_backoff for l in limitadores), 3)
+        }
+
+limites_api = LimitesApi()
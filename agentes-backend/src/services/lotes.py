@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from src.models.user import db
+from src.models.lote import Lote, ElementoLote
+from src.services.proveedores import SaturacionProveedor, proveedor_de_modelo
+from src.services.admision import control_admision, stream_como_inquilino, LOTE, MAX_POR_INQUILINO
+from src.services.concurrencia import completar_en_ventana
+from src.services.respaldo import modelo_de
+
+# Generación por lotes: una lista de prompts contra un modelo o un agente. Los
+# elementos se guardan en SQLite y se generan en paralelo sin superar lo que
+# admite el proveedor; cada resultado se guarda al llegar, así que un lote
+# cortado (cliente desconectado, reinicio) se reanuda por su ID generando
+# solo lo que falta.
+
+LOTE_MAX_PROMPTS = int(os.getenv('LOTE_MAX_PROMPTS', '500'))
+LOTE_CONCURRENCIA = int(os.getenv('LOTE_CONCURRENCIA', '0'))  # 0 = lo que admita el proveedor
+LOTE_INTENTOS_MAX = int(os.getenv('LOTE_INTENTOS_MAX', '3'))
+LOTE_CONCESION_SEGUNDOS = int(os.getenv('LOTE_CONCESION_SEGUNDOS', '300'))
+
+def inquilino_lote(lote_id):
+    """Inquilino del reparto justo para las generaciones de un lote"""
+    return f'lote:{lote_id}'
+
+def concurrencia_lote(modelo, solicitada=None):
+    """Elementos del lote en curso a la vez: nunca más de los que admite el proveedor"""
+    limites = [control_admision.limite_proveedor(proveedor_de_modelo(modelo) or modelo)]
+    for limite in (control_admision.limite_modelo(modelo), MAX_POR_INQUILINO, LOTE_CONCURRENCIA, solicitada):
+        if limite:
+            limites.append(int(limite))
+    return max(min(limites), 1)
+
+class GestorLotes:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._en_curso = set()
+        self.creados = 0
+        self.reanudados = 0
+        self.completados = 0
+        self.errores = 0
+        self.reintentos = 0
+
+    def crear(self, prompts, modelo=None, agente_id=None, usuario=None, **parametros):
+        """Guardar un lote nuevo con un elemento pendiente por prompt"""
+        lote = Lote(
+            estado='en_curso',  # Recién creado: lo genera quien lo crea
+            modelo=modelo,
+            agente_id=agente_id,
+            usuario=usuario,
+            parametros=json.dumps(parametros),
+            total=len(prompts)
+        )
+        lote.elementos = [ElementoLote(indice=indice, prompt=prompt) for indice, prompt in enumerate(prompts)]
+        db.session.add(lote)
+        db.session.commit()
+        with self._lock:
+            self.creados += 1
+        return lote
+
+    def reclamar(self, lote_id):
+        """Marcar el lote como en curso si nadie lo está generando.
+
+        El UPDATE condicional hace que de dos reanudaciones simultáneas (del
+        mismo proceso o de otro) solo gane una. Un lote en curso que lleva
+        LOTE_CONCESION_SEGUNDOS sin guardar resultados se da por abandonado.
+        """
+        ahora = datetime.utcnow()
+        caducidad = ahora - timedelta(seconds=LOTE_CONCESION_SEGUNDOS)
+        reclamado = Lote.query.filter(
+            Lote.id == lote_id,
+            db.or_(Lote.estado != 'en_curso', Lote.fecha_actualizacion < caducidad)
+        ).update({'estado': 'en_curso', 'fecha_actualizacion': ahora}, synchronize_session=False)
+        db.session.commit()
+        return bool(reclamado)
+
+    def _generar(self, generar, prompt):
+        """Generar un elemento; si el proveedor está saturado se devuelve como tal
+        para reintentarlo en la siguiente ronda (no se espera en el executor)"""
+        try:
+            return {'respuesta': generar(prompt)}
+        except SaturacionProveedor as e:
+            return {'saturado': str(e), 'reintentarEn': e.reintentar_en}
+
+    def ejecutar(self, lote, generar, concurrencia, formatear, reanudar=False, reintentar_errores=False):
+        """Generador de eventos del lote: los resultados ya guardados (al reanudar),
+        uno por elemento según termina y 'fin' con el recuento. El lote debe
+        estar reclamado (recién creado o con `reclamar`).
+
+        `generar(prompt)` devuelve la respuesta o lanza una excepción;
+        `formatear(evento, datos)` convierte cada evento al formato de salida.
+        """
+        with self._lock:
+            self._en_curso.add(lote.id)
+            if reanudar:
+                self.reanudados += 1
+
+        try:
+            estados = ('pendiente', 'error') if reintentar_errores else ('pendiente',)
+            pendientes = {elemento.indice: elemento for elemento in lote.elementos if elemento.estado in estados}
+            yield formatear('lote', lote.to_dict())
+
+            if reanudar:
+                for elemento in lote.elementos:
+                    if elemento.indice not in pendientes:
+                        yield formatear('resultado', {**elemento.to_dict(), 'previo': True})
+
+            # Por rondas: los elementos que encuentran el proveedor saturado se
+            # reintentan en la siguiente, tras el Retry-After más largo
+            for intento in range(1, LOTE_INTENTOS_MAX + 1):
+                tareas = ((indice, self._generar, (generar, elemento.prompt)) for indice, elemento in pendientes.items())
+                resultados = stream_como_inquilino(
+                    completar_en_ventana(tareas, concurrencia), inquilino_lote(lote.id), LOTE
+                )
+                saturados = {}
+                espera = 0
+                for indice, resultado in resultados:
+                    salida = resultado['resultado'] or {}
+                    if salida.get('saturado') and intento < LOTE_INTENTOS_MAX:
+                        saturados[indice] = pendientes[indice]
+                        espera = max(espera, salida['reintentarEn'])
+                        continue
+                    # Sigue pendiente si estaba saturado en la última ronda: se generará al reanudar
+                    elemento = self._guardar(pendientes[indice], resultado, lote.modelo, intento)
+                    yield formatear('resultado', elemento.to_dict())
+                if not saturados:
+                    break
+                with self._lock:
+                    self.reintentos += len(saturados)
+                pendientes = saturados
+                time.sleep(espera)
+
+            self.cerrar(lote)
+            yield formatear('fin', lote.to_dict())
+        finally:
+            # También si el cliente corta el stream: lo que falte queda pendiente
+            self.cerrar(lote)
+            with self._lock:
+                self._en_curso.discard(lote.id)
+
+    def cerrar(self, lote):
+        """Soltar el lote: completado si no falta nada, parcial si queda por generar"""
+        conteo = lote.recuento()
+        lote.estado = 'completado' if conteo['completado'] == lote.total else 'parcial'
+        db.session.commit()
+
+    def _guardar(self, elemento, resultado, modelo, intentos):
+        salida = resultado['resultado'] or {}
+        elemento.intentos = (elemento.intentos or 0) + intentos
+        elemento.duracion_ms = resultado['duracionMs']
+        if resultado['estado'] == 'ok' and salida.get('respuesta'):
+            elemento.estado = 'completado'
+            elemento.respuesta = salida['respuesta']
+            elemento.modelo = modelo_de(salida['respuesta'], modelo)
+            elemento.error = None
+        elif salida.get('saturado'):
+            elemento.estado = 'pendiente'
+            elemento.error = salida['saturado']
+        else:
+            elemento.estado = 'error'
+            elemento.error = resultado['error'] or 'No se pudo generar respuesta'
+        elemento.fecha_fin = datetime.utcnow()
+        # Cada resultado renueva la concesión del lote
+        elemento.lote.fecha_actualizacion = elemento.fecha_fin
+        db.session.commit()
+        with self._lock:
+            if elemento.estado == 'completado':
+                self.completados += 1
+            elif elemento.estado == 'error':
+                self.errores += 1
+        return elemento
+
+    def estadisticas(self):
+        estados = dict(db.session.query(Lote.estado, db.func.count(Lote.id)).group_by(Lote.estado).all())
+        with self._lock:
+            return {
+                'maxPrompts': LOTE_MAX_PROMPTS,
+                'concurrencia': LOTE_CONCURRENCIA or 'proveedor',
+                'intentosMax': LOTE_INTENTOS_MAX,
+                'concesionSegundos': LOTE_CONCESION_SEGUNDOS,
+                'enCurso': len(self._en_curso),
+                'lotes': estados,
+                'creados': self.creados,
+                'reanudados': self.reanudados,
+                'elementosCompletados': self.completados,
+                'elementosConError': self.errores,
+                'reintentosSaturacion': self.reintentos
+            }
+
+gestor_lotes = GestorLotes()
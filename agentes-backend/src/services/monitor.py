@@ -0,0 +1,177 @@
+import os
+import platform
+import re
+import subprocess
+import threading
+import time
+from urllib.parse import urlsplit
+from src.services import proveedores
+
+# Monitor de servicios locales en segundo plano. Cada pocos segundos revisa
+# los procesos (leyendo /proc cuando existe, sin lanzar pgrep) y sondea la
+# API de cada nodo de cada servicio; los endpoints responden desde esta
+# instantánea.
+
+INTERVALO_MONITOR = float(os.getenv('MONITOR_SERVICIOS_INTERVALO', '5'))
+
+PATRONES_PROCESOS = {
+    'ollama': re.compile(r'ollama', re.IGNORECASE),
+    'lmstudio': re.compile(r'lm.studio', re.IGNORECASE),
+    'localai': re.compile(r'local-?ai', re.IGNORECASE)
+}
+
+RUTAS_SONDEO = {
+    'ollama': '/api/tags',
+    'lmstudio': '/v1/models',
+    'localai': '/v1/models'
+}
+
+def listar_procesos():
+    """Lista de (pid, línea de comandos) de los procesos del sistema"""
+    if os.path.isdir('/proc'):
+        return _procesos_proc()
+    return _procesos_comando()
+
+def _procesos_proc():
+    procesos = []
+    propio = os.getpid()
+    for entrada in os.listdir('/proc'):
+        if not entrada.isdigit() or int(entrada) == propio:
+            continue
+        try:
+            with open(f'/proc/{entrada}/cmdline', 'rb') as f:
+                linea = f.read().replace(b'\0', b' ').decode('utf-8', 'replace').strip()
+            if not linea:
+                # Hilos del kernel y procesos zombis no tienen cmdline
+                with open(f'/proc/{entrada}/comm', 'rb') as f:
+                    linea = f.read().decode('utf-8', 'replace').strip()
+        except OSError:
+            # El proceso terminó mientras se leía
+            continue
+        procesos.append((int(entrada), linea))
+    return procesos
+
+def _procesos_comando():
+    """Sin /proc (Windows, macOS): un único listado de procesos por ciclo"""
+    if platform.system().lower() == 'windows':
+        resultado = subprocess.run(['tasklist', '/FO', 'CSV', '/NH'], capture_output=True, text=True)
+        procesos = []
+        for linea in resultado.stdout.splitlines():
+            campos = [c.strip('"') for c in linea.split('","')]
+            if len(campos) > 1 and campos[1].isdigit():
+                procesos.append((int(campos[1]), campos[0]))
+        return procesos
+
+    resultado = subprocess.run(['ps', '-axo', 'pid=,command='], capture_output=True, text=True)
+    procesos = []
+    for linea in resultado.stdout.splitlines():
+        pid, _, comando = linea.strip().partition(' ')
+        if pid.isdigit():
+            procesos.append((int(pid), comando.strip()))
+    return procesos
+
+def _contenedor_localai():
+    """LocalAI en Docker Desktop no aparece entre los procesos del host"""
+    try:
+        resultado = subprocess.run(['docker', 'ps', '--filter', 'name=localai', '-q'],
+                                   capture_output=True, text=True, timeout=5)
+        return bool(resultado.stdout.strip())
+    except Exception:
+        return False
+
+def _sondear(servicio, url):
+    """Estado de un nodo: se sondea su URL completa, sin pasar por el reparto del pool"""
+    estado = {'url': url, 'activo': False, 'latenciaMs': None}
+    t0 = time.monotonic()
+    try:
+        response = proveedores.get(servicio, f'{url}{RUTAS_SONDEO[servicio]}', timeout=3)
+        estado['activo'] = response.status_code == 200
+        estado['latenciaMs'] = round((time.monotonic() - t0) * 1000, 1)
+    except Exception as e:
+        estado['error'] = str(e)
+    return estado
+
+class MonitorServicios:
+    def __init__(self, intervalo=INTERVALO_MONITOR):
+        self.intervalo = intervalo
+        self._servicios = {}
+        self._actualizado = None
+        self._duracion_ms = None
+        self._lock = threading.Lock()
+        self._hilo = None
+
+    def actualizar(self):
+        """Revisar procesos y sondear los servicios una vez"""
+        inicio = time.monotonic()
+        try:
+            procesos = listar_procesos()
+        except Exception as e:
+            print(f"⚠️ Error listando procesos: {e}")
+            procesos = []
+
+        servicios = {}
+        for servicio, patron in PATRONES_PROCESOS.items():
+            pids = [pid for pid, linea in procesos if patron.search(linea)]
+            if servicio == 'localai' and not pids and not os.path.isdir('/proc'):
+                proceso = _contenedor_localai()
+            else:
+                proceso = bool(pids)
+
+            nodos = [_sondear(servicio, url) for url in proveedores.CONFIG_PROVEEDORES[servicio]['urls']]
+            activos = [nodo for nodo in nodos if nodo['activo']]
+            # El servicio está activo si responde algún nodo; el resumen es el del primero que responde
+            principal = activos[0] if activos else nodos[0]
+            estado = {
+                'activo': bool(activos),
+                'puerto': urlsplit(principal['url']).port,
+                'proceso': proceso,
+                'pids': pids,
+                'latenciaMs': principal['latenciaMs'],
+                'nodos': nodos
+            }
+            if not activos and 'error' in principal:
+                estado['error'] = principal['error']
+            servicios[servicio] = estado
+
+        with self._lock:
+            self._servicios = servicios
+            self._actualizado = time.time()
+            self._duracion_ms = round((time.monotonic() - inicio) * 1000, 1)
+
+    def instantanea(self):
+        """Copia del último estado y su antigüedad; actualiza si aún no hay datos"""
+        if self._actualizado is None:
+            self.actualizar()
+        with self._lock:
+            return {
+                'servicios': {
+                    nombre: {**estado, 'nodos': [dict(nodo) for nodo in estado['nodos']]}
+                    for nombre, estado in self._servicios.items()
+                },
+                'actualizado': self._actualizado,
+                'edadSegundos': round(time.time() - self._actualizado, 2),
+                'duracionSondeoMs': self._duracion_ms,
+                'intervalo': self.intervalo
+            }
+
+    def pids(self, servicio):
+        """PIDs del servicio según la última revisión"""
+        return list(self.instantanea()['servicios'].get(servicio, {}).get('pids', []))
+
+    def iniciar(self):
+        """Arrancar el hilo de monitorización (una sola vez)"""
+        with self._lock:
+            if self._hilo is not None:
+                return
+            self._hilo = threading.Thread(target=self._bucle, name='monitor-servicios', daemon=True)
+            self._hilo.start()
+
+    def _bucle(self):
+        while True:
+            try:
+                self.actualizar()
+            except Exception as e:
+                print(f"⚠️ Error en monitor de servicios: {e}")
+            time.sleep(self.intervalo)
+
+monitor_servicios = MonitorServicios()
@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+import weakref
+from src.services.circuito import circuitos, CERRADO
+
+# Pool de nodos para los proveedores locales (Ollama, LM Studio, LocalAI)
+# repartidos en varias máquinas. Cada petición va al nodo sano con menos
+# peticiones en curso, salvo que el modelo ya esté "caliente" en un nodo:
+# entonces se mantiene en él mientras no esté mucho más cargado que el resto.
+# Los nodos con el circuito abierto salen de la rotación.
+
+NODOS_HOLGURA_AFINIDAD = int(os.getenv('NODOS_HOLGURA_AFINIDAD', '2'))
+
+class Nodo:
+    def __init__(self, proveedor, url):
+        self.proveedor = proveedor
+        self.url = url
+        self.en_curso = 0
+        self.peticiones = 0
+        self.modelos = set()
+        self._lock = threading.Lock()
+
+    @property
+    def sano(self):
+        return circuitos.circuito(self.url).estado == CERRADO
+
+    def empezar(self):
+        with self._lock:
+            self.en_curso += 1
+            self.peticiones += 1
+
+    def terminar(self):
+        with self._lock:
+            self.en_curso = max(self.en_curso - 1, 0)
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'sano': self.sano,
+            'enCurso': self.en_curso,
+            'peticiones': self.peticiones,
+            'modelos': sorted(self.modelos)
+        }
+
+class PoolNodos:
+    def __init__(self):
+        self._nodos = {}
+        self._afinidad = {}
+        self._lock = threading.Lock()
+        self.por_afinidad = 0
+        self.por_carga = 0
+
+    def configurar(self, proveedor, urls):
+        """Registrar las URLs de un proveedor (se llama al cargar la configuración)"""
+        with self._lock:
+            self._nodos[proveedor] = [Nodo(proveedor, url) for url in urls]
+
+    def nodos(self, proveedor):
+        return self._nodos.get(proveedor, [])
+
+    def nodo(self, proveedor, url):
+        for nodo in self.nodos(proveedor):
+            if nodo.url == url:
+                return nodo
+        return None
+
+    def nodo_de_url(self, proveedor, url):
+        """Nodo al que va una URL completa (p. ej. http://b:11434/api/ps), o None"""
+        for nodo in self.nodos(proveedor):
+            if url == nodo.url or url.startswith(f'{nodo.url}/'):
+                return nodo
+        return None
+
+    def registrar_modelos(self, proveedor, url, modelos):
+        """Modelos instalados en un nodo (los informa el catálogo)"""
+        nodo = self.nodo(proveedor, url)
+        if nodo is not None:
+            nodo.modelos = set(modelos)
+
+    def elegir(self, proveedor, modelo=None):
+        """Nodo para una petición: afinidad con el modelo o el menos cargado"""
+        nodos = self.nodos(proveedor)
+        candidatos = [n for n in nodos if n.sano] or nodos
+        if modelo:
+            # Solo los nodos que tienen el modelo, si alguno lo tiene
+            con_modelo = [n for n in candidatos if _tiene_modelo(n, modelo)]
+            candidatos = con_modelo or candidatos
+
+        menos_cargado = min(candidatos, key=lambda n: n.en_curso)
+        if modelo is None:
+            return menos_cargado
+
+        with self._lock:
+            preferido = self._afinidad.get((proveedor, modelo))
+            if (preferido in candidatos
+                    and preferido.en_curso <= menos_cargado.en_curso + NODOS_HOLGURA_AFINIDAD):
+                self.por_afinidad += 1
+                return preferido
+            # Primer uso del modelo, nodo caído o demasiado cargado: mover la afinidad
+            self._afinidad[(proveedor, modelo)] = menos_cargado
+            self.por_carga += 1
+            return menos_cargado
+
+    def olvidar_modelo(self, proveedor, modelo):
+        with self._lock:
+            self._afinidad.pop((proveedor, modelo), None)
+
+    def seguir_respuesta(self, nodo, response):
+        """Mantener el nodo ocupado hasta que se cierre una respuesta en streaming"""
+        liberar = _una_vez(nodo.terminar)
+        cerrar = response.close
+
+        def close():
+            liberar()
+            cerrar()
+
+        response.close = close
+        # Por si el stream se consume sin cerrar la respuesta
+        weakref.finalize(response, liberar)
+
+    def estadisticas(self):
+        with self._lock:
+            afinidad = {f"{p}:{m}": nodo.url for (p, m), nodo in self._afinidad.items()}
+        return {
+            'holguraAfinidad': NODOS_HOLGURA_AFINIDAD,
+            'porAfinidad': self.por_afinidad,
+            'porCarga': self.por_carga,
+            'afinidad': afinidad,
+            'proveedores': {p: [n.to_dict() for n in nodos] for p, nodos in self._nodos.items()}
+        }
+
+def clave_modelo(modelo):
+    """Nombre de modelo sin la etiqueta por defecto: llama2 y llama2:latest son
+    el mismo modelo y deben compartir afinidad de nodo"""
+    if modelo and modelo.endswith(':latest'):
+        return modelo[:-len(':latest')]
+    return modelo
+
+def _tiene_modelo(nodo, modelo):
+    # Ollama informa las etiquetas completas (llama2 -> llama2:latest)
+    return modelo in nodo.modelos or f'{modelo}:latest' in nodo.modelos
+
+def _una_vez(funcion):
+    hecho = threading.Lock()
+
+    def envoltura():
+        if hecho.acquire(blocking=False):
+            funcion()
+    return envoltura
+
+pool_nodos = PoolNodos()
@@ -0,0 +1,83 @@
+import contextvars
+import inspect
+import os
+import time
+from contextlib import contextmanager
+from flask import has_request_context, request, jsonify
+from src.services.concurrencia import iterar_en_contexto
+
+# Plazo de la petición propagado a toda la generación: lo fija la cabecera
+# X-Plazo-Ms o el plazo del agente, viaja en una variable de contexto (que
+# el pool de generación copia a sus hilos) y lo respetan las llamadas a los
+# proveedores, la espera de admisión y el reparto de las salas.
+
+CABECERA_PLAZO = 'X-Plazo-Ms'
+PLAZO_MAX_SEGUNDOS = float(os.getenv('PLAZO_MAX_SEGUNDOS', '600'))
+
+# Instante (time.monotonic) en que vence el plazo del contexto actual
+_limite = contextvars.ContextVar('limite_plazo', default=None)
+
+def plazo_agente(agente):
+    """Segundos de plazo configurados en el agente, o None"""
+    ms = getattr(agente, 'plazo_respuesta_ms', None)
+    return ms / 1000 if ms else None
+
+def plazo_solicitado(agente=None):
+    """Segundos de plazo de la petición: el menor entre la cabecera y el del agente"""
+    plazos = []
+    if has_request_context() and request.headers.get(CABECERA_PLAZO):
+        try:
+            plazos.append(max(float(request.headers[CABECERA_PLAZO]), 0) / 1000)
+        except ValueError:
+            pass
+    if plazo_agente(agente):
+        plazos.append(plazo_agente(agente))
+    return min(plazos) if plazos else None
+
+@contextmanager
+def con_plazo(segundos):
+    """Limitar la generación del bloque (y de los hilos que lance) a `segundos`.
+
+    Un plazo anidado nunca alarga el exterior.
+    """
+    if segundos is None:
+        yield
+        return
+    limite = time.monotonic() + min(segundos, PLAZO_MAX_SEGUNDOS)
+    actual = _limite.get()
+    token = _limite.set(limite if actual is None else min(actual, limite))
+    try:
+        yield
+    finally:
+        _limite.reset(token)
+
+def restante():
+    """Segundos que quedan del plazo actual (pueden ser negativos), o None"""
+    limite = _limite.get()
+    return None if limite is None else limite - time.monotonic()
+
+def agotado():
+    tiempo = restante()
+    return tiempo is not None and tiempo <= 0
+
+def respuesta_plazo_agotado(error):
+    """Respuesta HTTP 504 para una generación que no terminó dentro del plazo"""
+    return jsonify({
+        'error': str(error),
+        'proveedor': error.proveedor,
+        'plazoAgotado': True
+    }), error.codigo
+
+def limitar(funcion, segundos):
+    """Envolver una función (o una que devuelve un stream) para ejecutarla con plazo"""
+    if not segundos:
+        return funcion
+
+    def envoltura(*args, **kwargs):
+        with con_plazo(segundos):
+            contexto = contextvars.copy_context()
+        resultado = contexto.run(funcion, *args, **kwargs)
+        if inspect.isgenerator(resultado):
+            return iterar_en_contexto(resultado, contexto)
+        return resultado
+    return envoltura
@@ -0,0 +1,395 @@
+import contextvars
+import os
+import socket
+import threading
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from src.services.circuito import circuitos, PRUEBA
+from src.services.nodos import pool_nodos, clave_modelo
+from src.services.plazos import restante, agotado
+
+# Cliente HTTP compartido por todas las llamadas a proveedores de modelos.
+# Cada proveedor tiene su propia sesión con un pool de conexiones keep-alive,
+# así los mensajes a Ollama, LM Studio, OpenAI o Anthropic reutilizan TCP/TLS.
+
+def _entero_env(nombre, defecto):
+    try:
+        return int(os.getenv(nombre, defecto))
+    except (TypeError, ValueError):
+        return defecto
+
+def _decimal_env(nombre, defecto):
+    try:
+        return float(os.getenv(nombre, defecto))
+    except (TypeError, ValueError):
+        return defecto
+
+# Valores por defecto comunes (se pueden sobrescribir por proveedor)
+POOL_CONEXIONES = _entero_env('PROVEEDORES_POOL_CONEXIONES', 4)
+POOL_TAMANO = _entero_env('PROVEEDORES_POOL_TAMANO', 16)
+TIMEOUT_CONEXION = _decimal_env('PROVEEDORES_TIMEOUT_CONEXION', 3.05)
+TIMEOUT_LECTURA = _decimal_env('PROVEEDORES_TIMEOUT_LECTURA', 60)
+
+URLS_POR_DEFECTO = {
+    'ollama': 'http://localhost:11434',
+    'lmstudio': 'http://localhost:1234',
+    'localai': 'http://localhost:8080',
+    'openai': 'https://api.openai.com/v1',
+    'anthropic': 'https://api.anthropic.com',
+    'google': 'https://generativelanguage.googleapis.com'
+}
+
+# Variable de entorno con la URL base de cada proveedor
+VARIABLES_URL = {
+    'ollama': 'OLLAMA_URL',
+    'lmstudio': 'LMSTUDIO_URL',
+    'localai': 'LOCALAI_URL',
+    'openai': 'OPENAI_API_BASE',
+    'anthropic': 'ANTHROPIC_API_BASE',
+    'google': 'GOOGLE_API_BASE'
+}
+
+# Proveedores locales que pueden repartirse entre varios nodos (OLLAMA_URLS=http://a:11434,http://b:11434)
+PROVEEDORES_MULTINODO = ('ollama', 'lmstudio', 'localai')
+
+def _urls_configuradas(nombre):
+    url = os.getenv(VARIABLES_URL[nombre], URLS_POR_DEFECTO[nombre]).rstrip('/')
+    if nombre not in PROVEEDORES_MULTINODO:
+        return [url]
+    lista = [u.strip().rstrip('/') for u in os.getenv(f'{VARIABLES_URL[nombre]}S', '').split(',') if u.strip()]
+    return lista or [url]
+
+def _configurar_proveedor(nombre):
+    """Leer la configuración de pool y timeouts de un proveedor"""
+    prefijo = nombre.upper()
+    urls = _urls_configuradas(nombre)
+    return {
+        'url': urls[0],
+        'urls': urls,
+        'pool_conexiones': _entero_env(f'{prefijo}_POOL_CONEXIONES', POOL_CONEXIONES),
+        'pool_tamano': _entero_env(f'{prefijo}_POOL_TAMANO', POOL_TAMANO),
+        'timeout_conexion': _decimal_env(f'{prefijo}_TIMEOUT_CONEXION', TIMEOUT_CONEXION),
+        'timeout_lectura': _decimal_env(f'{prefijo}_TIMEOUT_LECTURA', TIMEOUT_LECTURA)
+    }
+
+CONFIG_PROVEEDORES = {nombre: _configurar_proveedor(nombre) for nombre in URLS_POR_DEFECTO}
+
+for _nombre in PROVEEDORES_MULTINODO:
+    if len(CONFIG_PROVEEDORES[_nombre]['urls']) > 1:
+        pool_nodos.configurar(_nombre, CONFIG_PROVEEDORES[_nombre]['urls'])
+
+class ErrorProveedor(Exception):
+    """Error de un proveedor con un mensaje apto para mostrar al usuario"""
+
+    def __init__(self, mensaje, proveedor=None, codigo=None):
+        super().__init__(mensaje)
+        self.proveedor = proveedor
+        self.codigo = codigo
+
+class SaturacionProveedor(ErrorProveedor):
+    """El proveedor no admite más peticiones en este momento"""
+
+    def __init__(self, mensaje, proveedor, codigo, reintentar_en):
+        super().__init__(mensaje, proveedor, codigo)
+        self.reintentar_en = reintentar_en
+
+class PlazoAgotado(ErrorProveedor):
+    """Se agotó el plazo de la petición antes de que respondiera el proveedor"""
+
+    def __init__(self, proveedor):
+        super().__init__(f"Plazo agotado esperando la respuesta de {proveedor}", proveedor, 504)
+
+# Conexiones cortables: quien abre un stream en otro hilo (p. ej. una carrera de
+# modelos de respaldo) registra las conexiones que usa para que, al cancelarlo,
+# se apague el socket y la lectura bloqueada termine en lugar de esperar al
+# siguiente token (o a las cabeceras) ocupando su hueco de admisión.
+_cortables = contextvars.ContextVar('conexiones_cortables', default=None)
+
+class ConexionesCortables:
+    """Conexiones HTTP usadas por un bloque que se pueden cortar desde otro hilo"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conexiones = []
+        self.cortadas = False
+        self.activas = True
+
+    def registrar(self, conexion):
+        """Anotar una conexión en uso; indica si aún se puede usar"""
+        with self._lock:
+            if self.activas and not self.cortadas:
+                self._conexiones.append(conexion)
+            return not self.cortadas
+
+    def cortar(self):
+        """Apagar los sockets de las conexiones en uso (si el bloque sigue activo)"""
+        with self._lock:
+            self.cortadas = True
+            conexiones = self._conexiones if self.activas else []
+            self._conexiones = []
+        for conexion in conexiones:
+            _apagar(conexion)
+
+    def soltar(self):
+        """El bloque terminó: sus conexiones vuelven al pool y ya no se cortan"""
+        with self._lock:
+            self.activas = False
+            self._conexiones = []
+
+def _apagar(conexion):
+    sock = getattr(conexion, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+@contextmanager
+def cortables(conexiones):
+    """Registrar en `conexiones` las peticiones a proveedores hechas dentro del bloque"""
+    token = _cortables.set(conexiones)
+    try:
+        yield conexiones
+    finally:
+        _cortables.reset(token)
+
+class _Cortable:
+    def request(self, *args, **kwargs):
+        registro = _cortables.get()
+        if registro is not None and not registro.registrar(self):
+            raise ConnectionAbortedError('Petición cancelada')
+        super().request(*args, **kwargs)
+        if registro is not None and registro.cortadas:
+            # Cancelada mientras se conectaba: no esperar la respuesta
+            _apagar(self)
+
+class _ConexionHttp(_Cortable, HTTPConnection):
+    pass
+
+class _ConexionHttps(_Cortable, HTTPSConnection):
+    pass
+
+class _AdaptadorCortable(HTTPAdapter):
+    """Adaptador cuyas conexiones se registran en las ConexionesCortables del contexto"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('PoolHttp', (HTTPConnectionPool,), {'ConnectionCls': _ConexionHttp}),
+            'https': type('PoolHttps', (HTTPSConnectionPool,), {'ConnectionCls': _ConexionHttps})
+        }
+
+class CircuitoAbierto(SaturacionProveedor):
+    """El circuito del endpoint está abierto: se falla sin llamar al backend"""
+
+    def __init__(self, proveedor, endpoint, reintentar_en):
+        super().__init__(
+            f"{proveedor} no disponible en {endpoint} (circuito abierto)",
+            proveedor, 503, reintentar_en
+        )
+        self.endpoint = endpoint
+
+_sesiones = {}
+_contadores = {}
+_lock = threading.Lock()
+
+def proveedor_de_modelo(modelo):
+    """Nombre del proveedor a partir del identificador de modelo"""
+    if modelo.startswith('ollama:'):
+        return 'ollama'
+    elif modelo.startswith('lmstudio:'):
+        return 'lmstudio'
+    elif modelo.startswith('localai:'):
+        return 'localai'
+    elif modelo.startswith('gpt-'):
+        return 'openai'
+    elif modelo.startswith('claude'):
+        return 'anthropic'
+    elif modelo.startswith('gemini-'):
+        return 'google'
+    return None
+
+def url_base(proveedor):
+    """URL base configurada para un proveedor (la primera si hay varios nodos)"""
+    return CONFIG_PROVEEDORES[proveedor]['url']
+
+def urls_proveedor(proveedor):
+    """Todas las URLs base configuradas para un proveedor"""
+    return list(CONFIG_PROVEEDORES[proveedor]['urls'])
+
+def _modelo_peticion(kwargs):
+    """Modelo al que va dirigida la petición (para la afinidad de nodo)"""
+    cuerpo = kwargs.get('json')
+    if isinstance(cuerpo, dict):
+        return clave_modelo(cuerpo.get('model') or cuerpo.get('name'))
+    return None
+
+def nodo_para_modelo(proveedor, modelo):
+    """URL base del nodo que atiende un modelo (la única si no hay varios nodos).
+
+    Sirve para fijar el nodo cuando varias peticiones deben ir al mismo
+    (generar y descargar de memoria, llevar la cuenta de residencia, pulls).
+    """
+    if pool_nodos.nodos(proveedor):
+        return pool_nodos.elegir(proveedor, clave_modelo(modelo)).url
+    return url_base(proveedor)
+
+def obtener_sesion(proveedor):
+    """Obtener (o crear) la sesión con pool keep-alive de un proveedor"""
+    sesion = _sesiones.get(proveedor)
+    if sesion is not None:
+        return sesion
+
+    with _lock:
+        if proveedor not in _sesiones:
+            config = CONFIG_PROVEEDORES[proveedor]
+            sesion = requests.Session()
+            adaptador = _AdaptadorCortable(
+                pool_connections=config['pool_conexiones'],
+                pool_maxsize=config['pool_tamano'],
+                pool_block=False
+            )
+            sesion.mount('http://', adaptador)
+            sesion.mount('https://', adaptador)
+            _sesiones[proveedor] = sesion
+            _contadores[proveedor] = {'solicitudes': 0, 'errores': 0}
+        return _sesiones[proveedor]
+
+def _timeout_por_defecto(proveedor):
+    config = CONFIG_PROVEEDORES[proveedor]
+    return (config['timeout_conexion'], config['timeout_lectura'])
+
+def solicitar(proveedor, metodo, ruta, timeout=None, ignorar_circuito=False, **kwargs):
+    """Realizar una petición HTTP a un proveedor reutilizando su pool.
+
+    `ruta` puede ser una URL completa o una ruta relativa a la URL base
+    del proveedor (por ejemplo '/api/generate'). Si el circuito del
+    endpoint está abierto se lanza CircuitoAbierto sin tocar la red.
+    """
+    sesion = obtener_sesion(proveedor)
+    nodo = None
+    if ruta.startswith('http'):
+        # URL de un nodo concreto: cuenta para su carga pero no se reparte
+        url = ruta
+        nodo = pool_nodos.nodo_de_url(proveedor, url)
+    elif pool_nodos.nodos(proveedor):
+        nodo = pool_nodos.elegir(proveedor, _modelo_peticion(kwargs))
+        url = f"{nodo.url}{ruta}"
+    else:
+        url = f"{url_base(proveedor)}{ruta}"
+
+    circuito = None if ignorar_circuito else circuitos.circuito(url)
+    permiso = True if circuito is None else circuito.permitir()
+    if not permiso:
+        raise CircuitoAbierto(proveedor, circuito.endpoint, circuito.reintentar_en())
+
+    try:
+        return _enviar(proveedor, sesion, metodo, url, nodo, circuito, timeout, kwargs)
+    finally:
+        if permiso == PRUEBA:
+            # Si la prueba no registró éxito ni fallo, no dejar el circuito bloqueado en semiabierto
+            circuito.liberar_prueba()
+
+def _enviar(proveedor, sesion, metodo, url, nodo, circuito, timeout, kwargs):
+    if timeout is None:
+        timeout = _timeout_por_defecto(proveedor)
+    elif not isinstance(timeout, tuple):
+        # Un timeout simple limita la lectura; la conexión usa el configurado
+        timeout = (min(CONFIG_PROVEEDORES[proveedor]['timeout_conexion'], timeout), timeout)
+    
+    # Nunca esperar más allá del plazo de la petición
+    tiempo = restante()
+    if tiempo is not None:
+        if tiempo <= 0:
+            raise PlazoAgotado(proveedor)
+        timeout = (min(timeout[0], tiempo), min(timeout[1], tiempo))
+
+    with _lock:
+        _contadores[proveedor]['solicitudes'] += 1
+    if nodo is not None:
+        nodo.empezar()
+    try:
+        response = sesion.request(metodo, url, timeout=timeout, **kwargs)
+    except requests.exceptions.RequestException as e:
+        if nodo is not None:
+            nodo.terminar()
+        cortables_activas = _cortables.get()
+        if cortables_activas is not None and cortables_activas.cortadas:
+            # La cortamos nosotros (carrera perdida): no es un fallo del proveedor
+            raise
+        with _lock:
+            _contadores[proveedor]['errores'] += 1
+        if isinstance(e, requests.exceptions.Timeout) and agotado():
+            # Vence el plazo de la petición, no es un fallo del proveedor
+            raise PlazoAgotado(proveedor) from e
+        if circuito is not None:
+            circuito.registrar_fallo(e)
+        raise
+
+    if nodo is not None:
+        if kwargs.get('stream'):
+            pool_nodos.seguir_respuesta(nodo, response)
+        else:
+            nodo.terminar()
+
+    if circuito is not None:
+        if response.status_code >= 500:
+            circuito.registrar_fallo(f"HTTP {response.status_code}")
+        else:
+            circuito.registrar_exito()
+    return response
+
+def get(proveedor, ruta, **kwargs):
+    return solicitar(proveedor, 'GET', ruta, **kwargs)
+
+def post(proveedor, ruta, **kwargs):
+    return solicitar(proveedor, 'POST', ruta, **kwargs)
+
+def delete(proveedor, ruta, **kwargs):
+    return solicitar(proveedor, 'DELETE', ruta, **kwargs)
+
+def estadisticas_pools():
+    """Estadísticas de reutilización de conexiones por proveedor y host"""
+    estadisticas = {}
+
+    with _lock:
+        sesiones = list(_sesiones.items())
+        contadores = {nombre: dict(valores) for nombre, valores in _contadores.items()}
+
+    for nombre, sesion in sesiones:
+        config = CONFIG_PROVEEDORES[nombre]
+        hosts = []
+
+        adaptadores = {id(a): a for a in sesion.adapters.values()}.values()
+        for adaptador in adaptadores:
+            pools = adaptador.poolmanager.pools
+            for clave in list(pools.keys()):
+                pool = pools.get(clave)
+                if pool is None:
+                    continue
+                conexiones = pool.num_connections
+                peticiones = pool.num_requests
+                hosts.append({
+                    'host': f"{pool.scheme}://{pool.host}:{pool.port}",
+                    'conexionesCreadas': conexiones,
+                    'peticiones': peticiones,
+                    'reutilizadas': max(peticiones - conexiones, 0),
+                    'tasaReutilizacion': round((peticiones - conexiones) / peticiones, 3) if peticiones else 0.0
+                })
+
+        estadisticas[nombre] = {
+            'url': config['url'],
+            'urls': config['urls'],
+            'poolConexiones': config['pool_conexiones'],
+            'poolTamano': config['pool_tamano'],
+            'timeoutConexion': config['timeout_conexion'],
+            'timeoutLectura': config['timeout_lectura'],
+            'solicitudes': contadores.get(nombre, {}).get('solicitudes', 0),
+            'errores': contadores.get(nombre, {}).get('errores', 0),
+            'hosts': hosts
+        }
+
+    return estadisticas
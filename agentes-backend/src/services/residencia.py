@@ -0,0 +1,213 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from src.services import proveedores
+from src.services.catalogo import catalogo
+
+# Gestor de residencia de modelos de Ollama: lleva la cuenta de qué modelos
+# están cargados, cuánta memoria ocupan y cuándo se usaron por última vez.
+# Fija keep_alive en cada petición y, si se configura un presupuesto de
+# memoria, descarga los modelos menos usados antes de cargar uno nuevo.
+#
+# Con varios nodos cada uno tiene su memoria: la residencia y el presupuesto
+# (que es por máquina) se llevan por nodo, y la petición, las descargas de
+# memoria y los pulls van a la URL del nodo elegido, no a la ruta relativa.
+
+PRESUPUESTO_BYTES = int(float(os.getenv('OLLAMA_PRESUPUESTO_MEMORIA_GB', '0')) * 1024**3)  # 0 = sin límite; por nodo
+KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '5m')
+SINCRONIZAR_CADA = float(os.getenv('OLLAMA_SINCRONIZAR_CADA', '10'))
+
+def _keep_alive_modelos():
+    try:
+        return json.loads(os.getenv('OLLAMA_KEEP_ALIVE_MODELOS', '{}'))
+    except ValueError:
+        return {}
+
+def _nombre_completo(modelo):
+    """Ollama informa los modelos con etiqueta (llama2 -> llama2:latest)"""
+    modelo = modelo.replace('ollama:', '')
+    return modelo if ':' in modelo else f'{modelo}:latest'
+
+class UsoModelo:
+    """Modelo en uso en un nodo: keep_alive a enviar y URL del nodo que lo carga"""
+
+    def __init__(self, nodo, keep_alive):
+        self.nodo = nodo
+        self.keep_alive = keep_alive
+
+    def url(self, ruta):
+        return f'{self.nodo}{ruta}'
+
+class ResidenciaOllama:
+    def __init__(self, presupuesto=PRESUPUESTO_BYTES):
+        self.presupuesto = presupuesto
+        self._keep_alive_modelos = _keep_alive_modelos()
+        self._residentes = {}  # url del nodo -> OrderedDict(modelo -> residente), LRU primero
+        self._en_uso = {}  # (url del nodo, modelo) -> peticiones en curso
+        self._sincronizado = 0
+        self._lock = threading.Lock()
+        self.cargas = 0
+        self.desalojos = 0
+
+    def keep_alive(self, modelo):
+        """Valor de keep_alive para las peticiones de este modelo"""
+        return self._keep_alive_modelos.get(modelo.replace('ollama:', ''), KEEP_ALIVE)
+
+    def tamano_estimado(self, modelo):
+        """Tamaño del modelo según /api/tags (antes de cargarlo)"""
+        nombre = _nombre_completo(modelo)
+        datos = catalogo.entrada('ollama').get('datos') or {}
+        for m in datos.get('models', []):
+            if m.get('name') == nombre:
+                return m.get('size', 0)
+        return 0
+
+    def _nodo(self, url):
+        return self._residentes.setdefault(url, OrderedDict())
+
+    def sincronizar(self, forzar=False):
+        """Actualizar los residentes de cada nodo con su /api/ps"""
+        if not forzar and time.monotonic() - self._sincronizado < SINCRONIZAR_CADA:
+            return
+        for url in proveedores.urls_proveedor('ollama'):
+            try:
+                response = proveedores.get('ollama', f"{url}/api/ps", timeout=3)
+                if response.status_code != 200:
+                    continue
+                cargados = {m['name']: m.get('size', 0) for m in response.json().get('models', [])}
+            except Exception:
+                continue
+
+            with self._lock:
+                residentes = self._nodo(url)
+                for nombre in list(residentes):
+                    if nombre not in cargados:
+                        # Ollama lo descargó al vencer su keep_alive
+                        del residentes[nombre]
+                for nombre, tamano in cargados.items():
+                    if nombre in residentes:
+                        residentes[nombre]['tamano'] = tamano
+                    else:
+                        residentes[nombre] = {'tamano': tamano, 'ultimoUso': time.time(), 'cargado': time.time()}
+                        residentes.move_to_end(nombre, last=False)
+        self._sincronizado = time.monotonic()
+
+    def _victimas(self, url, nombre, tamano):
+        """Modelos del nodo a descargar (LRU, sin uso en curso) para que quepa el nuevo"""
+        residentes = self._nodo(url)
+        if not self.presupuesto or nombre in residentes:
+            return []
+        ocupado = sum(r['tamano'] for r in residentes.values())
+        victimas = []
+        for candidato, residente in residentes.items():
+            if ocupado + tamano <= self.presupuesto:
+                break
+            if self._en_uso.get((url, candidato)):
+                continue
+            victimas.append(candidato)
+            ocupado -= residente['tamano']
+        return victimas
+
+    @contextmanager
+    def usar(self, modelo):
+        """Marcar el modelo en uso en su nodo durante el bloque.
+
+        Produce un UsoModelo: la petición debe ir a `uso.url(ruta)` con
+        `uso.keep_alive`, para que se cargue en el nodo cuya cuenta se lleva.
+        """
+        nombre = _nombre_completo(modelo)
+        url = proveedores.nodo_para_modelo('ollama', modelo.replace('ollama:', ''))
+        if self.presupuesto:
+            self.sincronizar()
+            tamano = self.tamano_estimado(modelo)
+            with self._lock:
+                victimas = self._victimas(url, nombre, tamano)
+            for victima in victimas:
+                self.descargar(victima, motivo='presupuesto', nodo=url)
+
+        with self._lock:
+            clave = (url, nombre)
+            self._en_uso[clave] = self._en_uso.get(clave, 0) + 1
+            residentes = self._nodo(url)
+            residente = residentes.get(nombre)
+            if residente is None:
+                residente = {'tamano': self.tamano_estimado(modelo), 'ultimoUso': time.time(), 'cargado': time.time()}
+                residentes[nombre] = residente
+                self.cargas += 1
+            residente['ultimoUso'] = time.time()
+            residentes.move_to_end(nombre)
+        try:
+            yield UsoModelo(url, self.keep_alive(modelo))
+        finally:
+            with self._lock:
+                self._en_uso[clave] -= 1
+
+    def cargar(self, modelo):
+        """Cargar el modelo en memoria sin generar texto"""
+        with self.usar(modelo) as uso:
+            response = proveedores.post('ollama', uso.url('/api/generate'),
+                json={'model': modelo.replace('ollama:', ''), 'keep_alive': uso.keep_alive},
+                timeout=120
+            )
+        self.sincronizar(forzar=True)
+        return response
+
+    def descargar(self, modelo, motivo='manual', nodo=None):
+        """Sacar un modelo de memoria (keep_alive = 0) del nodo indicado o, si no
+        se indica, de todos los nodos en que está cargado"""
+        nombre = _nombre_completo(modelo)
+        if nodo is not None:
+            nodos = [nodo]
+        else:
+            with self._lock:
+                nodos = [url for url, residentes in self._residentes.items() if nombre in residentes]
+            nodos = nodos or proveedores.urls_proveedor('ollama')
+
+        fallida = None
+        for url in nodos:
+            response = proveedores.post('ollama', f'{url}/api/generate',
+                json={'model': nombre, 'keep_alive': 0},
+                timeout=30
+            )
+            if response.status_code != 200:
+                fallida = response
+                continue
+            with self._lock:
+                self._nodo(url).pop(nombre, None)
+                if motivo == 'presupuesto':
+                    self.desalojos += 1
+            print(f"📤 Modelo {nombre} descargado de memoria en {url} ({motivo})")
+        return fallida if fallida is not None else response
+
+    def estadisticas(self):
+        self.sincronizar()
+        with self._lock:
+            return {
+                'presupuestoBytes': self.presupuesto,
+                'presupuestoPor': 'nodo',
+                'ocupadoBytes': sum(r['tamano'] for residentes in self._residentes.values() for r in residentes.values()),
+                'keepAlive': KEEP_ALIVE,
+                'cargas': self.cargas,
+                'desalojos': self.desalojos,
+                'nodos': {
+                    url: {'ocupadoBytes': sum(r['tamano'] for r in residentes.values()), 'modelos': list(residentes)}
+                    for url, residentes in self._residentes.items()
+                },
+                'residentes': [
+                    {
+                        'modelo': nombre,
+                        'nodo': url,
+                        'tamanoBytes': r['tamano'],
+                        'ultimoUso': r['ultimoUso'],
+                        'cargado': r['cargado'],
+                        'enUso': self._en_uso.get((url, nombre), 0)
+                    }
+                    for url, residentes in self._residentes.items()
+                    for nombre, r in residentes.items()
+                ]
+            }
+
+residencia_ollama = ResidenciaOllama()
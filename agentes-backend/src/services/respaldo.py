@@ -0,0 +1,198 @@
+import json
+import os
+import queue
+import threading
+import time
+import types
+from src.services.concurrencia import copiar_agente, con_contexto
+from src.services.proveedores import ConexionesCortables, cortables
+
+# Cadena de modelos de respaldo por agente con un SLO de primer token. Si el
+# modelo principal no produce su primer token a tiempo se lanza una petición
+# de cobertura al siguiente modelo de la cadena (también si falla); gana el
+# primero que empieza a responder y el resto se cancela.
+
+RESPALDO_SLO_MS = int(os.getenv('RESPALDO_SLO_PRIMER_TOKEN_MS', '0'))  # 0 = solo respaldo por error
+
+class TextoGenerado(str):
+    """Texto (o primer token) que recuerda qué modelo lo generó"""
+
+    def __new__(cls, texto, modelo):
+        objeto = super().__new__(cls, texto)
+        objeto.modelo = modelo
+        return objeto
+
+def modelo_de(texto, por_defecto):
+    """Modelo que generó el texto, o el indicado si no se sabe"""
+    return getattr(texto, 'modelo', None) or por_defecto
+
+def cadena_modelos(agente):
+    """Modelo principal seguido de los de respaldo, sin repetir"""
+    try:
+        respaldo = json.loads(getattr(agente, 'modelos_respaldo', None) or '[]')
+    except ValueError:
+        respaldo = []
+    cadena = [agente.modelo]
+    for modelo in respaldo:
+        if modelo and modelo not in cadena:
+            cadena.append(modelo)
+    return cadena
+
+def slo_primer_token(agente):
+    """Segundos de espera del primer token antes de cubrir, o None"""
+    slo = getattr(agente, 'slo_primer_token_ms', None) or RESPALDO_SLO_MS
+    return slo / 1000 if slo else None
+
+def _con_modelo(agente, modelo):
+    copia = copiar_agente(agente) if hasattr(agente, '__table__') else types.SimpleNamespace(**vars(agente))
+    copia.modelo = modelo
+    return copia
+
+class Carrera:
+    """Stream de un modelo de la cadena consumido en su propio hilo"""
+
+    def __init__(self, indice, modelo, cola):
+        self.indice = indice
+        self.modelo = modelo
+        self.cola = cola
+        self.cancelada = threading.Event()
+        self.conexiones = ConexionesCortables()
+        self.inicio = time.monotonic()
+
+    def lanzar(self, abrir_stream, mensaje, agente, sesion):
+        hilo = threading.Thread(
+            target=con_contexto(self._consumir), args=(abrir_stream, mensaje, agente, sesion),
+            name=f'respaldo-{self.modelo}', daemon=True
+        )
+        hilo.start()
+
+    def cancelar(self):
+        """Cortar la carrera: también la lectura en curso, para liberar su hueco de admisión"""
+        self.cancelada.set()
+        self.conexiones.cortar()
+
+    def _consumir(self, abrir_stream, mensaje, agente, sesion):
+        stream = abrir_stream(mensaje, agente, sesion)
+        try:
+            with cortables(self.conexiones):
+                for token in stream:
+                    if self.cancelada.is_set():
+                        # Al cerrar el generador se cierra la conexión con el proveedor
+                        break
+                    self.cola.put(('token', self.indice, token))
+                else:
+                    self.cola.put(('fin', self.indice, None))
+        except Exception as e:
+            self.cola.put(('error', self.indice, e))
+        finally:
+            # Las conexiones vuelven al pool: cancelar ya no debe apagarlas
+            self.conexiones.soltar()
+            stream.close()
+
+class RespaldoModelos:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.coberturas = 0
+        self.por_error = 0
+        self.ganadas_respaldo = 0
+        self.canceladas = 0
+
+    def aplica(self, agente):
+        return len(cadena_modelos(agente)) > 1
+
+    def _contar(self, campo):
+        with self._lock:
+            setattr(self, campo, getattr(self, campo) + 1)
+
+    def stream(self, abrir_stream, mensaje, agente, sesion=None):
+        """Tokens del primer modelo de la cadena que empieza a responder.
+
+        `abrir_stream(mensaje, agente, sesion)` abre el stream de un modelo.
+        El primer token producido es un TextoGenerado con el modelo ganador.
+        Los modelos perdedores se cancelan en su siguiente token.
+        """
+        cadena = cadena_modelos(agente)
+        slo = slo_primer_token(agente)
+        cola = queue.Queue()
+        carreras = []
+        fallidas = set()
+        ganadora = None
+        ultimo_error = None
+
+        def lanzar_siguiente():
+            indice = len(carreras)
+            carrera = Carrera(indice, cadena[indice], cola)
+            carreras.append(carrera)
+            # El contexto de conversación solo vale para el modelo principal
+            carrera.lanzar(abrir_stream, mensaje, _con_modelo(agente, carrera.modelo), sesion if indice == 0 else None)
+            return time.monotonic() + slo if slo else None
+
+        cubrir_en = lanzar_siguiente()
+        try:
+            while True:
+                espera = None
+                if ganadora is None and cubrir_en is not None and len(carreras) < len(cadena):
+                    espera = max(cubrir_en - time.monotonic(), 0)
+                try:
+                    evento, indice, valor = cola.get(timeout=espera)
+                except queue.Empty:
+                    # SLO de primer token incumplido: cubrir con el siguiente modelo
+                    self._contar('coberturas')
+                    cubrir_en = lanzar_siguiente()
+                    continue
+
+                if ganadora is not None and indice != ganadora:
+                    continue
+
+                if evento == 'error':
+                    if ganadora is not None:
+                        raise valor
+                    fallidas.add(indice)
+                    ultimo_error = valor
+                    if len(carreras) < len(cadena):
+                        self._contar('por_error')
+                        cubrir_en = lanzar_siguiente()
+                    elif len(fallidas) == len(carreras):
+                        raise ultimo_error
+                    continue
+
+                if ganadora is None:
+                    ganadora = indice
+                    if indice > 0:
+                        self._contar('ganadas_respaldo')
+                    for carrera in carreras:
+                        if carrera.indice != indice and carrera.indice not in fallidas:
+                            carrera.cancelar()
+                            self._contar('canceladas')
+                    if evento == 'token':
+                        valor = TextoGenerado(valor, cadena[indice])
+
+                if evento == 'fin':
+                    return
+                yield valor
+        finally:
+            # Cliente desconectado o fin: no dejar streams abiertos
+            for carrera in carreras:
+                carrera.cancelar()
+
+    def generar(self, abrir_stream, mensaje, agente, sesion=None):
+        """Respuesta completa del modelo ganador como TextoGenerado"""
+        partes = []
+        modelo = agente.modelo
+        for token in self.stream(abrir_stream, mensaje, agente, sesion):
+            if not partes:
+                modelo = modelo_de(token, modelo)
+            partes.append(token)
+        return TextoGenerado(''.join(partes), modelo)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'sloPorDefectoMs': RESPALDO_SLO_MS,
+                'coberturas': self.coberturas,
+                'respaldosPorError': self.por_error,
+                'ganadasPorRespaldo': self.ganadas_respaldo,
+                'canceladas': self.canceladas
+            }
+
+respaldo_modelos = RespaldoModelos()
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Estado de conversación de Ollama: el array `context` que devuelve
+# /api/generate se guarda por conversación (agente + sala o agente + usuario)
+# y se reenvía en el turno siguiente, así el prompt del agente no se vuelve
+# a evaluar y el modelo recuerda los turnos anteriores.
+
+SESIONES_MAX = int(os.getenv('OLLAMA_SESIONES_MAX', '256'))  # 0 = desactivado
+SESIONES_TTL = float(os.getenv('OLLAMA_SESIONES_TTL', '1800'))
+SESIONES_MAX_TOKENS = int(os.getenv('OLLAMA_SESIONES_MAX_TOKENS', '3072'))
+
+def clave_sesion(agente_id, sala_id=None, usuario=None):
+    """Clave de la conversación: el agente en una sala o con un usuario"""
+    if sala_id is not None:
+        return f'agente:{agente_id}:sala:{sala_id}'
+    return f'agente:{agente_id}:usuario:{usuario or "Usuario"}'
+
+def _huella_agente(agente):
+    """Si cambia el modelo o el prompt del agente, el contexto guardado ya no sirve"""
+    return hashlib.sha256(f'{agente.modelo}\0{agente.prompt}'.encode('utf-8')).hexdigest()
+
+class SesionesOllama:
+    def __init__(self, max_sesiones=SESIONES_MAX, ttl=SESIONES_TTL):
+        self.max_sesiones = max_sesiones
+        self.ttl = ttl
+        self._sesiones = OrderedDict()
+        self._lock = threading.Lock()
+        self.reutilizadas = 0
+        self.nuevas = 0
+        self.reiniciadas = 0
+        self.desalojadas = 0
+
+    def aplica(self, modelo, sesion):
+        """Indica si la petición usa contexto de conversación"""
+        return bool(self.max_sesiones and sesion and modelo.startswith('ollama:'))
+
+    def obtener(self, sesion, agente):
+        """Contexto guardado para la conversación, o None si hay que empezar de cero"""
+        with self._lock:
+            entrada = self._sesiones.get(sesion)
+            if entrada is None:
+                self.nuevas += 1
+                return None
+            caducada = time.monotonic() - entrada['actualizado'] > self.ttl
+            if caducada or entrada['huella'] != _huella_agente(agente):
+                del self._sesiones[sesion]
+                self.reiniciadas += 1
+                return None
+            self._sesiones.move_to_end(sesion)
+            self.reutilizadas += 1
+            return entrada['contexto']
+
+    def tiene_contexto(self, sesion, agente):
+        """Indica, sin tocar contadores, si el próximo turno reutilizará contexto"""
+        if not self.aplica(agente.modelo, sesion):
+            return False
+        with self._lock:
+            entrada = self._sesiones.get(sesion)
+            return (entrada is not None
+                    and time.monotonic() - entrada['actualizado'] <= self.ttl
+                    and entrada['huella'] == _huella_agente(agente))
+
+    def guardar(self, sesion, agente, contexto):
+        """Guardar el contexto devuelto por Ollama tras un turno"""
+        with self._lock:
+            if len(contexto) > SESIONES_MAX_TOKENS:
+                # Ventana llena: el turno siguiente empieza de nuevo con el prompt del agente
+                self._sesiones.pop(sesion, None)
+                self.reiniciadas += 1
+                return
+            anterior = self._sesiones.get(sesion)
+            self._sesiones[sesion] = {
+                'contexto': contexto,
+                'huella': _huella_agente(agente),
+                'turnos': (anterior['turnos'] + 1) if anterior else 1,
+                'actualizado': time.monotonic()
+            }
+            self._sesiones.move_to_end(sesion)
+            while len(self._sesiones) > self.max_sesiones:
+                self._sesiones.popitem(last=False)
+                self.desalojadas += 1
+
+    def olvidar_agente(self, agente_id):
+        """Borrar todas las conversaciones de un agente"""
+        prefijo = f'agente:{agente_id}:'
+        with self._lock:
+            for sesion in [s for s in self._sesiones if s.startswith(prefijo)]:
+                del self._sesiones[sesion]
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'sesiones': len(self._sesiones),
+                'maxSesiones': self.max_sesiones,
+                'ttl': self.ttl,
+                'maxTokens': SESIONES_MAX_TOKENS,
+                'tokensGuardados': sum(len(e['contexto']) for e in self._sesiones.values()),
+                'reutilizadas': self.reutilizadas,
+                'nuevas': self.nuevas,
+                'reiniciadas': self.reiniciadas,
+                'desalojadas': self.desalojadas
+            }
+
+sesiones_ollama = SesionesOllama()
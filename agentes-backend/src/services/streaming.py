@@ -0,0 +1,74 @@
+import json
+from flask import Response, request, stream_with_context
+
+# Utilidades para respuestas en streaming (Server-Sent Events / NDJSON)
+
+CABECERAS_STREAM = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'  # Evitar que nginx acumule la respuesta
+}
+
+def solicita_stream(data=None):
+    """Indica si el cliente pidió la respuesta en streaming"""
+    if request.args.get('stream', '').lower() in ('1', 'true', 'sse', 'ndjson'):
+        return True
+    if data and data.get('stream'):
+        return True
+    aceptado = request.headers.get('Accept', '')
+    return 'text/event-stream' in aceptado or 'application/x-ndjson' in aceptado
+
+def formato_stream():
+    """Formato de streaming pedido por el cliente: 'sse' (por defecto) o 'ndjson'"""
+    if request.args.get('stream', '').lower() == 'ndjson' or request.args.get('formato') == 'ndjson':
+        return 'ndjson'
+    if 'application/x-ndjson' in request.headers.get('Accept', ''):
+        return 'ndjson'
+    return 'sse'
+
+def evento_sse(evento, datos):
+    """Formatear un evento SSE con datos JSON"""
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+def respuesta_sse(generador):
+    """Construir una respuesta Flask SSE a partir de un generador de eventos"""
+    return Response(
+        stream_with_context(generador),
+        mimetype='text/event-stream',
+        headers=CABECERAS_STREAM
+    )
+
+def linea_ndjson(evento, datos):
+    """Formatear un evento como una línea NDJSON con su tipo"""
+    return json.dumps({'tipo': evento, **datos}, ensure_ascii=False) + '\n'
+
+def formatear_evento(formato, evento, datos):
+    """Formatear un evento en el formato de streaming indicado"""
+    if formato == 'ndjson':
+        return linea_ndjson(evento, datos)
+    return evento_sse(evento, datos)
+
+def respuesta_stream(generador, formato='sse'):
+    """Construir una respuesta Flask SSE o NDJSON a partir de un generador"""
+    return Response(
+        stream_with_context(generador),
+        mimetype='application/x-ndjson' if formato == 'ndjson' else 'text/event-stream',
+        headers=CABECERAS_STREAM
+    )
+
+def leer_eventos_sse(response):
+    """Leer un stream SSE de un proveedor y devolver (evento, datos) por cada bloque"""
+    evento = None
+    datos = []
+    for linea in response.iter_lines():
+        linea = linea.decode('utf-8', errors='replace') if isinstance(linea, bytes) else linea
+        if linea == '':
+            if datos:
+                yield evento, '\n'.join(datos)
+            evento = None
+            datos = []
+        elif linea.startswith('event:'):
+            evento = linea[6:].strip()
+        elif linea.startswith('data:'):
+            datos.append(linea[5:].lstrip())
+    if datos:
+        yield evento, '\n'.join(datos)
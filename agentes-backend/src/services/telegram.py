@@ -0,0 +1,423 @@
+import asyncio
+import hashlib
+import json
+import os
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+import requests
+
+# Runtime de bots de Telegram: un único bucle asyncio hace long-polling de
+# getUpdates para todos los agentes con Telegram activo (una conexión
+# keep-alive por bot, sin un hilo por bot). Los mensajes recibidos se
+# atienden en un pool acotado de hilos que llama a la generación, responde
+# con sendMessage y guarda la Conversacion con canal='telegram'.
+
+TELEGRAM_API_BASE = os.getenv('TELEGRAM_API_BASE', 'https://api.telegram.org').rstrip('/')
+TELEGRAM_LONG_POLL = int(os.getenv('TELEGRAM_LONG_POLL', '25'))
+TELEGRAM_CONCURRENCIA = int(os.getenv('TELEGRAM_CONCURRENCIA', '4'))
+TELEGRAM_TIMEOUT_ENVIO = float(os.getenv('TELEGRAM_TIMEOUT_ENVIO', '10'))
+TELEGRAM_REINTENTO_MAX = float(os.getenv('TELEGRAM_REINTENTO_MAX', '60'))
+TELEGRAM_VALIDACION_TTL = float(os.getenv('TELEGRAM_VALIDACION_TTL', '3600'))
+TELEGRAM_VALIDACION_TTL_ERROR = float(os.getenv('TELEGRAM_VALIDACION_TTL_ERROR', '60'))
+TELEGRAM_VALIDACION_TIMEOUT = float(os.getenv('TELEGRAM_VALIDACION_TIMEOUT', '10'))
+
+_sesion_http = requests.Session()
+
+def url_metodo(token, metodo):
+    """URL de un método de la Bot API"""
+    return f"{TELEGRAM_API_BASE}/bot{token}/{metodo}"
+
+def enviar_mensaje(token, chat_id, texto):
+    """Enviar un mensaje de texto a un chat (bloqueante)"""
+    response = _sesion_http.post(
+        url_metodo(token, 'sendMessage'),
+        json={'chat_id': chat_id, 'text': texto[:4096]},
+        timeout=TELEGRAM_TIMEOUT_ENVIO
+    )
+    return response.status_code == 200
+
+def _huella_token(token):
+    """Los tokens no se guardan en claro en la caché"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+class ValidacionTokens:
+    """Caché de validaciones de tokens (getMe) con TTL y caché negativa"""
+
+    def __init__(self):
+        self._resultados = {}
+        self._en_curso = {}
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.consultas = 0
+
+    def conocido(self, token):
+        """True/False si hay un resultado vigente para el token, None si no"""
+        with self._lock:
+            entrada = self._resultados.get(_huella_token(token))
+            if entrada is None or entrada[1] <= time.monotonic():
+                return None
+            return entrada[0]
+
+    def registrar(self, token, valido):
+        """Guardar el resultado de una validación (también lo usa el polling)"""
+        ttl = TELEGRAM_VALIDACION_TTL if valido else TELEGRAM_VALIDACION_TTL_ERROR
+        with self._lock:
+            self._resultados[_huella_token(token)] = (valido, time.monotonic() + ttl)
+
+    def validar(self, token):
+        """Validar el token, usando la caché y compartiendo las consultas en curso"""
+        resultado = self.conocido(token)
+        huella = _huella_token(token)
+        with self._lock:
+            if resultado is not None:
+                self.aciertos += 1
+                return resultado
+            self.fallos += 1
+            evento = self._en_curso.get(huella)
+            propio = evento is None
+            if propio:
+                evento = self._en_curso[huella] = threading.Event()
+        if not propio:
+            evento.wait(TELEGRAM_VALIDACION_TIMEOUT)
+            return bool(self.conocido(token))
+
+        try:
+            return self._consultar(token)
+        finally:
+            with self._lock:
+                del self._en_curso[huella]
+            evento.set()
+
+    def validar_en_segundo_plano(self, token):
+        """Lanzar la validación sin esperar; devuelve el resultado si ya se conoce"""
+        resultado = self.conocido(token)
+        if resultado is None:
+            threading.Thread(target=self.validar, args=(token,), name='telegram-getme', daemon=True).start()
+        return resultado
+
+    def _consultar(self, token):
+        with self._lock:
+            self.consultas += 1
+        try:
+            response = _sesion_http.get(url_metodo(token, 'getMe'), timeout=TELEGRAM_VALIDACION_TIMEOUT)
+        except requests.RequestException:
+            # Sin respuesta de Telegram no se sabe si el token es válido: no se guarda
+            return False
+        if response.status_code in (401, 404):
+            self.registrar(token, False)
+            return False
+        if response.status_code != 200:
+            return False
+        valido = bool(response.json().get('ok', False))
+        self.registrar(token, valido)
+        return valido
+
+    def estadisticas(self):
+        with self._lock:
+            ahora = time.monotonic()
+            vigentes = [v for v, expira in self._resultados.values() if expira > ahora]
+            return {
+                'validos': sum(1 for v in vigentes if v),
+                'invalidos': sum(1 for v in vigentes if not v),
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'consultasGetMe': self.consultas,
+                'ttl': TELEGRAM_VALIDACION_TTL,
+                'ttlError': TELEGRAM_VALIDACION_TTL_ERROR
+            }
+
+validacion_tokens = ValidacionTokens()
+
+class ConexionHttp:
+    """Cliente HTTP/1.1 mínimo sobre asyncio con una conexión keep-alive"""
+
+    def __init__(self, base):
+        partes = urlsplit(base)
+        self.seguro = partes.scheme == 'https'
+        self.host = partes.hostname
+        self.puerto = partes.port or (443 if self.seguro else 80)
+        self.prefijo = partes.path.rstrip('/')
+        self.cabecera_host = partes.netloc
+        self._lector = None
+        self._escritor = None
+
+    async def _conectar(self):
+        contexto = ssl.create_default_context() if self.seguro else None
+        self._lector, self._escritor = await asyncio.open_connection(self.host, self.puerto, ssl=contexto)
+
+    async def cerrar(self):
+        if self._escritor is not None:
+            self._escritor.close()
+            try:
+                await self._escritor.wait_closed()
+            except Exception:
+                pass
+        self._lector = self._escritor = None
+
+    async def get_json(self, ruta, parametros, timeout):
+        """GET que devuelve (status, json); cierra la conexión si algo falla"""
+        if self._escritor is None:
+            await self._conectar()
+        peticion = (
+            f"GET {self.prefijo}{ruta}?{urlencode(parametros)} HTTP/1.1\r\n"
+            f"Host: {self.cabecera_host}\r\n"
+            "Accept: application/json\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        )
+        try:
+            self._escritor.write(peticion.encode('utf-8'))
+            await self._escritor.drain()
+            status, cuerpo = await asyncio.wait_for(self._leer_respuesta(), timeout)
+        except BaseException:
+            await self.cerrar()
+            raise
+        return status, json.loads(cuerpo or b'{}')
+
+    async def _leer_respuesta(self):
+        linea = await self._lector.readline()
+        if not linea:
+            raise ConnectionError('Conexión cerrada por el servidor')
+        status = int(linea.split()[1])
+
+        cabeceras = {}
+        while True:
+            linea = await self._lector.readline()
+            if linea in (b'\r\n', b'\n', b''):
+                break
+            nombre, _, valor = linea.decode('latin-1').partition(':')
+            cabeceras[nombre.strip().lower()] = valor.strip()
+
+        if cabeceras.get('transfer-encoding', '').lower() == 'chunked':
+            partes = []
+            while True:
+                tamano = int((await self._lector.readline()).split(b';')[0], 16)
+                if tamano == 0:
+                    await self._lector.readline()
+                    break
+                partes.append(await self._lector.readexactly(tamano))
+                await self._lector.readline()
+            cuerpo = b''.join(partes)
+        elif 'content-length' in cabeceras:
+            cuerpo = await self._lector.readexactly(int(cabeceras['content-length']))
+        else:
+            cuerpo = await self._lector.read()
+            cabeceras['connection'] = 'close'
+
+        if cabeceras.get('connection', '').lower() == 'close':
+            await self.cerrar()
+        return status, cuerpo
+
+class BotTelegram:
+    def __init__(self, agente_id, token, offset=None):
+        self.agente_id = agente_id
+        self.token = token
+        self.offset = offset
+        self.tarea = None
+        self.estado = 'iniciando'
+        self.actualizaciones = 0
+        self.respuestas = 0
+        self.errores = 0
+        self.ultimo_error = None
+        self.ultimo_sondeo = None
+
+    def to_dict(self):
+        return {
+            'agenteId': self.agente_id,
+            'estado': self.estado,
+            'offset': self.offset,
+            'actualizaciones': self.actualizaciones,
+            'respuestas': self.respuestas,
+            'errores': self.errores,
+            'ultimoError': self.ultimo_error,
+            'ultimoSondeo': self.ultimo_sondeo
+        }
+
+class RuntimeTelegram:
+    def __init__(self):
+        self._app = None
+        self._loop = None
+        self._hilo = None
+        self._bots = {}
+        self._lock = threading.Lock()
+        # Pool acotado: limita cuántos mensajes de Telegram se generan a la vez
+        self._executor = ThreadPoolExecutor(max_workers=TELEGRAM_CONCURRENCIA, thread_name_prefix='telegram')
+
+    def iniciar(self, app):
+        """Arrancar el bucle asyncio en su hilo (una sola vez)"""
+        with self._lock:
+            if self._hilo is not None:
+                return
+            self._app = app
+            self._loop = asyncio.new_event_loop()
+            self._hilo = threading.Thread(target=self._loop.run_forever, name='telegram-runtime', daemon=True)
+            self._hilo.start()
+
+    def cargar_activos(self):
+        """Registrar los bots de todos los agentes activos con Telegram"""
+        from src.models.agente import Agente
+
+        agentes = Agente.query.filter_by(telegram=True, estado='activo').all()
+        for agente in agentes:
+            if agente.telegram_token:
+                self.agregar(agente.id, agente.telegram_token, agente.telegram_offset)
+        return len(agentes)
+
+    def agregar(self, agente_id, token, offset=None):
+        """Empezar (o reiniciar) el long-polling del bot del agente"""
+        bot = BotTelegram(agente_id, token, offset)
+        self._loop.call_soon_threadsafe(self._registrar, bot)
+
+    def quitar(self, agente_id):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._cancelar, agente_id)
+
+    def _registrar(self, bot):
+        self._cancelar(bot.agente_id)
+        bot.tarea = self._loop.create_task(self._sondear(bot))
+        self._bots[bot.agente_id] = bot
+
+    def _cancelar(self, agente_id):
+        bot = self._bots.pop(agente_id, None)
+        if bot is not None and bot.tarea is not None:
+            bot.tarea.cancel()
+
+    async def _sondear(self, bot):
+        conexion = ConexionHttp(TELEGRAM_API_BASE)
+        espera = 1
+        try:
+            while True:
+                parametros = {'timeout': TELEGRAM_LONG_POLL, 'allowed_updates': '["message"]'}
+                if bot.offset is not None:
+                    parametros['offset'] = bot.offset
+                try:
+                    status, data = await conexion.get_json(
+                        f'/bot{bot.token}/getUpdates', parametros, TELEGRAM_LONG_POLL + 10
+                    )
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    bot.errores += 1
+                    bot.ultimo_error = str(e) or type(e).__name__
+                    bot.estado = 'reconectando'
+                    await asyncio.sleep(espera)
+                    espera = min(espera * 2, TELEGRAM_REINTENTO_MAX)
+                    continue
+
+                bot.ultimo_sondeo = time.time()
+                if status in (401, 404):
+                    # Token revocado o inválido: no tiene sentido seguir
+                    validacion_tokens.registrar(bot.token, False)
+                    bot.estado = 'token_invalido'
+                    bot.ultimo_error = data.get('description')
+                    return
+                if status != 200 or not data.get('ok'):
+                    # 409: otro proceso hace polling o hay un webhook configurado
+                    bot.errores += 1
+                    bot.ultimo_error = data.get('description') or f'HTTP {status}'
+                    bot.estado = 'reintentando'
+                    reintentar = data.get('parameters', {}).get('retry_after')
+                    await asyncio.sleep(reintentar or espera)
+                    espera = min(espera * 2, TELEGRAM_REINTENTO_MAX)
+                    continue
+
+                if bot.estado != 'activo':
+                    validacion_tokens.registrar(bot.token, True)
+                bot.estado = 'activo'
+                espera = 1
+                actualizaciones = data.get('result', [])
+                if not actualizaciones:
+                    continue
+
+                # Los mensajes de un mismo bot se atienden en orden
+                for actualizacion in actualizaciones:
+                    bot.actualizaciones += 1
+                    mensaje = actualizacion.get('message') or {}
+                    if mensaje.get('text'):
+                        await self._loop.run_in_executor(self._executor, self._atender, bot, mensaje)
+                    bot.offset = actualizacion['update_id'] + 1
+
+                await self._loop.run_in_executor(self._executor, self._guardar_offset, bot.agente_id, bot.offset)
+        finally:
+            await conexion.cerrar()
+
+    def _atender(self, bot, mensaje):
+        """Generar y enviar la respuesta a un mensaje (en el pool de Telegram)"""
+        from src.models.agente import db, Agente, Conversacion
+        from src.routes.agentes import generar_respuesta_ia
+        from src.services.admision import SaturacionProveedor, inquilino, como_inquilino
+        from src.services.plazos import con_plazo, plazo_agente
+        from src.services.proveedores import PlazoAgotado
+        from src.services.concurrencia import copiar_agente
+        from src.services.historial import historial_chat
+        from src.services.sesiones import clave_sesion, sesiones_ollama
+
+        chat_id = mensaje['chat']['id']
+        remitente = mensaje.get('from') or {}
+        usuario = remitente.get('username') or remitente.get('first_name') or str(chat_id)
+        texto = mensaje['text']
+
+        try:
+            with self._app.app_context():
+                agente = db.session.get(Agente, bot.agente_id)
+                if agente is None:
+                    return
+
+                sesion = clave_sesion(agente.id, usuario=f'telegram:{chat_id}')
+                mensaje_ia = texto
+                if not sesiones_ollama.tiene_contexto(sesion, agente):
+                    mensaje_ia = historial_chat(agente, usuario, None, texto, canal='telegram')
+
+                try:
+                    with como_inquilino(inquilino(usuario=f'telegram:{chat_id}')), con_plazo(plazo_agente(agente)):
+                        respuesta = generar_respuesta_ia(mensaje_ia, copiar_agente(agente), None, sesion)
+                except SaturacionProveedor as e:
+                    enviar_mensaje(bot.token, chat_id, f"Estoy ocupado ahora mismo, vuelve a escribirme en {e.reintentar_en} s.")
+                    return
+                except PlazoAgotado:
+                    enviar_mensaje(bot.token, chat_id, "No he podido responderte a tiempo, inténtalo de nuevo.")
+                    return
+
+                enviar_mensaje(bot.token, chat_id, respuesta)
+                bot.respuestas += 1
+
+                conversacion = Conversacion(
+                    agente_id=agente.id,
+                    usuario=usuario,
+                    mensaje_usuario=texto,
+                    respuesta_agente=respuesta,
+                    canal='telegram'
+                )
+                db.session.add(conversacion)
+                agente.conversaciones += 1
+                db.session.commit()
+        except Exception as e:
+            bot.errores += 1
+            bot.ultimo_error = str(e)
+            print(f"❌ Error atendiendo mensaje de Telegram (agente {bot.agente_id}): {e}")
+
+    def _guardar_offset(self, agente_id, offset):
+        """Persistir el offset para no reprocesar mensajes tras un reinicio"""
+        from src.models.agente import db, Agente
+
+        with self._app.app_context():
+            agente = db.session.get(Agente, agente_id)
+            if agente is not None:
+                agente.telegram_offset = offset
+                db.session.commit()
+
+    def estadisticas(self):
+        bots = list(self._bots.values())
+        return {
+            'activo': self._hilo is not None,
+            'apiBase': TELEGRAM_API_BASE,
+            'concurrencia': TELEGRAM_CONCURRENCIA,
+            'longPoll': TELEGRAM_LONG_POLL,
+            'validacion': validacion_tokens.estadisticas(),
+            'bots': [bot.to_dict() for bot in bots]
+        }
+
+telegram_runtime = RuntimeTelegram()
@@ -0,0 +1,264 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from flask import request
+from src.models.user import db
+from src.models.trabajo import Trabajo
+from src.services.proveedores import SaturacionProveedor
+from src.services.admision import inquilino, como_inquilino
+from src.services.plazos import con_plazo, plazo_agente
+
+# Cola persistente de trabajos de generación. En modo asíncrono las rutas de
+# chat y de sala guardan el mensaje, encolan un trabajo por agente en SQLite
+# y responden 202 al momento; un pool de hilos consume la cola y guarda las
+# respuestas. Los trabajos pendientes sobreviven a los reinicios.
+#
+# Cada trabajo reclamado tiene propietario y una concesión que el proceso
+# renueva con latidos mientras lo genera. Solo se vuelven a encolar los
+# trabajos cuya concesión caducó (el proceso murió), no los que genera otro
+# proceso vivo (el padre del reloader, otro worker del despliegue).
+
+TRABAJOS_WORKERS = int(os.getenv('TRABAJOS_WORKERS', '2'))
+TRABAJOS_INTENTOS_MAX = int(os.getenv('TRABAJOS_INTENTOS_MAX', '3'))
+TRABAJOS_SONDEO_SEGUNDOS = float(os.getenv('TRABAJOS_SONDEO_SEGUNDOS', '2'))
+TRABAJOS_LATIDO_SEGUNDOS = float(os.getenv('TRABAJOS_LATIDO_SEGUNDOS', '10'))
+TRABAJOS_CONCESION_SEGUNDOS = float(os.getenv('TRABAJOS_CONCESION_SEGUNDOS', '60'))
+
+def solicita_asincrono(data=None):
+    """Indica si el cliente pidió procesar la generación en segundo plano (202)"""
+    if request.args.get('async', '').lower() in ('1', 'true'):
+        return True
+    if data and data.get('async'):
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+class ColaTrabajos:
+    def __init__(self):
+        self._app = None
+        self._hilos = []
+        self.propietario = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._cambios = threading.Condition()
+        self._lock = threading.Lock()
+        self.recuperados = 0
+        self.completados = 0
+        self.fallidos = 0
+        self.reintentos = 0
+
+    def iniciar(self, app):
+        """Recuperar los trabajos abandonados y arrancar los workers y los latidos"""
+        with self._lock:
+            if self._hilos:
+                return
+            self._app = app
+            with app.app_context():
+                self._recuperar()
+            for numero in range(TRABAJOS_WORKERS):
+                hilo = threading.Thread(target=self._bucle, name=f'trabajos-{numero}', daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+            hilo = threading.Thread(target=self._bucle_latidos, name='trabajos-latidos', daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+
+    def _recuperar(self):
+        """Devolver a la cola los trabajos en curso cuya concesión caducó"""
+        caducidad = datetime.utcnow() - timedelta(seconds=TRABAJOS_CONCESION_SEGUNDOS)
+        recuperados = Trabajo.query.filter(
+            Trabajo.estado == 'en_curso',
+            db.or_(Trabajo.latido < caducidad, db.and_(Trabajo.latido.is_(None), Trabajo.fecha_inicio < caducidad))
+        ).update({'estado': 'pendiente', 'propietario': None}, synchronize_session=False)
+        db.session.commit()
+        if recuperados:
+            with self._lock:
+                self.recuperados += recuperados
+            print(f"🔁 {recuperados} trabajos de generación recuperados")
+        return recuperados
+
+    def _latir(self):
+        """Renovar la concesión de los trabajos que genera este proceso"""
+        Trabajo.query.filter_by(estado='en_curso', propietario=self.propietario).update(
+            {'latido': datetime.utcnow()}, synchronize_session=False
+        )
+        db.session.commit()
+
+    def _bucle_latidos(self):
+        while True:
+            time.sleep(TRABAJOS_LATIDO_SEGUNDOS)
+            try:
+                with self._app.app_context():
+                    self._latir()
+                    # Recoger también lo que abandone otro proceso mientras este sigue vivo
+                    if self._recuperar():
+                        self.avisar()
+            except Exception as e:
+                print(f"⚠️ Error renovando trabajos de generación: {e}")
+
+    def encolar(self, tipo, agente, mensaje, prompt, usuario=None, sala_id=None, mensaje_id=None, **parametros):
+        """Añadir un trabajo a la sesión; se procesa cuando la petición hace commit y llama a avisar()"""
+        trabajo = Trabajo(
+            tipo=tipo,
+            agente_id=agente.id,
+            sala_id=sala_id,
+            mensaje_id=mensaje_id,
+            usuario=usuario,
+            mensaje=mensaje,
+            prompt=prompt,
+            parametros=json.dumps(parametros)
+        )
+        db.session.add(trabajo)
+        return trabajo
+
+    def avisar(self):
+        """Despertar a los workers y a los clientes que esperan resultados"""
+        with self._cambios:
+            self._cambios.notify_all()
+
+    def esperar_cambios(self, segundos=None):
+        with self._cambios:
+            self._cambios.wait(segundos or TRABAJOS_SONDEO_SEGUNDOS)
+
+    def _bucle(self):
+        while True:
+            try:
+                with self._app.app_context():
+                    procesado = self._siguiente()
+            except Exception as e:
+                print(f"⚠️ Error en la cola de trabajos: {e}")
+                procesado = False
+            if not procesado:
+                # Sin trabajo: esperar un aviso (o sondear por si encola otro proceso)
+                self.esperar_cambios()
+
+    def _siguiente(self):
+        """Reclamar y procesar el siguiente trabajo; False si la cola está vacía"""
+        ahora = datetime.utcnow()
+        candidato = db.session.query(Trabajo.id).filter(
+            Trabajo.estado == 'pendiente', Trabajo.disponible_en <= ahora
+        ).order_by(Trabajo.id).first()
+        if candidato is None:
+            return False
+
+        # Reclamar con un UPDATE condicional: si otro worker se adelantó no se toca
+        reclamado = Trabajo.query.filter_by(id=candidato.id, estado='pendiente').update({
+            'estado': 'en_curso',
+            'propietario': self.propietario,
+            'fecha_inicio': ahora,
+            'latido': ahora,
+            'intentos': Trabajo.intentos + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        if reclamado:
+            self._procesar(db.session.get(Trabajo, candidato.id))
+        return True
+
+    def _procesar(self, trabajo):
+        from src.models.agente import Agente
+        from src.routes.agentes import generar_respuesta_ia
+        from src.services.concurrencia import copiar_agente
+        from src.services.respaldo import modelo_de
+
+        agente = db.session.get(Agente, trabajo.agente_id)
+        parametros = trabajo.leer_parametros()
+        inicio = time.monotonic()
+        try:
+            if agente is None:
+                raise ValueError('Agente no encontrado')
+            with como_inquilino(inquilino(trabajo.sala_id, trabajo.usuario)), con_plazo(plazo_agente(agente)):
+                respuesta = generar_respuesta_ia(
+                    trabajo.prompt, copiar_agente(agente), parametros.get('cache'), parametros.get('sesion')
+                )
+        except Exception as e:
+            db.session.rollback()
+            if not self._sigue_siendo_propio(trabajo):
+                return
+            if trabajo.intentos < TRABAJOS_INTENTOS_MAX and agente is not None:
+                # Saturación u otro fallo transitorio: volver a la cola más tarde
+                espera = e.reintentar_en if isinstance(e, SaturacionProveedor) else 2 ** trabajo.intentos
+                trabajo.estado = 'pendiente'
+                trabajo.propietario = None
+                trabajo.error = str(e)
+                trabajo.disponible_en = datetime.utcnow() + timedelta(seconds=espera)
+                db.session.commit()
+                with self._lock:
+                    self.reintentos += 1
+                return
+            self._terminar(trabajo, agente, None, error=str(e))
+            return
+
+        if not self._sigue_siendo_propio(trabajo):
+            return
+        trabajo.modelo = modelo_de(respuesta, agente.modelo)
+        self._terminar(trabajo, agente, respuesta, duracion_ms=round((time.monotonic() - inicio) * 1000, 1))
+
+    def _sigue_siendo_propio(self, trabajo):
+        """Indica si la concesión sigue siendo de este proceso; si caducó y otro
+        proceso lo reclamó, el resultado se descarta para no guardarlo dos veces"""
+        db.session.refresh(trabajo)
+        return trabajo.estado == 'en_curso' and trabajo.propietario == self.propietario
+
+    def _terminar(self, trabajo, agente, respuesta, duracion_ms=None, error=None):
+        """Guardar el resultado donde lo guardaría la ruta síncrona y cerrar el trabajo"""
+        from src.models.agente import Conversacion
+        from src.models.sala import Sala
+        from src.routes.salas import guardar_respuesta_agente
+
+        if trabajo.tipo == 'sala' and agente is not None:
+            sala = db.session.get(Sala, trabajo.sala_id)
+            if sala is not None:
+                if error is None:
+                    resultado = guardar_respuesta_agente(sala, agente, 'ok', respuesta, duracion_ms=duracion_ms)
+                else:
+                    resultado = guardar_respuesta_agente(
+                        sala, agente, 'error', None, f"Error generando respuesta: {error}", duracion_ms
+                    )
+                db.session.flush()
+                trabajo.resultado_id = resultado.id
+        elif trabajo.tipo == 'chat' and error is None:
+            conversacion = Conversacion(
+                agente_id=agente.id,
+                sala_id=trabajo.sala_id,
+                usuario=trabajo.usuario,
+                mensaje_usuario=trabajo.mensaje,
+                respuesta_agente=respuesta,
+                canal='web'
+            )
+            db.session.add(conversacion)
+            agente.conversaciones += 1
+            db.session.flush()
+            trabajo.resultado_id = conversacion.id
+
+        trabajo.estado = 'error' if error else 'completado'
+        trabajo.respuesta = respuesta
+        trabajo.error = error
+        trabajo.fecha_fin = datetime.utcnow()
+        db.session.commit()
+        with self._lock:
+            if error:
+                self.fallidos += 1
+            else:
+                self.completados += 1
+        self.avisar()
+
+    def estadisticas(self):
+        estados = dict(db.session.query(Trabajo.estado, db.func.count(Trabajo.id)).group_by(Trabajo.estado).all())
+        with self._lock:
+            return {
+                'workers': TRABAJOS_WORKERS if self._hilos else 0,
+                'propietario': self.propietario,
+                'concesionSegundos': TRABAJOS_CONCESION_SEGUNDOS,
+                'intentosMax': TRABAJOS_INTENTOS_MAX,
+                'pendientes': estados.get('pendiente', 0),
+                'enCurso': estados.get('en_curso', 0),
+                'completadosTotal': estados.get('completado', 0),
+                'erroresTotal': estados.get('error', 0),
+                'recuperados': self.recuperados,
+                'completados': self.completados,
+                'fallidos': self.fallidos,
+                'reintentos': self.reintentos
+            }
+
+cola_trabajos = ColaTrabajos()
@@ -0,0 +1,68 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import falsos
+
+# La configuración se lee al importar los servicios: apuntar todo a los falsos antes
+for variable in ('OLLAMA_URL', 'LMSTUDIO_URL', 'LOCALAI_URL', 'OPENAI_API_BASE', 'ANTHROPIC_API_BASE'):
+    os.environ[variable] = falsos.URL_PROVEEDOR
+os.environ['TELEGRAM_API_BASE'] = falsos.URL_TELEGRAM
+os.environ.setdefault('OPENAI_API_KEY', 'sk-prueba')
+os.environ.setdefault('ANTHROPIC_API_KEY', 'sk-ant-prueba')
+
+from flask import Flask
+from src.models.user import db
+from src.models.agente import Agente
+from src.models.sala import Sala
+from src.models.trabajo import Trabajo
+from src.models.lote import Lote, ElementoLote
+
+@pytest.fixture
+def app(tmp_path):
+    """Aplicación con todas las rutas sobre una base SQLite temporal"""
+    from src.routes.agentes import agentes_bp
+    from src.routes.salas import salas_bp
+    from src.routes.modelos import modelos_bp
+    from src.routes.trabajos import trabajos_bp
+    from src.routes.lotes import lotes_bp
+
+    aplicacion = Flask(__name__)
+    aplicacion.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'pruebas.db'}"
+    aplicacion.config['TESTING'] = True
+    for blueprint in (agentes_bp, salas_bp, modelos_bp, trabajos_bp, lotes_bp):
+        aplicacion.register_blueprint(blueprint, url_prefix='/api')
+    db.init_app(aplicacion)
+    with aplicacion.app_context():
+        db.create_all()
+        yield aplicacion
+        db.session.remove()
+
+@pytest.fixture
+def cliente(app):
+    return app.test_client()
+
+@pytest.fixture
+def proveedor():
+    """Proveedor de modelos falso con el estado limpio"""
+    falsos.proveedor.reiniciar()
+    yield falsos.proveedor
+    falsos.proveedor.reiniciar()
+
+@pytest.fixture
+def crear_agente(app):
+    def crear(**campos):
+        valores = {
+            'nombre': 'Ana', 'rol': 'Analista', 'avatar': 'A', 'modelo': 'ollama:llama2',
+            'prompt': 'Eres un asistente.', 'temperatura': 0.7, 'max_tokens': 50, 'estado': 'activo'
+        }
+        valores.update(campos)
+        agente = Agente(**valores)
+        db.session.add(agente)
+        db.session.commit()
+        return agente
+    return crear
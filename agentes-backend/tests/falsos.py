@@ -0,0 +1,226 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# Servidores HTTP locales que imitan a los proveedores de modelos (Ollama,
+# LM Studio, OpenAI, Anthropic) y a la API de bots de Telegram.
+
+class ProveedorFalso:
+    """Estado y respuestas del proveedor de modelos falso"""
+
+    def __init__(self):
+        self.reiniciar()
+
+    def reiniciar(self):
+        self.retardo = 0.0  # segundos antes de responder
+        self.retardos_modelo = {}  # modelo -> segundos antes de responder (en lugar de `retardo`)
+        self.retardo_token = 0.01
+        self.estados = []  # códigos a devolver en las próximas peticiones (luego 200)
+        self.reintentar_en = '0'
+        self.peticiones = []
+        self.llamadas = 0
+        self.tokens_enviados = 0
+        self.palabras = 4
+        self.cuerpo_modelos_ps = {'models': []}
+        self.lock = threading.Lock()
+
+    def texto(self, modelo, numero):
+        return ' '.join([f'Hola desde {modelo} {numero}'] + ['mas'] * max(self.palabras - 4, 0))
+
+class _ManejadorProveedor(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    estado = None
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, objeto, codigo=200, cabeceras=None):
+        cuerpo = json.dumps(objeto).encode()
+        self.send_response(codigo)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        for clave, valor in (cabeceras or {}).items():
+            self.send_header(clave, valor)
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def _trozo(self, texto):
+        datos = texto.encode()
+        self.wfile.write(f'{len(datos):x}\r\n'.encode() + datos + b'\r\n')
+        self.wfile.flush()
+
+    def _cuerpo(self):
+        longitud = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(longitud) or b'{}')
+
+    def do_GET(self):
+        estado = self.estado
+        estado.peticiones.append(('GET', self.path, None))
+        if self.path.startswith('/api/tags'):
+            return self._json({'models': [{'name': 'llama2:latest', 'size': 3 * 1024 ** 3}]})
+        if self.path.startswith('/api/ps'):
+            return self._json(estado.cuerpo_modelos_ps)
+        if self.path.endswith('/models'):
+            return self._json({'data': [{'id': 'local-model'}]})
+        self._json({}, 404)
+
+    def do_POST(self):
+        estado = self.estado
+        cuerpo = self._cuerpo()
+        with estado.lock:
+            estado.llamadas += 1
+            numero = estado.llamadas
+            codigo = estado.estados.pop(0) if estado.estados else 200
+        estado.peticiones.append(('POST', self.path, cuerpo))
+        time.sleep(estado.retardos_modelo.get(cuerpo.get('model'), estado.retardo))
+        if codigo != 200:
+            return self._json({'error': 'falso'}, codigo, {'Retry-After': estado.reintentar_en})
+
+        texto = estado.texto(cuerpo.get('model'), numero)
+        if self.path == '/api/pull':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for completado in (0, 50, 100):
+                self._trozo(json.dumps({'status': 'downloading', 'completed': completado, 'total': 100}) + '\n')
+            self._trozo(json.dumps({'status': 'success'}) + '\n')
+            self._trozo('')
+            return
+        if self.path == '/api/generate':
+            if cuerpo.get('stream') is False:
+                return self._json({'response': texto, 'done': True, 'context': [1, 2, 3]})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for palabra in texto.split(' '):
+                    self._trozo(json.dumps({'response': palabra + ' ', 'done': False}) + '\n')
+                    estado.tokens_enviados += 1
+                    time.sleep(estado.retardo_token)
+                self._trozo(json.dumps({'response': '', 'done': True, 'context': [1, 2, 3, 4]}) + '\n')
+                self._trozo('')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            return
+        if self.path.endswith('/chat/completions') and cuerpo.get('stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for palabra in texto.split(' '):
+                self._trozo('data: ' + json.dumps({'choices': [{'delta': {'content': palabra + ' '}}]}) + '\n\n')
+                time.sleep(estado.retardo_token)
+            self._trozo('data: [DONE]\n\n')
+            self._trozo('')
+            return
+        if self.path.endswith('/chat/completions'):
+            return self._json({'choices': [{'message': {'content': texto}}], 'usage': {'total_tokens': 10}})
+        if self.path.endswith('/messages'):
+            return self._json({'content': [{'text': texto}]})
+        self._json({}, 404)
+
+class TelegramFalso:
+    """Estado de la API de bots de Telegram falsa"""
+
+    def __init__(self):
+        self.reiniciar()
+
+    def reiniciar(self):
+        self.updates = {}  # token -> lista de updates pendientes
+        self.enviados = []  # (token, chat_id, texto)
+        self.peticiones = []  # (token, metodo, parámetros)
+        self.conexiones = 0  # conexiones TCP aceptadas
+        self.trozos = False  # responder con Transfer-Encoding: chunked
+        self.cortar = 0  # cerrar la conexión sin responder en las próximas N peticiones
+        self.condicion = threading.Condition()
+
+    def encolar(self, token, chat_id, texto):
+        with self.condicion:
+            cola = self.updates.setdefault(token, [])
+            siguiente = max([u['update_id'] for u in cola], default=0) + 1
+            cola.append({'update_id': siguiente, 'message': {'chat': {'id': chat_id}, 'text': texto}})
+            self.condicion.notify_all()
+
+class _ManejadorTelegram(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    estado = None
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.estado.condicion:
+            self.estado.conexiones += 1
+
+    def _responder(self, objeto):
+        cuerpo = json.dumps(objeto).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if self.estado.trozos:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            mitad = len(cuerpo) // 2
+            for parte in (cuerpo[:mitad], cuerpo[mitad:], b''):
+                self.wfile.write(f'{len(parte):x}\r\n'.encode() + parte + b'\r\n')
+        else:
+            self.send_header('Content-Length', str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+        self.wfile.flush()
+
+    def do_GET(self):
+        partes = urlsplit(self.path)
+        parametros = {clave: valores[0] for clave, valores in parse_qs(partes.query).items()}
+        self._atender(partes.path, parametros)
+
+    def do_POST(self):
+        longitud = int(self.headers.get('Content-Length') or 0)
+        self._atender(self.path, json.loads(self.rfile.read(longitud) or b'{}'))
+
+    def _atender(self, ruta, parametros):
+        estado = self.estado
+        _, _, token_metodo = ruta.partition('/bot')
+        token, _, metodo = token_metodo.partition('/')
+        with estado.condicion:
+            estado.peticiones.append((token, metodo, parametros))
+            if estado.cortar:
+                estado.cortar -= 1
+                self.close_connection = True
+                return
+        if metodo == 'getMe':
+            return self._responder({'ok': True, 'result': {'id': 1, 'username': f'bot_{token[:4]}'}})
+        if metodo == 'getUpdates':
+            offset = int(parametros.get('offset') or 0)
+            limite = time.monotonic() + min(float(parametros.get('timeout', 0)), 2)
+            with estado.condicion:
+                while True:
+                    updates = [u for u in estado.updates.get(token, []) if u['update_id'] >= offset]
+                    restante = limite - time.monotonic()
+                    if updates or restante <= 0:
+                        break
+                    estado.condicion.wait(restante)
+            return self._responder({'ok': True, 'result': updates})
+        if metodo == 'sendMessage':
+            with estado.condicion:
+                estado.enviados.append((token, parametros.get('chat_id'), parametros.get('text')))
+                estado.condicion.notify_all()
+            return self._responder({'ok': True, 'result': {'message_id': len(estado.enviados)}})
+        self._responder({'ok': False, 'description': 'Método desconocido'})
+
+def arrancar(estado, manejador):
+    """Servir `estado` con `manejador` en un puerto libre; devuelve la URL base"""
+    clase = type(manejador.__name__, (manejador,), {'estado': estado})
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), clase)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{servidor.server_address[1]}'
+
+proveedor = ProveedorFalso()
+URL_PROVEEDOR = arrancar(proveedor, _ManejadorProveedor)
+telegram = TelegramFalso()
+URL_TELEGRAM = arrancar(telegram, _ManejadorTelegram)
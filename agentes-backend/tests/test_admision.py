@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+
+from src.services import admision
+from src.services.admision import ControlAdmision, como_inquilino, LOTE
+from src.services.plazos import con_plazo
+from src.services.proveedores import SaturacionProveedor, PlazoAgotado
+
+MODELO = 'ollama:llama2'
+
+def _en_cola(control):
+    return control.estadisticas().get('ollama', {}).get('enCola', 0)
+
+class Turnos:
+    """Peticiones que esperan hueco en hilos y anotan el orden en que entran"""
+
+    def __init__(self, control):
+        self.control = control
+        self.orden = []
+        self.hilos = []
+
+    def pedir(self, nombre, inquilino, prioridad=admision.INTERACTIVA, timeout=5):
+        def entrar():
+            with como_inquilino(inquilino, prioridad):
+                try:
+                    with self.control.admitir(MODELO, timeout):
+                        self.orden.append(nombre)
+                except SaturacionProveedor:
+                    self.orden.append(f'{nombre}:expirada')
+
+        esperadas = _en_cola(self.control) + 1
+        hilo = threading.Thread(target=entrar, daemon=True)
+        hilo.start()
+        self.hilos.append(hilo)
+        # Encolar en un orden conocido
+        while _en_cola(self.control) < esperadas and hilo.is_alive():
+            time.sleep(0.005)
+
+    def terminar(self):
+        for hilo in self.hilos:
+            hilo.join(5)
+
+@pytest.fixture
+def control():
+    return ControlAdmision()
+
+def test_reparto_justo_entre_inquilinos(control):
+    turnos = Turnos(control)
+    with control.admitir(MODELO):
+        for numero in (1, 2, 3):
+            turnos.pedir(f'a{numero}', 'sala:a')
+        turnos.pedir('b1', 'sala:b')
+    turnos.terminar()
+
+    # La sala b no espera a que la sala a vacíe su cola
+    assert turnos.orden == ['a1', 'b1', 'a2', 'a3']
+
+def test_lo_interactivo_pasa_antes_que_el_lote(control):
+    turnos = Turnos(control)
+    with control.admitir(MODELO):
+        turnos.pedir('resumen', 'lote:1', LOTE)
+        turnos.pedir('chat', 'usuario:ana')
+    turnos.terminar()
+
+    assert turnos.orden == ['chat', 'resumen']
+
+def test_una_peticion_expirada_no_gasta_turno(control):
+    turnos = Turnos(control)
+    with control.admitir(MODELO):
+        turnos.pedir('a0', 'sala:a', timeout=0.05)
+        turnos.hilos[0].join(5)
+        turnos.pedir('a1', 'sala:a')
+        turnos.pedir('b1', 'sala:b')
+    turnos.terminar()
+
+    assert turnos.orden == ['a0:expirada', 'a1', 'b1']
+
+def test_una_peticion_rechazada_no_gasta_turno(control, monkeypatch):
+    monkeypatch.setattr(admision, 'COLA_MAX', 1)
+    turnos = Turnos(control)
+    with control.admitir(MODELO):
+        turnos.pedir('c1', 'sala:c')
+        with como_inquilino('sala:a'), pytest.raises(SaturacionProveedor) as error:
+            with control.admitir(MODELO, 5):
+                pass
+        assert error.value.codigo == 429
+        assert ('ollama', 'sala:a') not in control._ultima_etiqueta
+    turnos.terminar()
+
+    assert turnos.orden == ['c1']
+
+def test_sin_hueco_antes_del_plazo_lanza_plazo_agotado(control):
+    with control.admitir(MODELO):
+        with con_plazo(0.1), pytest.raises(PlazoAgotado) as error:
+            with control.admitir(MODELO):
+                pass
+    assert error.value.codigo == 504
+    assert control.estadisticas()['ollama']['expiradas'] == 1
+
+def test_sin_hueco_en_la_espera_maxima_sigue_siendo_saturacion(control):
+    with control.admitir(MODELO):
+        with con_plazo(5), pytest.raises(SaturacionProveedor) as error:
+            with control.admitir(MODELO, 0.05):
+                pass
+    assert error.value.codigo == 503
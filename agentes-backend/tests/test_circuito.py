@@ -0,0 +1,43 @@
+import time
+
+import pytest
+
+import falsos
+from src.services import circuito as modulo_circuito
+from src.services import proveedores
+from src.services.circuito import circuitos, PRUEBA, SEMIABIERTO, CERRADO
+from src.services.plazos import con_plazo
+from src.services.proveedores import PlazoAgotado
+
+@pytest.fixture
+def semiabierto():
+    """Circuito del proveedor falso listo para dejar pasar su petición de prueba"""
+    circuito = circuitos.circuito(falsos.URL_PROVEEDOR)
+    for _ in range(modulo_circuito.UMBRAL_FALLOS):
+        circuito.registrar_fallo('caído')
+    circuito.abierto_desde = time.monotonic() - modulo_circuito.TIEMPO_ABIERTO
+    yield circuito
+    circuito.registrar_exito()
+
+def test_prueba_con_plazo_agotado_libera_el_circuito(semiabierto, proveedor):
+    proveedor.retardo = 1.0
+
+    with con_plazo(0.2), pytest.raises(PlazoAgotado):
+        proveedores.post('openai', '/chat/completions', json={'model': 'gpt-4o-mini'})
+
+    # Sin veredicto: sigue semiabierto y la siguiente petición puede probar
+    assert semiabierto.estado == SEMIABIERTO
+    assert semiabierto.prueba_en_curso is False
+    assert semiabierto.permitir() == PRUEBA
+
+def test_prueba_con_plazo_ya_vencido_libera_el_circuito(semiabierto, proveedor):
+    with con_plazo(0), pytest.raises(PlazoAgotado):
+        proveedores.post('openai', '/chat/completions', json={'model': 'gpt-4o-mini'})
+
+    assert semiabierto.prueba_en_curso is False
+
+def test_prueba_correcta_cierra_el_circuito(semiabierto, proveedor):
+    response = proveedores.post('openai', '/chat/completions', json={'model': 'gpt-4o-mini'})
+
+    assert response.status_code == 200
+    assert semiabierto.estado == CERRADO
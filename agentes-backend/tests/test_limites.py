@@ -0,0 +1,102 @@
+import threading
+import time
+import uuid
+
+import pytest
+
+from src.services import limites
+from src.services.admision import ControlAdmision
+from src.services.limites import CuboTokens, LimitesApi
+from src.services.plazos import con_plazo
+from src.services.proveedores import SaturacionProveedor, PlazoAgotado
+
+def _post(api, tokens, clave):
+    return api.post('openai', '/chat/completions', tokens, json={'model': 'gpt-4o-mini', 'messages': []},
+                    headers={'Authorization': f'Bearer {clave}'})
+
+def _estadisticas(api):
+    return api.estadisticas()['claves'][0]
+
+def test_cubo_reserva_en_deuda_y_se_rellena():
+    cubo = CuboTokens(60)
+    assert cubo.reservar(60, cubo.actualizado) == 0
+    assert cubo.reservar(30, cubo.actualizado) == pytest.approx(30)
+    assert cubo.reservar(0, cubo.actualizado + 30) == pytest.approx(0)
+    cubo.devolver(1000, cubo.actualizado)
+    assert cubo.nivel == 60
+
+def test_peticion_mayor_que_el_cubo_no_se_bloquea():
+    cubo = CuboTokens(100)
+    assert cubo.reservar(500, cubo.actualizado) == 0
+    assert cubo.nivel == 0
+
+def test_los_429_no_consumen_tokens_de_mas(proveedor):
+    api = LimitesApi()
+    proveedor.estados = [429, 429]
+
+    response = _post(api, 1000, uuid.uuid4().hex)
+
+    assert response.status_code == 200
+    estadisticas = _estadisticas(api)
+    assert estadisticas['limitadas429'] == 2
+    # Tres intentos, pero solo la petición que salió bien gasta su estimación
+    assert estadisticas['tokensDisponibles'] == pytest.approx(limites.LIMITES_TPM['openai'] - 1000, abs=100)
+
+def test_el_backoff_cuenta_como_tiempo_limitado(proveedor):
+    api = LimitesApi()
+    proveedor.estados = [429]
+    proveedor.reintentar_en = '0.2'
+
+    assert _post(api, 10, uuid.uuid4().hex).status_code == 200
+
+    estadisticas = _estadisticas(api)
+    assert estadisticas['segundosBackoff'] == pytest.approx(0.2, abs=0.05)
+    assert estadisticas['segundosEspera'] == pytest.approx(0, abs=0.01)
+    assert api.estadisticas()['segundosLimitadoTotal'] == pytest.approx(0.2, abs=0.05)
+
+def test_agotar_los_reintentos_lanza_saturacion(proveedor, monkeypatch):
+    monkeypatch.setattr(limites, 'LIMITE_REINTENTOS', 1)
+    api = LimitesApi()
+    proveedor.estados = [429, 429]
+    proveedor.reintentar_en = '0.1'
+
+    with pytest.raises(SaturacionProveedor) as error:
+        _post(api, 10, uuid.uuid4().hex)
+
+    assert error.value.codigo == 429
+    assert error.value.reintentar_en == 1
+    assert _estadisticas(api)['tokensDisponibles'] == pytest.approx(limites.LIMITES_TPM['openai'], abs=100)
+
+def test_un_turno_posterior_al_plazo_lanza_plazo_agotado(proveedor):
+    api = LimitesApi()
+    clave = uuid.uuid4().hex
+    _post(api, limites.LIMITES_TPM['openai'], clave)
+
+    with con_plazo(0.1), pytest.raises(PlazoAgotado):
+        _post(api, 1000, clave)
+    assert proveedor.llamadas == 1
+
+def test_esperar_turno_del_limite_suelta_el_hueco_de_admision(proveedor, monkeypatch):
+    monkeypatch.setenv('ADMISION_MAX_OPENAI', '1')
+    control = ControlAdmision()
+    monkeypatch.setattr(limites, 'control_admision', control)
+    api = LimitesApi()
+    clave = uuid.uuid4().hex
+    # Agotar el cubo de tokens: la siguiente petición espera ~0.4 s su turno
+    _post(api, limites.LIMITES_TPM['openai'], clave)
+    tokens = int(limites.LIMITES_TPM['openai'] * 0.4 / 60)
+
+    hilo = threading.Thread(target=lambda: _admitido_y_post(control, api, tokens, clave), daemon=True)
+    hilo.start()
+    time.sleep(0.1)
+    # Otra generación del mismo proveedor entra mientras la primera espera al límite
+    with control.admitir('gpt-4o-mini', 0.2):
+        pass
+    hilo.join(5)
+
+    assert not hilo.is_alive()
+    assert control.estadisticas()['openai']['enVuelo'] == 0
+
+def _admitido_y_post(control, api, tokens, clave):
+    with control.admitir('gpt-4o-mini'):
+        assert _post(api, tokens, clave).status_code == 200
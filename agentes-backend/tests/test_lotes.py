@@ -0,0 +1,108 @@
+import json
+import threading
+from datetime import datetime, timedelta
+
+from src.models.user import db
+from src.models.lote import Lote
+from src.services import lotes
+from src.services.lotes import gestor_lotes
+from src.services.proveedores import SaturacionProveedor
+
+def _eventos(respuesta):
+    return [json.loads(linea) for linea in respuesta.get_data(as_text=True).splitlines() if linea]
+
+def _lote_cortado(prompts, completados):
+    """Lote como el que deja un cliente desconectado: parte generado, parte pendiente"""
+    lote = gestor_lotes.crear(prompts, 'ollama:llama2', usuario='Usuario', cache=False)
+    for elemento in lote.elementos[:completados]:
+        elemento.estado = 'completado'
+        elemento.respuesta = f'previa {elemento.indice}'
+    gestor_lotes.cerrar(lote)
+    return lote
+
+def test_crear_lote_genera_todos_los_prompts(cliente, proveedor):
+    respuesta = cliente.post('/api/lotes', json={'modelo': 'ollama:llama2', 'prompts': ['uno', 'dos', 'tres'],
+                                                 'cache': False})
+    eventos = _eventos(respuesta)
+
+    assert respuesta.status_code == 200
+    assert eventos[0]['tipo'] == 'lote'
+    assert sorted(e['indice'] for e in eventos if e['tipo'] == 'resultado') == [0, 1, 2]
+    assert eventos[-1]['tipo'] == 'fin'
+    assert eventos[-1]['estado'] == 'completado'
+    assert eventos[-1]['completados'] == 3
+
+def test_reanudar_solo_genera_lo_pendiente(cliente, proveedor):
+    lote = _lote_cortado(['uno', 'dos', 'tres'], completados=2)
+    assert lote.estado == 'parcial'
+
+    eventos = _eventos(cliente.post(f'/api/lotes/{lote.id}/reanudar'))
+    resultados = [e for e in eventos if e['tipo'] == 'resultado']
+
+    assert [(e['indice'], e.get('previo', False)) for e in resultados] == [(0, True), (1, True), (2, False)]
+    assert resultados[0]['respuesta'] == 'previa 0'
+    assert resultados[2]['respuesta'].startswith('Hola desde llama2')
+    assert proveedor.llamadas == 1
+    assert eventos[-1]['estado'] == 'completado'
+
+def test_reanudar_un_lote_en_curso_responde_409(cliente, proveedor):
+    lote = _lote_cortado(['uno', 'dos'], completados=1)
+    assert gestor_lotes.reclamar(lote.id) is True
+
+    respuesta = cliente.post(f'/api/lotes/{lote.id}/reanudar')
+
+    assert respuesta.status_code == 409
+    assert proveedor.llamadas == 0
+
+def test_solo_una_reclamacion_gana(app):
+    lote = _lote_cortado(['uno'], completados=0)
+
+    assert [gestor_lotes.reclamar(lote.id) for _ in range(3)] == [True, False, False]
+
+def test_un_lote_abandonado_se_puede_reanudar(cliente, proveedor):
+    lote = _lote_cortado(['uno', 'dos'], completados=1)
+    caducado = datetime.utcnow() - timedelta(seconds=lotes.LOTE_CONCESION_SEGUNDOS + 5)
+    Lote.query.filter_by(id=lote.id).update({'estado': 'en_curso', 'fecha_actualizacion': caducado})
+    db.session.commit()
+
+    eventos = _eventos(cliente.post(f'/api/lotes/{lote.id}/reanudar'))
+
+    assert eventos[-1]['tipo'] == 'fin'
+    assert eventos[-1]['estado'] == 'completado'
+
+def test_los_saturados_se_reintentan_sin_dormir_en_el_executor(cliente, monkeypatch):
+    saturar = {'dos': 1}
+    dormidos = []
+
+    def generar(modelo, prompt, *args):
+        if saturar.get(prompt):
+            saturar[prompt] -= 1
+            raise SaturacionProveedor('saturado', 'ollama', 429, 0.01)
+        return f'respuesta {prompt}', False
+
+    monkeypatch.setattr('src.routes.lotes.generar_con_cache', generar)
+    monkeypatch.setattr(lotes.time, 'sleep', lambda segundos: dormidos.append(threading.current_thread()))
+    reintentos = gestor_lotes.reintentos
+
+    respuesta = cliente.post('/api/lotes', json={'modelo': 'ollama:llama2', 'prompts': ['uno', 'dos']})
+    eventos = _eventos(respuesta)
+
+    assert eventos[-1]['estado'] == 'completado'
+    intentos = {e['indice']: e['intentos'] for e in eventos if e['tipo'] == 'resultado'}
+    assert intentos == {0: 1, 1: 2}
+    assert gestor_lotes.reintentos == reintentos + 1
+    # La espera del Retry-After la hace el hilo del stream, no un worker compartido
+    assert dormidos == [threading.current_thread()]
+
+def test_saturado_en_la_ultima_ronda_queda_pendiente(cliente, monkeypatch):
+    def generar(modelo, prompt, *args):
+        raise SaturacionProveedor('saturado', 'ollama', 429, 0)
+
+    monkeypatch.setattr('src.routes.lotes.generar_con_cache', generar)
+    monkeypatch.setattr(lotes.time, 'sleep', lambda segundos: None)
+
+    eventos = _eventos(cliente.post('/api/lotes', json={'modelo': 'ollama:llama2', 'prompts': ['uno']}))
+
+    assert eventos[-1]['estado'] == 'parcial'
+    assert eventos[-1]['pendientes'] == 1
+    assert eventos[1]['intentos'] == lotes.LOTE_INTENTOS_MAX
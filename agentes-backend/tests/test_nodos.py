@@ -0,0 +1,107 @@
+import pytest
+
+import falsos
+from src.services import proveedores
+from src.services.nodos import pool_nodos
+from src.services.residencia import ResidenciaOllama
+from src.services.descargas import GestorDescargas
+from src.services.monitor import MonitorServicios
+
+GB = 1024 ** 3
+
+@pytest.fixture
+def dos_nodos(monkeypatch):
+    """Ollama repartido en dos nodos falsos"""
+    estados = [falsos.ProveedorFalso(), falsos.ProveedorFalso()]
+    urls = [falsos.arrancar(estado, falsos._ManejadorProveedor) for estado in estados]
+    monkeypatch.setitem(proveedores.CONFIG_PROVEEDORES['ollama'], 'urls', urls)
+    pool_nodos.configurar('ollama', urls)
+    yield dict(zip(urls, estados))
+    pool_nodos._nodos.pop('ollama', None)
+    pool_nodos._afinidad.clear()
+
+def _cargados(estado, *modelos):
+    estado.cuerpo_modelos_ps = {'models': [{'name': nombre, 'size': tamano} for nombre, tamano in modelos]}
+
+def _posts(estado, ruta):
+    return [cuerpo for metodo, camino, cuerpo in estado.peticiones if metodo == 'POST' and camino == ruta]
+
+def test_presupuesto_de_memoria_por_nodo(dos_nodos):
+    (url_a, nodo_a), (url_b, nodo_b) = dos_nodos.items()
+    _cargados(nodo_a, ('a:latest', 3 * GB))
+    _cargados(nodo_b, ('b:latest', 3 * GB))
+    residencia = ResidenciaOllama(presupuesto=4 * GB)
+    residencia.sincronizar(forzar=True)
+
+    # 3 GB + 0.5 GB caben en el nodo A aunque entre los dos nodos sumen 6.5 GB
+    assert residencia._victimas(url_a, 'c:latest', GB // 2) == []
+    assert residencia._victimas(url_a, 'c:latest', 2 * GB) == ['a:latest']
+    estadisticas = residencia.estadisticas()
+    assert estadisticas['nodos'][url_a]['modelos'] == ['a:latest']
+    assert estadisticas['nodos'][url_b]['ocupadoBytes'] == 3 * GB
+
+def test_descargar_de_memoria_va_al_nodo_que_tiene_el_modelo(dos_nodos):
+    (url_a, nodo_a), (url_b, nodo_b) = dos_nodos.items()
+    _cargados(nodo_a, ('a:latest', GB))
+    _cargados(nodo_b, ('b:latest', GB))
+    residencia = ResidenciaOllama()
+    residencia.sincronizar(forzar=True)
+
+    response = residencia.descargar('b')
+    assert response.status_code == 200
+    assert _posts(nodo_b, '/api/generate') == [{'model': 'b:latest', 'keep_alive': 0}]
+    assert _posts(nodo_a, '/api/generate') == []
+
+def test_la_etiqueta_latest_comparte_afinidad_de_nodo(dos_nodos):
+    residencia = ResidenciaOllama()
+    with residencia.usar('llama2') as uso:
+        proveedores.post('ollama', uso.url('/api/generate'), json={'model': 'llama2', 'keep_alive': '5m'})
+    # Una petición relativa con el nombre completo va al mismo nodo
+    for _ in range(3):
+        proveedores.post('ollama', '/api/generate', json={'model': 'llama2:latest', 'keep_alive': 0})
+
+    elegido = dos_nodos[uso.nodo]
+    otro = next(estado for url, estado in dos_nodos.items() if url != uso.nodo)
+    assert len(_posts(elegido, '/api/generate')) == 4
+    assert _posts(otro, '/api/generate') == []
+
+def test_pull_va_a_la_url_del_nodo(dos_nodos):
+    gestor = GestorDescargas()
+    trabajo, nuevo = gestor.iniciar('mistral')
+    assert nuevo and trabajo.esperar(10)
+
+    assert trabajo.estado == 'completado'
+    assert trabajo.to_dict()['nodo'] in dos_nodos
+    pulls = {url: _posts(estado, '/api/pull') for url, estado in dos_nodos.items()}
+    assert pulls[trabajo.nodo] == [{'name': 'mistral', 'stream': True}]
+    assert sum(len(p) for p in pulls.values()) == 1
+
+def test_la_etiqueta_latest_comparte_la_descarga(dos_nodos):
+    for estado in dos_nodos.values():
+        estado.retardo = 0.3
+    gestor = GestorDescargas()
+
+    trabajo, nuevo = gestor.iniciar('mistral')
+    mismo, otro_nuevo = gestor.iniciar('mistral:latest')
+    assert trabajo.esperar(10)
+
+    assert nuevo and not otro_nuevo
+    assert mismo is trabajo
+    assert sum(len(_posts(estado, '/api/pull')) for estado in dos_nodos.values()) == 1
+
+def test_el_monitor_sondea_cada_nodo(dos_nodos, monkeypatch):
+    (url_a, nodo_a), (url_b, nodo_b) = dos_nodos.items()
+    caido = 'http://127.0.0.1:9'
+    monkeypatch.setitem(proveedores.CONFIG_PROVEEDORES['ollama'], 'urls', [caido, url_a, url_b])
+    monitor = MonitorServicios()
+
+    monitor.actualizar()
+    ollama = monitor.instantanea()['servicios']['ollama']
+
+    assert [nodo['url'] for nodo in ollama['nodos']] == [caido, url_a, url_b]
+    assert [nodo['activo'] for nodo in ollama['nodos']] == [False, True, True]
+    assert 'error' in ollama['nodos'][0]
+    assert ollama['activo'] is True
+    # Cada nodo recibe su sondeo, no solo el que elegiría el reparto
+    for estado in (nodo_a, nodo_b):
+        assert [camino for metodo, camino, _ in estado.peticiones if metodo == 'GET'] == ['/api/tags']
@@ -0,0 +1,92 @@
+import json
+import threading
+import time
+
+import pytest
+
+from src.models.agente import Conversacion
+from src.services.coalescencia import VueloUnico
+from src.services.plazos import con_plazo, restante, limitar
+from src.services.proveedores import PlazoAgotado
+
+def test_plazo_anidado_no_alarga_el_exterior():
+    with con_plazo(1):
+        with con_plazo(30):
+            assert restante() <= 1
+    assert restante() is None
+
+def test_el_plazo_llega_a_los_hilos_lanzados():
+    with con_plazo(5):
+        assert 0 < limitar(restante, 1)() <= 1
+
+def test_chat_fuera_de_plazo_responde_504_sin_guardar(cliente, crear_agente, proveedor):
+    agente = crear_agente(modelo='ollama:lento')
+    proveedor.retardo = 1.0
+
+    respuesta = cliente.post(f'/api/agentes/{agente.id}/chat', json={'mensaje': 'hola', 'cache': False},
+                             headers={'X-Plazo-Ms': '200'})
+
+    assert respuesta.status_code == 504
+    assert respuesta.get_json()['plazoAgotado'] is True
+    assert Conversacion.query.count() == 0
+
+def test_chat_dentro_de_plazo_no_cambia(cliente, crear_agente, proveedor):
+    agente = crear_agente()
+
+    respuesta = cliente.post(f'/api/agentes/{agente.id}/chat', json={'mensaje': 'hola', 'cache': False},
+                             headers={'X-Plazo-Ms': '5000'})
+
+    assert respuesta.status_code == 200
+    assert Conversacion.query.count() == 1
+
+def test_stream_fuera_de_plazo_emite_error_504(cliente, crear_agente, proveedor):
+    agente = crear_agente(modelo='ollama:lento')
+    proveedor.retardo = 1.0
+
+    respuesta = cliente.post(f'/api/agentes/{agente.id}/chat', json={'mensaje': 'hola', 'stream': True, 'cache': False},
+                             headers={'X-Plazo-Ms': '200'})
+    eventos = [linea for linea in respuesta.get_data(as_text=True).splitlines() if linea.startswith('data:')]
+
+    assert json.loads(eventos[-1][len('data:'):])['codigo'] == 504
+    assert Conversacion.query.count() == 0
+
+def _lider_lento(vuelos, ejecutar):
+    """Arrancar en un hilo una generación que tarda hasta que se libere el evento"""
+    liberar = threading.Event()
+    hilo = threading.Thread(target=ejecutar, args=(liberar,), daemon=True)
+    hilo.start()
+    while not vuelos.estadisticas()['enVuelo']:
+        time.sleep(0.01)
+    return liberar, hilo
+
+def test_esperar_a_otra_generacion_respeta_el_plazo():
+    vuelos = VueloUnico()
+    liberar, hilo = _lider_lento(vuelos, lambda evento: vuelos.ejecutar('clave', lambda: evento.wait(5) and 'hecho'))
+
+    inicio = time.monotonic()
+    with con_plazo(0.2), pytest.raises(PlazoAgotado):
+        vuelos.ejecutar('clave', lambda: 'no debería llamarse', proveedor='ollama')
+    assert time.monotonic() - inicio < 1
+    assert vuelos.estadisticas()['esperando'] == 0
+
+    liberar.set()
+    hilo.join(5)
+
+def test_seguir_un_stream_ajeno_respeta_el_plazo():
+    vuelos = VueloUnico()
+
+    def tokens_lentos(evento):
+        yield 'uno'
+        evento.wait(5)
+        yield 'dos'
+
+    liberar, hilo = _lider_lento(vuelos, lambda evento: list(vuelos.ejecutar_stream('clave', tokens_lentos, evento)))
+
+    recibidos = []
+    with con_plazo(0.3), pytest.raises(PlazoAgotado):
+        for token in vuelos.ejecutar_stream('clave', tokens_lentos, None, proveedor='ollama'):
+            recibidos.append(token)
+    assert recibidos == ['uno']
+
+    liberar.set()
+    hilo.join(5)
@@ -0,0 +1,79 @@
+import json
+import time
+
+from src.routes.agentes import generar_respuesta_agente, clave_generacion
+import falsos
+from src.services import proveedores
+from src.services.admision import control_admision
+from src.services.cache_respuestas import cache_respuestas
+from src.services.circuito import circuitos, CERRADO
+from src.services.coalescencia import Vuelo, VueloUnico
+from src.services.respaldo import respaldo_modelos, TextoGenerado
+
+def _en_vuelo(modelo):
+    return control_admision.estadisticas()['modelos'].get(modelo, 0)
+
+def test_el_respaldo_gana_y_la_carrera_lenta_libera_su_hueco(crear_agente, proveedor):
+    agente = crear_agente(modelo='ollama:lento', modelos_respaldo=json.dumps(['lmstudio:rapido']),
+                          slo_primer_token_ms=100)
+    proveedor.retardos_modelo = {'lento': 5}
+    canceladas = respaldo_modelos.canceladas
+    fallos = circuitos.estado(falsos.URL_PROVEEDOR)['fallosTotales']
+    errores = proveedores.estadisticas_pools().get('ollama', {}).get('errores', 0)
+
+    inicio = time.monotonic()
+    respuesta = generar_respuesta_agente('hola', agente, usar_cache=False)
+
+    assert respuesta.startswith('Hola desde')
+    assert respuesta.modelo == 'lmstudio:rapido'
+    assert respaldo_modelos.canceladas == canceladas + 1
+    # La lectura bloqueada esperando al modelo lento se corta al cancelar
+    while _en_vuelo('ollama:lento') and time.monotonic() - inicio < 2:
+        time.sleep(0.02)
+    assert _en_vuelo('ollama:lento') == 0
+    assert time.monotonic() - inicio < 2
+    # Cortar la carrera perdida no cuenta como fallo del backend lento
+    circuito = circuitos.estado(falsos.URL_PROVEEDOR)
+    assert circuito['estado'] == CERRADO
+    assert circuito['fallosTotales'] == fallos
+    assert proveedores.estadisticas_pools().get('ollama', {}).get('errores', 0) == errores
+
+def test_el_principal_a_tiempo_no_lanza_respaldo(crear_agente, proveedor):
+    agente = crear_agente(modelos_respaldo=json.dumps(['ollama:rapido']), slo_primer_token_ms=2000)
+
+    respuesta = generar_respuesta_agente('hola', agente, usar_cache=False)
+
+    assert respuesta.modelo == 'ollama:llama2'
+    assert not any(cuerpo and cuerpo.get('model') == 'rapido' for _, _, cuerpo in proveedor.peticiones)
+
+def test_el_stream_coalescido_conserva_el_modelo_ganador():
+    vuelos = VueloUnico()
+    vuelo = Vuelo()
+
+    def tokens():
+        yield TextoGenerado('Hola ', 'lmstudio:rapido')
+        yield 'mundo'
+
+    vuelos._producir('clave', vuelo, tokens, ())
+
+    assert vuelo.resultado == 'Hola mundo'
+    assert vuelo.resultado.modelo == 'lmstudio:rapido'
+
+def test_agentes_con_otra_cadena_de_respaldo_no_comparten_clave(crear_agente):
+    solo = crear_agente()
+    con_respaldo = crear_agente(modelos_respaldo=json.dumps(['lmstudio:rapido']))
+    otro_respaldo = crear_agente(modelos_respaldo=json.dumps(['ollama:rapido']))
+
+    claves = {clave_generacion('hola', agente) for agente in (solo, con_respaldo, otro_respaldo)}
+
+    assert len(claves) == 3
+
+def test_la_respuesta_de_un_respaldo_no_se_guarda_en_cache(crear_agente, proveedor):
+    agente = crear_agente(modelo='ollama:lento', modelos_respaldo=json.dumps(['lmstudio:rapido']),
+                          slo_primer_token_ms=100)
+    proveedor.retardos_modelo = {'lento': 5}
+
+    respuesta = generar_respuesta_agente('hola', agente, usar_cache=True)
+
+    assert respuesta.modelo == 'lmstudio:rapido'
+    assert cache_respuestas.obtener(clave_generacion('hola', agente)) is None
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from src.models.user import db
+from src.models.sala import Sala, Mensaje
+
+@pytest.fixture
+def sala_con_plazo(crear_agente, proveedor):
+    """Sala con un agente rápido y otro lento con plazo propio de 200 ms"""
+    rapido = crear_agente(nombre='Rápido', modelo='lmstudio:rapido')
+    lento = crear_agente(nombre='Lento', modelo='ollama:lento', plazo_respuesta_ms=200)
+    proveedor.retardos_modelo = {'lento': 1.0}
+    sala = Sala(nombre='Dirección', tipo='ejecutiva', agentes_activos=json.dumps([rapido.id, lento.id]))
+    db.session.add(sala)
+    db.session.commit()
+    return sala, rapido, lento
+
+def _metadatos(sala, agente):
+    mensaje = Mensaje.query.filter_by(sala_id=sala.id, agente_id=agente.id).one()
+    return mensaje.texto, json.loads(mensaje.metadatos)
+
+def test_el_plazo_del_agente_se_guarda_como_no_respondio(cliente, sala_con_plazo):
+    sala, rapido, lento = sala_con_plazo
+
+    respuesta = cliente.post(f'/api/salas/{sala.id}/mensajes',
+                             json={'mensaje': 'hola', 'enrutado': False, 'cache': False})
+
+    assert respuesta.status_code == 200
+    texto, metadatos = _metadatos(sala, lento)
+    assert texto.endswith('no respondió a tiempo')
+    assert metadatos.get('timeout') is True
+    assert 'error' not in metadatos
+    texto, metadatos = _metadatos(sala, rapido)
+    assert texto.startswith('Hola desde')
+    assert not metadatos.get('timeout')
+
+def test_en_streaming_el_plazo_del_agente_es_un_timeout(cliente, sala_con_plazo):
+    sala, rapido, lento = sala_con_plazo
+
+    respuesta = cliente.post(f'/api/salas/{sala.id}/mensajes',
+                             json={'mensaje': 'hola', 'enrutado': False, 'cache': False, 'stream': True})
+    eventos = [json.loads(linea[len('data:'):]) for linea in respuesta.get_data(as_text=True).splitlines()
+               if linea.startswith('data:')]
+
+    estados = {e['agenteId']: e['estado'] for e in eventos if 'estado' in e and 'agenteId' in e}
+    assert estados == {rapido.id: 'ok', lento.id: 'timeout'}
+    _, metadatos = _metadatos(sala, lento)
+    assert metadatos.get('timeout') is True
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import falsos
+from src.models.user import db
+from src.models.agente import Agente, Conversacion
+from src.services.historial import historial_chat
+from src.services.telegram import ConexionHttp, RuntimeTelegram, ValidacionTokens, enviar_mensaje
+
+@pytest.fixture
+def telegram():
+    falsos.telegram.reiniciar()
+    yield falsos.telegram
+    falsos.telegram.reiniciar()
+
+def _ejecutar(corrutina):
+    return asyncio.run(corrutina)
+
+def test_get_updates_reutiliza_la_conexion_keep_alive(telegram):
+    telegram.encolar('tok', 7, 'hola')
+
+    async def sondear():
+        conexion = ConexionHttp(falsos.URL_TELEGRAM)
+        try:
+            resultados = []
+            for _ in range(3):
+                resultados.append(await conexion.get_json('/bottok/getUpdates', {'offset': 1, 'timeout': 0}, 5))
+            return resultados
+        finally:
+            await conexion.cerrar()
+
+    resultados = _ejecutar(sondear())
+    assert [status for status, _ in resultados] == [200, 200, 200]
+    assert resultados[0][1]['result'][0]['message']['text'] == 'hola'
+    assert telegram.conexiones == 1
+
+def test_get_updates_con_cuerpo_chunked(telegram):
+    telegram.trozos = True
+    telegram.encolar('tok', 7, 'troceado')
+
+    async def sondear():
+        conexion = ConexionHttp(falsos.URL_TELEGRAM)
+        try:
+            primera = await conexion.get_json('/bottok/getUpdates', {'timeout': 0}, 5)
+            segunda = await conexion.get_json('/bottok/getUpdates', {'offset': 2, 'timeout': 0}, 5)
+            return primera, segunda
+        finally:
+            await conexion.cerrar()
+
+    (status, data), (_, vacia) = _ejecutar(sondear())
+    assert status == 200
+    assert data['result'][0]['message']['text'] == 'troceado'
+    assert vacia['result'] == []
+    assert telegram.conexiones == 1
+
+def test_reconecta_si_el_servidor_cierra_la_conexion(telegram):
+    async def sondear():
+        conexion = ConexionHttp(falsos.URL_TELEGRAM)
+        try:
+            await conexion.get_json('/bottok/getMe', {}, 5)
+            telegram.cortar = 1
+            with pytest.raises(ConnectionError):
+                await conexion.get_json('/bottok/getMe', {}, 5)
+            return await conexion.get_json('/bottok/getMe', {}, 5)
+        finally:
+            await conexion.cerrar()
+
+    status, data = _ejecutar(sondear())
+    assert status == 200 and data['ok']
+    assert telegram.conexiones == 2
+
+def test_long_poll_respeta_el_timeout(telegram):
+    async def sondear():
+        conexion = ConexionHttp(falsos.URL_TELEGRAM)
+        try:
+            await conexion.get_json('/bottok/getUpdates', {'timeout': 10}, 0.3)
+        finally:
+            await conexion.cerrar()
+
+    inicio = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        _ejecutar(sondear())
+    assert time.monotonic() - inicio < 1
+
+def test_send_message(telegram):
+    assert enviar_mensaje('tok', 99, 'respuesta') is True
+    assert telegram.enviados == [('tok', 99, 'respuesta')]
+
+def test_validacion_comparte_consultas_concurrentes(telegram):
+    validacion = ValidacionTokens()
+    resultados = []
+    hilos = [threading.Thread(target=lambda: resultados.append(validacion.validar('tok-valido'))) for _ in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert resultados == [True] * 8
+    assert validacion.validar('tok-valido') is True
+    estadisticas = validacion.estadisticas()
+    assert estadisticas['consultasGetMe'] == 1
+    assert estadisticas['aciertos'] + estadisticas['fallos'] == 9
+
+def test_runtime_responde_y_guarda_la_conversacion(app, crear_agente, proveedor, telegram):
+    agente = crear_agente(telegram=True, telegram_token='tok-bot')
+    runtime = RuntimeTelegram()
+    runtime.iniciar(app)
+    try:
+        runtime.agregar(agente.id, 'tok-bot')
+        telegram.encolar('tok-bot', 42, 'hola bot')
+
+        limite = time.monotonic() + 10
+        with telegram.condicion:
+            while not telegram.enviados and time.monotonic() < limite:
+                telegram.condicion.wait(0.1)
+        assert telegram.enviados[0][:2] == ('tok-bot', 42)
+        assert telegram.enviados[0][2].startswith('Hola desde llama2')
+
+        # El offset se guarda tras atender el lote de updates
+        while time.monotonic() < limite:
+            db.session.expire_all()
+            if db.session.get(Agente, agente.id).telegram_offset == 2:
+                break
+            time.sleep(0.05)
+        assert db.session.get(Agente, agente.id).telegram_offset == 2
+        conversacion = Conversacion.query.one()
+        assert conversacion.canal == 'telegram'
+        assert conversacion.mensaje_usuario == 'hola bot'
+    finally:
+        runtime.quitar(agente.id)
+
+def test_el_historial_no_mezcla_web_y_telegram(app, crear_agente):
+    agente = crear_agente()
+    for canal in ('web', 'telegram'):
+        db.session.add(Conversacion(agente_id=agente.id, usuario='ana', mensaje_usuario=f'hola por {canal}',
+                                    respuesta_agente='hola', canal=canal))
+    db.session.commit()
+
+    en_telegram = historial_chat(agente, 'ana', None, 'sigo', canal='telegram')
+    en_web = historial_chat(agente, 'ana', None, 'sigo')
+
+    assert 'hola por telegram' in en_telegram and 'hola por web' not in en_telegram
+    assert 'hola por web' in en_web and 'hola por telegram' not in en_web
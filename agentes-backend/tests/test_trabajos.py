@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+
+from src.models.user import db
+from src.models.agente import Conversacion
+from src.models.trabajo import Trabajo
+from src.services import trabajos
+from src.services.trabajos import ColaTrabajos
+
+def _cola(app):
+    cola = ColaTrabajos()
+    cola._app = app
+    return cola
+
+def _encolar(cola, agente, mensaje='hola'):
+    trabajo = cola.encolar('chat', agente, mensaje, mensaje, 'Usuario')
+    db.session.commit()
+    return trabajo
+
+def test_un_trabajo_solo_lo_reclama_un_proceso(app, crear_agente, monkeypatch):
+    agente = crear_agente()
+    primera, segunda = _cola(app), _cola(app)
+    procesados = []
+    for cola in (primera, segunda):
+        monkeypatch.setattr(cola, '_procesar', lambda trabajo, cola=cola: procesados.append((cola, trabajo.id)))
+    trabajo = _encolar(primera, agente)
+
+    assert primera._siguiente() is True
+    assert segunda._siguiente() is False
+    assert procesados == [(primera, trabajo.id)]
+
+    db.session.refresh(trabajo)
+    assert trabajo.estado == 'en_curso'
+    assert trabajo.propietario == primera.propietario
+    assert trabajo.latido is not None
+
+def test_recuperar_solo_trabajos_con_concesion_caducada(app, crear_agente):
+    agente = crear_agente()
+    cola = _cola(app)
+    vivo = _encolar(cola, agente, 'vivo')
+    abandonado = _encolar(cola, agente, 'abandonado')
+    ahora = datetime.utcnow()
+    caducado = ahora - timedelta(seconds=trabajos.TRABAJOS_CONCESION_SEGUNDOS + 5)
+    vivo.estado, vivo.propietario, vivo.latido = 'en_curso', 'otro-proceso', ahora
+    abandonado.estado, abandonado.propietario, abandonado.latido = 'en_curso', 'proceso-muerto', caducado
+    db.session.commit()
+
+    assert cola._recuperar() == 1
+    db.session.refresh(vivo)
+    db.session.refresh(abandonado)
+    assert vivo.estado == 'en_curso'
+    assert abandonado.estado == 'pendiente'
+    assert abandonado.propietario is None
+
+def test_latido_renueva_solo_los_trabajos_propios(app, crear_agente):
+    agente = crear_agente()
+    cola = _cola(app)
+    propio = _encolar(cola, agente)
+    ajeno = _encolar(cola, agente)
+    antiguo = datetime.utcnow() - timedelta(minutes=5)
+    propio.estado, propio.propietario, propio.latido = 'en_curso', cola.propietario, antiguo
+    ajeno.estado, ajeno.propietario, ajeno.latido = 'en_curso', 'otro-proceso', antiguo
+    db.session.commit()
+
+    cola._latir()
+    db.session.refresh(propio)
+    db.session.refresh(ajeno)
+    assert propio.latido > antiguo
+    assert ajeno.latido == antiguo
+
+def test_resultado_descartado_si_otro_proceso_reclamo_el_trabajo(app, crear_agente, monkeypatch):
+    agente = crear_agente()
+    cola = _cola(app)
+    trabajo = _encolar(cola, agente)
+
+    def generar(prompt, agente, usar_cache=None, sesion=None):
+        # Mientras tanto la concesión caducó y otro proceso se quedó el trabajo
+        Trabajo.query.filter_by(id=trabajo.id).update({'propietario': 'otro-proceso'})
+        db.session.commit()
+        return 'respuesta tardía'
+
+    monkeypatch.setattr('src.routes.agentes.generar_respuesta_ia', generar)
+    assert cola._siguiente() is True
+
+    db.session.refresh(trabajo)
+    assert trabajo.propietario == 'otro-proceso'
+    assert trabajo.estado == 'en_curso'
+    assert Conversacion.query.count() == 0
+
+def test_trabajo_de_chat_guarda_la_conversacion(app, crear_agente, proveedor):
+    agente = crear_agente()
+    cola = _cola(app)
+    trabajo = _encolar(cola, agente, 'hola chat')
+
+    assert cola._siguiente() is True
+    db.session.refresh(trabajo)
+    assert trabajo.estado == 'completado'
+    assert trabajo.respuesta.startswith('Hola desde llama2')
+    conversacion = db.session.get(Conversacion, trabajo.resultado_id)
+    assert conversacion.mensaje_usuario == 'hola chat'
@@ -4,18 +4,31 @@ Script de diagnóstico para Ollama
 Detecta y muestra todos los modelos disponibles
 """
 
+import os
 import requests
 import json
 import sys
 
+def urls_ollama():
+    """Nodos de Ollama: argumentos, OLLAMA_URLS (separadas por comas) u OLLAMA_URL"""
+    if len(sys.argv) > 1:
+        return [url.rstrip('/') for url in sys.argv[1:]]
+    lista = [url.strip().rstrip('/') for url in os.getenv('OLLAMA_URLS', '').split(',') if url.strip()]
+    return lista or [os.getenv('OLLAMA_URL', 'http://localhost:11434').rstrip('/')]
+
 def diagnosticar_ollama():
     print("🔍 DIAGNÓSTICO DE OLLAMA")
     print("=" * 50)
     
+    for url in urls_ollama():
+        diagnosticar_nodo(url)
+    verificar_proceso()
+
+def diagnosticar_nodo(url):
     # Verificar conexión
     try:
-        print("📡 Verificando conexión a Ollama...")
-        response = requests.get('http://localhost:11434/api/tags', timeout=10)
+        print(f"📡 Verificando conexión a Ollama en {url}...")
+        response = requests.get(f'{url}/api/tags', timeout=10)
         print(f"✅ Estado de respuesta: {response.status_code}")
         
         if response.status_code == 200:
@@ -54,7 +67,7 @@ def diagnosticar_ollama():
             print(f"📄 Respuesta: {response.text}")
             
     except requests.exceptions.ConnectionError:
-        print("❌ No se puede conectar a Ollama en puerto 11434")
+        print(f"❌ No se puede conectar a Ollama en {url}")
         print("💡 Verifica que Ollama esté ejecutándose:")
         print("   - Windows: Busca 'Ollama' en el menú inicio")
         print("   - Terminal: ollama serve")
@@ -64,8 +77,9 @@ def diagnosticar_ollama():
         
     except Exception as e:
         print(f"❌ Error inesperado: {e}")
-    
-    # Verificar proceso
+
+def verificar_proceso():
+    # Verificar proceso (solo en esta máquina)
     print("\n🔍 VERIFICANDO PROCESO...")
     try:
         import subprocess